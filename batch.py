@@ -0,0 +1,211 @@
+"""
+Batch driver: road preparation, road merging and upstream averaging for many towns or tiles.
+
+The jobs come from a JSON manifest, a list with one object per job:
+
+    [{"name": "monkton", "dem": "monkton/dem.tif", "roads": "monkton/roads.gdb", "roads_layer": "dissolved_roads",
+      "culverts": "monkton/culverts.gpkg", "variables": ["monkton/slope.tif"], "params": {"hp_distance": 4.0}}]
+
+Paths are relative to the manifest; the layers, variables, params (see roadprep.PARAMETERS) and fill (the
+hydrocorrection, default 'recursive') are optional. Every job runs the STAGES in order (roadprep, roadmerge, then
+upstream averaging of the variables over the DEM if it has any) into its own directory under the output directory,
+<output>/<name>, with its own scratch directory, so concurrent jobs never share a file; names must be plain directory
+names other than 'cache'. The stage and topology caches are shared (in <output>/cache by default): their entries are
+keyed by content and written atomically.
+
+Each finished stage is recorded in the job's checkpoint.json under a key of the job's settings and the size and
+modification time of its inputs. Running the same batch again resumes it: stages whose key is checkpointed and
+whose outputs exist are skipped, so a crashed or interrupted batch picks up where it stopped, and a job whose inputs
+changed runs again from the start.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from roadprep import PARAMETERS, source_key
+
+STAGES = ('prepare', 'merge', 'upstream')
+CHECKPOINT = 'checkpoint.json'
+CHECKPOINT_VERSION = 1  # bump when a stage's outputs change for the same job
+CACHE_DIR = 'cache'  # default location of the shared caches under the output directory, not a valid job name
+
+def read_manifest(path):
+    """
+    The jobs of a manifest, with their paths made relative to the working directory. Raises ValueError for
+    duplicate, missing or invalid names (anything that isn't a plain directory name, and CACHE_DIR), missing inputs
+    and unknown preparation parameters.
+    """
+    with open(path) as f:
+        jobs = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    names = set()
+    for job in jobs:
+        name = job.get('name')
+        if not name or name in names:
+            raise ValueError(f'every job needs a unique name, got {name!r}')
+        if (not isinstance(name, str) or name in ('.', '..', CACHE_DIR) or
+                any(sep and sep in name for sep in ('/', os.sep, os.altsep))):
+            raise ValueError(f'job names must be directory names other than {CACHE_DIR!r}, got {name!r}')
+        names.add(name)
+        missing = [k for k in ('dem', 'roads', 'culverts') if k not in job]
+        if missing:
+            raise ValueError(f'job {name} has no {", ".join(missing)}')
+        unknown = set(job.get('params', {})) - set(PARAMETERS)
+        if unknown:
+            raise ValueError(f'job {name} has unknown parameters {sorted(unknown)}')
+        for k in ('dem', 'roads', 'culverts'):
+            job[k] = os.path.join(base, job[k])
+        job['variables'] = [os.path.join(base, v) for v in job.get('variables', [])]
+    return jobs
+
+def job_key(job):
+    """
+    Hash of a job's settings and the state of its input files.
+    """
+    sources = [source_key(job[k], job.get(f'{k}_layer')) for k in ('dem', 'roads', 'culverts')]
+    sources += [source_key(v) for v in job['variables']]
+    settings = {k: v for k, v in job.items() if k != 'name'}
+    return hashlib.blake2b(json.dumps([CHECKPOINT_VERSION, settings, sources], sort_keys=True).encode(),
+                           digest_size=16).hexdigest()
+
+def read_checkpoint(job_dir):
+    """
+    The checkpoint of a job: {'key': ..., 'stages': {stage: {'outputs': [...], 'seconds': ...}}}.
+    """
+    try:
+        with open(os.path.join(job_dir, CHECKPOINT)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'key': None, 'stages': {}}
+
+def write_checkpoint(job_dir, checkpoint):
+    """
+    Replace the checkpoint of a job, atomically.
+    """
+    tmp = os.path.join(job_dir, f'.{CHECKPOINT}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(tmp, os.path.join(job_dir, CHECKPOINT))
+
+def _prepare(job, job_dir, scratch, cache_dir):
+    from roadprep import PreparePipeline
+
+    pipeline = PreparePipeline(job['dem'], job['roads'], job['culverts'], os.path.join(cache_dir, 'prepare'),
+                               job.get('roads_layer'), job.get('culverts_layer'), **job.get('params', {}))
+    path = os.path.join(scratch, 'prepared.gpkg')
+    for stage, layer in [('joins', 'split_roads_elev'), ('sample', 'culverts_with_elevation'),
+                         ('high_points', 'high_points'), ('intersections', 'intersections')]:
+        pipeline.get(stage).to_file(path, layer=layer)
+    return ['prepared.gpkg']
+
+def _merge(job, job_dir, scratch, cache_dir):
+    import geopandas as gpd
+    from roadmerge import merge_roads
+
+    prepared = os.path.join(job_dir, 'prepared.gpkg')
+    roads = gpd.read_file(prepared, layer='split_roads_elev')
+    culverts = gpd.read_file(prepared, layer='culverts_with_elevation')
+    merge_roads(roads, culverts, graph=True).to_file(os.path.join(scratch, 'merged_roads.gpkg'),
+                                                      layer='merged_roads')
+    return ['merged_roads.gpkg']
+
+def _upstream(job, job_dir, scratch, cache_dir):
+    import numpy as np
+    from upstreamcache import TopologyCache
+    from upstreamhandler import array_to_tiff, tiff_get_tags, tiff_to_array, tiffs_to_stack
+    from upstreamlib import DEFAULT_NODATA, route_topology
+
+    if not job['variables']:
+        return []
+    _, gt, proj, dx, _, _, nodata = tiff_get_tags(job['dem'])
+    nodata = DEFAULT_NODATA if nodata is None else nodata
+    topology = TopologyCache(os.path.join(cache_dir, 'topology')).get_or_build(
+        tiff_to_array(job['dem']), nodata, fill=job.get('fill', 'recursive'))
+    var = tiffs_to_stack(job['variables'])
+    out = np.empty_like(var)
+    route_topology(topology, var, out, dx, nodata)
+    array_to_tiff(out, os.path.join(scratch, 'upstreamavg.tif'), gt, proj, nodata)
+    return ['upstreamavg.tif']
+
+STAGE_FUNCTIONS = {'prepare': _prepare, 'merge': _merge, 'upstream': _upstream}
+
+def run_job(job, output_dir, cache_dir, threads=0, force=False):
+    """
+    Run the stages of a job that aren't checkpointed yet; returns (name, stages run, seconds). Every stage writes
+    into the job's scratch directory, and its outputs are moved into the job directory and checkpointed only once it
+    has finished.
+    """
+    from upstreamlib import set_threads
+
+    set_threads(threads)
+    start = time.perf_counter()
+    job_dir = os.path.join(output_dir, job['name'])
+    scratch = os.path.join(job_dir, 'scratch')
+    os.makedirs(job_dir, exist_ok=True)
+    key = job_key(job)
+    checkpoint = read_checkpoint(job_dir)
+    if force or checkpoint['key'] != key:
+        checkpoint = {'key': key, 'stages': {}}
+    ran = []
+    for stage in STAGES:
+        done = checkpoint['stages'].get(stage)
+        if done is not None and all(os.path.exists(os.path.join(job_dir, f)) for f in done['outputs']):
+            continue
+        # whatever a crashed run left behind is stale
+        shutil.rmtree(scratch, ignore_errors=True)
+        os.makedirs(scratch)
+        stage_start = time.perf_counter()
+        outputs = STAGE_FUNCTIONS[stage](job, job_dir, scratch, cache_dir)
+        for f in outputs:
+            os.replace(os.path.join(scratch, f), os.path.join(job_dir, f))
+        checkpoint['stages'][stage] = {'outputs': outputs, 'seconds': time.perf_counter() - stage_start}
+        # later stages read this stage's outputs, so they can't be trusted once it has run again
+        for later in STAGES[STAGES.index(stage) + 1:]:
+            checkpoint['stages'].pop(later, None)
+        write_checkpoint(job_dir, checkpoint)
+        ran.append(stage)
+    shutil.rmtree(scratch, ignore_errors=True)
+    return job['name'], ran, time.perf_counter() - start
+
+def run_batch(jobs, output_dir, cache_dir=None, workers=1, threads=0, force=False):
+    """
+    Run the jobs, up to workers at a time in separate processes, each routing with threads threads (0: the CPUs
+    shared out between the workers). Returns {name: error traceback} of the jobs that failed; the others are done.
+    """
+    cache_dir = cache_dir or os.path.join(output_dir, CACHE_DIR)
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    failed = {}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(run_job, job, output_dir, cache_dir, threads, force): job['name'] for job in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                _, ran, seconds = future.result()
+            except Exception:
+                failed[name] = traceback.format_exc()
+                print(f"{name}: failed\n{failed[name]}")
+                continue
+            print(f"{name}: {', '.join(ran) or 'nothing'} run in {seconds:.1f} s")
+    return failed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Prepare, merge and upstream-average many towns or tiles.')
+    parser.add_argument('manifest', help='JSON list of jobs (see the module docstring)')
+    parser.add_argument('-o', '--output', default='./data/batch', help='output directory (default: %(default)s)')
+    parser.add_argument('--cache', help='stage and topology caches (default: <output>/cache)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='concurrent jobs (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, default=0,
+                        help='routing threads per job (default: the CPUs shared out between the jobs)')
+    parser.add_argument('--force', action='store_true', help='ignore the checkpoints and run every stage again')
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest)
+    failed = run_batch(jobs, args.output, args.cache, args.workers, args.threads, args.force)
+    print(f"{len(jobs) - len(failed)} of {len(jobs)} jobs done" + (f", failed: {', '.join(failed)}" if failed else ''))
+    if failed:
+        exit(1)
@@ -0,0 +1,349 @@
+"""
+Benchmarks for the upstream averaging engine on seeded synthetic DEMs.
+
+Every case (grid size x terrain type) runs in its own subprocess so its peak RSS is its own. A case writes its
+synthetic DEM and variable to .flt files, reads them back, runs upstream_average and writes the result, timing I/O
+and each engine stage (see upstreamlib.STAGES) separately. Results are written as JSON together with the commit and
+machine they were measured on; passing an earlier result file as --baseline flags every time or memory figure that
+grew by more than the tolerance, and exits with status 1 if there is one.
+
+Terrain types:
+    slope   smooth multi-octave terrain on a regional tilt, few depressions
+    pits    slope with per-cell noise: many small pits and nested depressions to fill
+    flats   slope quantized into terraces: large flat areas to route across
+    holes   slope with NoData blobs covering about 7% of the grid
+    mixed   pits, flats and holes in different parts of the same DEM
+    basin   slope clipped to an irregular watershed outline, like a DEM cut to a catchment: about 70% NoData
+
+    python benchmark.py --sizes 200 1000 2000 5000 --terrains slope mixed -o results.json
+    python benchmark.py --baseline results.json --tolerance 0.2
+
+--check-backends instead routes pitted, flat and NoData DEMs with both fills on the C core and on the NumPy engine
+(filling cell by cell in the C core's order, see upstreamnumpy.exact_fill) and exits with status 1 unless the
+contributing areas and upstream sums and averages agree within CHECK_RTOL, and the catchment labels of
+CHECK_OUTLETS random outlets (some of them on NoData) are identical and 0 on NoData.
+
+    python benchmark.py --check-backends --sizes 200
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+TERRAINS = ('slope', 'pits', 'flats', 'holes', 'mixed', 'basin')
+DEFAULT_SIZES = (200, 1000, 2000)  # 5000 to 20000 are supported, but take minutes and several GB each
+DEFAULT_TERRAINS = TERRAINS
+DEFAULT_TOLERANCE = 0.2  # relative growth flagged as a regression
+CHECK_TERRAINS = ('pits', 'flats', 'holes', 'mixed')  # --check-backends cases: terrains the fills have work to do on
+CHECK_FILLS = ('recursive', 'priorityflood')
+CHECK_PRODUCTS = ('area', 'sum', 'avg')
+CHECK_RTOL = 1e-5  # relative difference of a routed result the backends may show
+CHECK_OUTLETS = 200
+MIN_SECONDS = 0.05  # absolute slack, so stages taking a few milliseconds don't flag on timer noise
+DX = 30.0
+NODATA = -9999.0
+CHUNK_ROWS = 1024  # rows generated at a time, so 20k x 20k DEMs are written without holding them in memory
+# (cell size, amplitude in m) of the value noise octaves making up the terrain
+OCTAVES = ((1024, 20.0), (256, 8.0), (64, 3.0), (16, 1.0), (4, 0.3))
+TILT = 0.1  # regional gradient in m per cell, so most of the DEM drains towards one corner
+TERRACE_STEP = 2.0  # m
+HOLE_THRESHOLD = 1.0  # NoData where the mask noise exceeds this (about 7% of the cells)
+BASIN_AXES = (0.5, 0.76)  # semi-axes of the basin outline as fractions of the half grid height and width
+BASIN_WOBBLE = 0.3  # mask noise added to the outline, so the basin edge is irregular
+
+def _value_noise(coarse, cell, i0, i1, nx):
+    """
+    Rows i0:i1 of a bilinear interpolation of the coarse random grid, one coarse node every cell cells.
+    """
+    y = np.arange(i0, i1) / cell
+    x = np.arange(nx) / cell
+    iy, ix = y.astype(np.intp), x.astype(np.intp)
+    fy, fx = (y - iy)[:, None], x - ix
+    top = coarse[iy][:, ix] * (1 - fx) + coarse[iy][:, ix + 1] * fx
+    bottom = coarse[iy + 1][:, ix] * (1 - fx) + coarse[iy + 1][:, ix + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def _octaves(rng, ny, nx, octaves):
+    return [(cell, amp, rng.standard_normal((ny // cell + 2, nx // cell + 2))) for cell, amp in octaves]
+
+def synthetic_rows(ny, nx, terrain='mixed', seed=0, nodata=NODATA):
+    """
+    Generate a synthetic DEM of the given terrain type (see TERRAINS) as float32 blocks of CHUNK_ROWS rows, yielding
+    (i0, rows). The DEM depends only on (ny, nx, terrain, seed).
+    """
+    if terrain not in TERRAINS:
+        raise ValueError(f'terrain must be one of {TERRAINS}, got {terrain!r}')
+    rng = np.random.default_rng([seed, ny, nx])
+    octaves = _octaves(rng, ny, nx, OCTAVES)
+    mask = _octaves(rng, ny, nx, [(max(min(ny, nx) // 8, 4), 1.0)])[0]
+    x = np.arange(nx)
+    for i0 in range(0, ny, CHUNK_ROWS):
+        i1 = min(i0 + CHUNK_ROWS, ny)
+        z = 100.0 + TILT * ((ny - np.arange(i0, i1))[:, None] + (nx - x))
+        for cell, amp, coarse in octaves:
+            z += amp * _value_noise(coarse, cell, i0, i1, nx)
+        region = _value_noise(mask[2], mask[0], i0, i1, nx)
+        if terrain == 'pits' or terrain == 'mixed':
+            noise = np.random.default_rng([seed, ny, nx, i0]).standard_normal(z.shape)
+            z += np.where(region < 0, 1.0, 0.0) * noise if terrain == 'mixed' else noise
+        if terrain == 'flats' or terrain == 'mixed':
+            terraces = np.floor(z / TERRACE_STEP) * TERRACE_STEP
+            z = np.where(region > 0, terraces, z) if terrain == 'mixed' else terraces
+        if terrain == 'holes' or terrain == 'mixed':
+            z[region > HOLE_THRESHOLD if terrain == 'holes' else np.abs(region) > HOLE_THRESHOLD] = nodata
+        if terrain == 'basin':
+            v = (np.arange(i0, i1)[:, None] - ny / 2) / (BASIN_AXES[0] * ny / 2)
+            u = (x - nx / 2) / (BASIN_AXES[1] * nx / 2)
+            z[np.hypot(v, u) + BASIN_WOBBLE * region > 1.0] = nodata
+        yield i0, z.astype(np.float32)
+
+def synthetic_dem(ny, nx, terrain='mixed', seed=0, nodata=NODATA):
+    """
+    The synthetic DEM of synthetic_rows() as one (ny, nx) float32 array.
+    """
+    dem = np.empty((ny, nx), dtype=np.float32)
+    for i0, rows in synthetic_rows(ny, nx, terrain, seed, nodata):
+        dem[i0:i0 + rows.shape[0]] = rows
+    return dem
+
+def write_synthetic(path, ny, nx, terrain='mixed', seed=0, nodata=NODATA):
+    """
+    Write the synthetic DEM to a raw float32 .flt file, one block of rows at a time.
+    """
+    with open(path, 'wb') as f:
+        for _, rows in synthetic_rows(ny, nx, terrain, seed, nodata):
+            rows.tofile(f)
+    return path
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MiB (ru_maxrss is in KiB on Linux, bytes on macOS).
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+def run_case(size, terrain, seed=0, fill='priorityflood', threads=0, tiff=False, repeat=1, tmp_dir=None):
+    """
+    Time one case in this process: .flt read, every engine stage and the output write, in seconds. Engine stages
+    are the fastest of repeat runs.
+    """
+    from upstreamlib import STAGES, set_threads, stage_times, upstream_average, native_available
+
+    result = {'size': size, 'terrain': terrain, 'seed': seed, 'fill': fill,
+              'backend': 'native' if native_available() else 'numpy', 'threads': set_threads(threads)}
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        dem_file, var_file = os.path.join(tmp, 'dem.flt'), os.path.join(tmp, 'var.flt')
+        t = time.perf_counter()
+        write_synthetic(dem_file, size, size, terrain, seed)
+        write_synthetic(var_file, size, size, 'slope', seed + 1)
+        result['generate'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        dem = np.fromfile(dem_file, dtype=np.float32).reshape(size, size)
+        var = np.fromfile(var_file, dtype=np.float32).reshape(size, size)
+        times = {'read': time.perf_counter() - t}
+        result['nodata_fraction'] = float(np.mean(dem == NODATA))
+
+        out = np.empty_like(var)
+        for _ in range(repeat):
+            t = time.perf_counter()
+            upstream_average(dem, var, out, DX, NODATA, fill=fill)
+            engine = time.perf_counter() - t
+            stages = stage_times()
+            if 'engine' not in times or engine < times['engine']:
+                times.update(stages, engine=engine)
+        del dem, var
+
+        t = time.perf_counter()
+        if tiff:
+            from upstreamtiff import write_array
+            write_array(out, os.path.join(tmp, 'out.tif'), (0, DX, 0, 0, 0, -DX), '', NODATA)
+        else:
+            out.tofile(os.path.join(tmp, 'out.flt'))
+        times['write'] = time.perf_counter() - t
+
+    result['times'] = {k: times[k] for k in ('read',) + STAGES + ('engine', 'write')}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def case_key(result):
+    return f"{result['size']}/{result['terrain']}"
+
+def run_cases(sizes, terrains, seed=0, fill='priorityflood', threads=0, tiff=False, repeat=1, backend=None,
+              tmp_dir=None):
+    """
+    Run every (size, terrain) case in a fresh interpreter and return the list of results.
+    """
+    env = dict(os.environ)
+    if backend is not None:
+        env['UPSTREAM_BACKEND'] = backend
+    if env.get('UPSTREAM_BACKEND', 'auto') != 'numpy':
+        # build the C core here so compiling it isn't timed as part of the first case
+        subprocess.run([sys.executable, '-c', 'import upstreamlib; upstreamlib.native_available()'], cwd=SRC_DIR,
+                       env=env, check=True)
+    results = []
+    for size in sizes:
+        for terrain in terrains:
+            cmd = [sys.executable, os.path.abspath(__file__), '--run-case', str(size), terrain, '--seed', str(seed),
+                   '--fill', fill, '--threads', str(threads), '--repeat', str(repeat)]
+            cmd += ['--tiff'] if tiff else []
+            cmd += ['--tmp-dir', tmp_dir] if tmp_dir else []
+            proc = subprocess.run(cmd, cwd=SRC_DIR, env=env, stdout=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                results.append({'size': size, 'terrain': terrain, 'error': f'exit status {proc.returncode}'})
+            else:
+                results.append(json.loads(proc.stdout))
+            print_result(results[-1], file=sys.stderr)
+    return results
+
+def machine_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': platform.node(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+def print_result(result, file=sys.stdout):
+    if 'error' in result:
+        print(f"{case_key(result):>16}  FAILED ({result['error']})", file=file)
+        return
+    times = '  '.join(f'{k} {v:7.3f}' for k, v in result['times'].items())
+    print(f"{case_key(result):>16}  {times}  peak {result['peak_rss_mb']:8.1f} MiB", file=file)
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, min_seconds=MIN_SECONDS):
+    """
+    Regressions of results against baseline (both lists of case results), as (case, metric, baseline, current)
+    tuples: times that grew by more than tolerance and min_seconds, and peak RSS that grew by more than tolerance.
+    Cases missing from either side or that failed in the baseline are skipped; cases that fail now are regressions.
+    """
+    base = {case_key(r): r for r in baseline if 'error' not in r}
+    regressions = []
+    for r in results:
+        b = base.get(case_key(r))
+        if b is None:
+            continue
+        if 'error' in r:
+            regressions.append((case_key(r), 'error', None, r['error']))
+            continue
+        for metric, t in r['times'].items():
+            t0 = b['times'].get(metric)
+            if t0 is not None and t > t0 * (1 + tolerance) and t - t0 > min_seconds:
+                regressions.append((case_key(r), metric, t0, t))
+        if r['peak_rss_mb'] > b['peak_rss_mb'] * (1 + tolerance):
+            regressions.append((case_key(r), 'peak_rss_mb', b['peak_rss_mb'], r['peak_rss_mb']))
+    return regressions
+
+def check_backends(size, terrains=CHECK_TERRAINS, fills=CHECK_FILLS, seed=0, rtol=CHECK_RTOL):
+    """
+    Run upstream_products on the C core and on the NumPy engine, with the NumPy fills replaying the C core's visiting
+    order, for every terrain and fill on a size x size DEM, and return the differences beyond rtol as (case,
+    product, number of cells that differ) tuples. The catchment labels of random outlets on the filled DEM's
+    topology are checked the same way (product 'labels'), and must be 0 on NoData ('nodata labels'). Raises if the
+    C core can't be loaded.
+    """
+    import upstreamlib
+    import upstreamnumpy
+
+    previous = upstreamlib.BACKEND, upstreamnumpy.exact_fill
+    differences = []
+    for terrain in terrains:
+        dem = synthetic_dem(size, size, terrain, seed)
+        var = synthetic_dem(size, size, 'slope', seed + 1)
+        for fill in fills:
+            products = {}
+            try:
+                upstreamnumpy.exact_fill = True
+                for backend in ('native', 'numpy'):
+                    upstreamlib.BACKEND = backend
+                    products[backend] = upstreamlib.upstream_products(dem, var, DX, NODATA, CHECK_PRODUCTS,
+                                                                      fill=fill)
+            finally:
+                upstreamlib.BACKEND, upstreamnumpy.exact_fill = previous
+            for name in CHECK_PRODUCTS:
+                differ = ~np.isclose(products['numpy'][name], products['native'][name], rtol=rtol, atol=0)
+                if np.any(differ):
+                    differences.append((f'{size}/{terrain}/{fill}', name, int(np.count_nonzero(differ))))
+        topology = upstreamlib.flow_topology(dem, NODATA)
+        outlets = np.random.default_rng([seed, size]).integers(0, dem.size, CHECK_OUTLETS)
+        outlets = np.concatenate((outlets, np.flatnonzero(dem == NODATA)[::97][:CHECK_OUTLETS // 10]))
+        labels = {}
+        try:
+            for backend in ('native', 'numpy'):
+                upstreamlib.BACKEND = backend
+                labels[backend] = upstreamlib.catchment_labels(topology, outlets)
+        finally:
+            upstreamlib.BACKEND = previous[0]
+        differ = labels['numpy'] != labels['native']
+        if np.any(differ):
+            differences.append((f'{size}/{terrain}', 'labels', int(np.count_nonzero(differ))))
+        for backend, label in labels.items():
+            if np.any(label[dem == NODATA]):
+                differences.append((f'{size}/{terrain}/{backend}', 'nodata labels',
+                                    int(np.count_nonzero(label[dem == NODATA]))))
+    return differences
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark upstream averaging on synthetic DEMs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='grid sizes N of the N x N DEMs (default: %(default)s)')
+    parser.add_argument('--terrains', nargs='+', choices=TERRAINS, default=DEFAULT_TERRAINS,
+                        help='terrain types (default: all)')
+    parser.add_argument('--seed', type=int, default=0, help='terrain seed (default: %(default)s)')
+    parser.add_argument('--fill', default='priorityflood', choices=['none', 'recursive', 'priorityflood'],
+                        help='hydrocorrection (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='threads, 0 = all cores (default: %(default)s)')
+    parser.add_argument('--backend', choices=['auto', 'native', 'numpy'], help='engine backend (default: auto)')
+    parser.add_argument('--repeat', type=int, default=1, help='engine runs per case, fastest kept (default: 1)')
+    parser.add_argument('--tiff', action='store_true', help='time writing a compressed GeoTIFF instead of a .flt')
+    parser.add_argument('--tmp-dir', help='directory for the synthetic inputs and outputs (default: system temp)')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative growth of a time or peak RSS flagged as a regression (default: %(default)s)')
+    parser.add_argument('--check-backends', action='store_true',
+                        help='check that the C core and the NumPy engine give identical results instead of timing')
+    parser.add_argument('--run-case', nargs=2, metavar=('SIZE', 'TERRAIN'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        result = run_case(int(args.run_case[0]), args.run_case[1], args.seed, args.fill, args.threads, args.tiff,
+                          args.repeat, args.tmp_dir)
+        json.dump(result, sys.stdout)
+        sys.exit(0)
+
+    if args.check_backends:
+        terrains = args.terrains if args.terrains != DEFAULT_TERRAINS else CHECK_TERRAINS
+        differences = [d for size in args.sizes for d in check_backends(size, terrains, seed=args.seed)]
+        for case, product, cells in differences:
+            print(f"MISMATCH {case} {product}: {cells} cells differ")
+        if differences:
+            sys.exit(1)
+        print("C core and NumPy engine agree")
+        sys.exit(0)
+
+    results = run_cases(args.sizes, args.terrains, args.seed, args.fill, args.threads, args.tiff, args.repeat,
+                        args.backend, args.tmp_dir)
+    report = {'machine': machine_info(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for case, metric, before, now in regressions:
+            print(f"REGRESSION {case} {metric}: {before} -> {now}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%}")
@@ -0,0 +1,217 @@
+"""
+Snapping points onto a road network and sampling a DEM at them, for millions of points at once.
+
+EdgeIndex breaks the roads into straight edges and keeps a KD-tree (scipy cKDTree) of the edge midpoints. The nearest
+edge of a point is found among the edges with the nearest midpoints, asking for more neighbours only for the points
+where a farther midpoint could still belong to a nearer edge, and the points are projected onto their edges with
+array arithmetic. This replaces arcpy.edit.Snap with an EDGE tolerance.
+
+sample_points replaces ExtractValuesToPoints: it reads the DEM at all points with one gather, by nearest cell or
+bilinear interpolation between the four nearest cell centers. The DEM can be any array indexed by (rows, cols): an
+in-memory array, a numpy.memmap of an .flt grid, or a BlockRaster, which reads a GDAL raster block by block and keeps
+the most recently used blocks, so only the blocks holding points are ever decoded.
+"""
+import argparse
+from collections import OrderedDict
+import numpy as np
+from upstreamlib import DEFAULT_NODATA
+
+SAMPLE_METHODS = ('nearest', 'bilinear')
+NEIGHBOURS = 8  # edge midpoints examined per point at first; doubled for the points that need more
+DEFAULT_BLOCK_CACHE = 256 * 1024**2  # bytes of decoded blocks a BlockRaster keeps
+
+class BlockRaster:
+    """
+    A band of a GDAL raster indexed like a (Ny, Nx) array with raster[rows, cols], reading only the blocks those cells
+    fall in and keeping up to cache_bytes of decoded blocks, least recently used evicted first.
+    """
+    def __init__(self, path, band=1, cache_bytes=DEFAULT_BLOCK_CACHE):
+        from osgeo import gdal
+
+        self.dataset = gdal.Open(path)
+        if self.dataset is None:
+            raise FileNotFoundError(f"Could not open raster file: {path}")
+        self.band = self.dataset.GetRasterBand(band)
+        self.shape = (self.dataset.RasterYSize, self.dataset.RasterXSize)
+        self.gt = self.dataset.GetGeoTransform()
+        self.nodata = self.band.GetNoDataValue()
+        bx, by = self.band.GetBlockSize()
+        self.block = (by, bx)
+        self.cache_bytes = cache_bytes
+        self._blocks = OrderedDict()
+        self._bytes = 0
+
+    def _read_block(self, bi, bj):
+        key = (bi, bj)
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+        (by, bx), (Ny, Nx) = self.block, self.shape
+        block = self.band.ReadAsArray(bj * bx, bi * by, min(bx, Nx - bj * bx), min(by, Ny - bi * by))
+        self._blocks[key] = block
+        self._bytes += block.nbytes
+        while self._bytes > self.cache_bytes and len(self._blocks) > 1:
+            self._bytes -= self._blocks.popitem(last=False)[1].nbytes
+        return block
+
+    def __getitem__(self, cells):
+        rows, cols = (np.asarray(c, dtype=np.intp) for c in cells)
+        by, bx = self.block
+        bi, bj = rows // by, cols // bx
+        blocks = bi * (-(-self.shape[1] // bx)) + bj
+        order = np.argsort(blocks, kind='stable')
+        _, starts = np.unique(blocks[order], return_index=True)
+        out = np.empty(rows.shape, dtype=np.float64)
+        for sel in np.split(order, starts[1:]):
+            if sel.size:
+                i, j = bi[sel[0]], bj[sel[0]]
+                out[sel] = self._read_block(i, j)[rows[sel] - i * by, cols[sel] - j * bx]
+        return out
+
+def sample_points(raster, gt, x, y, method='nearest', nodata=DEFAULT_NODATA):
+    """
+    Values of the raster (indexed by raster[rows, cols], see BlockRaster) at the points (x, y) in the CRS of the GDAL
+    geotransform gt, as float64 with NaN off the grid and at nodata. 'nearest' takes the cell containing each point,
+    'bilinear' interpolates between the four nearest cell centers, leaving out nodata cells and clamping at the
+    edges of the grid.
+    """
+    if method not in SAMPLE_METHODS:
+        raise ValueError(f"method must be one of {SAMPLE_METHODS}, got '{method}'")
+    Ny, Nx = raster.shape
+    u = (np.asarray(x, dtype=np.float64) - gt[0]) / gt[1]
+    v = (np.asarray(y, dtype=np.float64) - gt[3]) / gt[5]
+    inside = np.flatnonzero((u >= 0) & (u < Nx) & (v >= 0) & (v < Ny))
+    values = np.full(u.shape, np.nan)
+    if method == 'nearest':
+        found = np.asarray(raster[v[inside].astype(np.intp), u[inside].astype(np.intp)], dtype=np.float64)
+        values[inside] = np.where(found == nodata, np.nan, found)
+        return values
+    u, v = u[inside] - 0.5, v[inside] - 0.5
+    c0, r0 = np.floor(u), np.floor(v)
+    fx, fy = u - c0, v - r0
+    rows = np.clip(np.stack([r0, r0, r0 + 1, r0 + 1]), 0, Ny - 1).astype(np.intp)
+    cols = np.clip(np.stack([c0, c0 + 1, c0, c0 + 1]), 0, Nx - 1).astype(np.intp)
+    weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx])
+    corners = np.asarray(raster[rows.reshape(-1), cols.reshape(-1)], dtype=np.float64).reshape(rows.shape)
+    weights[(corners == nodata) | np.isnan(corners)] = 0.0
+    total = weights.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values[inside] = np.where(total > 0, (weights * np.nan_to_num(corners)).sum(axis=0) / total, np.nan)
+    return values
+
+class EdgeIndex:
+    """
+    KD-tree over the straight edges of polylines, given as their vertices xy (an (n, 2) array, in order), the part
+    each vertex belongs to (consecutive vertices of the same part form an edge) and the line of each vertex, which
+    snap reports.
+    """
+    def __init__(self, xy, part, line):
+        from scipy.spatial import cKDTree
+
+        xy = np.asarray(xy, dtype=np.float64)
+        start = np.flatnonzero(part[1:] == part[:-1])
+        self.a, self.b = xy[start], xy[start + 1]
+        self.line = np.asarray(line)[start]
+        self.length = np.hypot(*(self.b - self.a).T)
+        # position of every edge's start along its line's part
+        offset = np.cumsum(self.length) - self.length
+        first = np.ones(start.size, dtype=bool)
+        first[1:] = part[start[1:]] != part[start[:-1]]
+        self.along = offset - offset[np.maximum.accumulate(np.where(first, np.arange(start.size), 0))]
+        self.half = self.length.max() / 2 if start.size else 0.0
+        self.tree = cKDTree((self.a + self.b) / 2)
+
+    @classmethod
+    def from_lines(cls, lines, max_edge=None):
+        """
+        Index of the lines (an array of shapely geometries), their edges first split to at most max_edge long: long
+        edges make the search examine more candidates.
+        """
+        import shapely
+
+        parts, line = shapely.get_parts(lines, return_index=True)
+        if max_edge:
+            parts = shapely.segmentize(parts, max_edge)
+        xy, part = shapely.get_coordinates(parts, return_index=True)
+        return cls(xy, part, line[part])
+
+    def _project(self, p, edges):
+        a, ab = self.a[edges], self.b[edges] - self.a[edges]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip(np.nan_to_num(((p[:, None] - a) * ab).sum(axis=-1) / (ab * ab).sum(axis=-1)), 0.0, 1.0)
+        q = a + t[..., None] * ab
+        return q, t, np.hypot(*np.moveaxis(p[:, None] - q, -1, 0))
+
+    def snap(self, x, y, max_distance=np.inf, neighbours=NEIGHBOURS):
+        """
+        The points (x, y) projected onto their nearest edge within max_distance, as a dict of arrays: the snapped 'x'
+        and 'y' (unchanged for points without an edge in reach), the 'line' of the edge (-1 for none), the 'distance'
+        moved and the position 'along' the line's part.
+        """
+        p = np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)])
+        nedges = self.a.shape[0]
+        best = np.full(p.shape[0], -1, dtype=np.intp)
+        best_d = np.full(p.shape[0], np.inf)
+        best_q, best_t = p.copy(), np.zeros(p.shape[0])
+        todo = np.arange(p.shape[0])
+        k = min(neighbours, nedges)
+        while todo.size and nedges:
+            # an edge within max_distance has its midpoint within max_distance + half the longest edge
+            dist, idx = self.tree.query(p[todo], k=k, distance_upper_bound=max_distance + self.half)
+            dist, idx = dist.reshape(todo.size, k), idx.reshape(todo.size, k)
+            found = idx < nedges
+            q, t, d = self._project(p[todo], np.where(found, idx, 0))
+            d[~found] = np.inf
+            j = np.argmin(d, axis=1)
+            pick = np.arange(todo.size)
+            better = d[pick, j] < best_d[todo]
+            update = todo[better]
+            best[update] = idx[pick, j][better]
+            best_d[update] = d[pick, j][better]
+            best_q[update] = q[pick, j][better]
+            best_t[update] = t[pick, j][better]
+            if k == nedges:
+                break
+            # a farther midpoint can only belong to a nearer edge if it is within best distance + half an edge
+            todo = todo[found[:, -1] & (dist[:, -1] <= best_d[todo] + self.half)]
+            k = min(2 * k, nedges)
+        snapped = best_d <= max_distance
+        best[~snapped] = -1
+        q = np.where(snapped[:, None], best_q, p)
+        edge = best[snapped]
+        line = np.full(p.shape[0], -1, dtype=np.intp)
+        line[snapped] = self.line[edge]
+        along = np.full(p.shape[0], np.nan)
+        along[snapped] = self.along[edge] + best_t[snapped] * self.length[edge]
+        return {'x': q[:, 0], 'y': q[:, 1], 'line': line, 'distance': np.where(snapped, best_d, 0.0),
+                'along': along}
+
+if __name__ == "__main__":
+
+    from upstreamquery import read_points, write_results
+
+    parser = argparse.ArgumentParser(description='Snap points to roads and sample a DEM at them.')
+    parser.add_argument('dem', help='DEM raster (any GDAL format)')
+    parser.add_argument('points', help='CSV file of points in the DEM CRS')
+    parser.add_argument('-o', '--output', required=True, help='output CSV: the points with the results appended')
+    parser.add_argument('--xy', nargs=2, default=('x', 'y'), metavar=('X', 'Y'),
+                        help='coordinate columns of the points (default: x y)')
+    parser.add_argument('--method', default='nearest', choices=SAMPLE_METHODS, help='default: %(default)s')
+    parser.add_argument('--roads', help='roads to snap the points to first (any OGR source, in the DEM CRS)')
+    parser.add_argument('--roads-layer', help='layer of the roads source')
+    parser.add_argument('--snap', type=float, default=50.0, help='snap distance (default: %(default)s)')
+    args = parser.parse_args()
+
+    records, x, y = read_points(args.points, *args.xy)
+    result = {}
+    if args.roads:
+        import geopandas as gpd
+
+        roads = gpd.read_file(args.roads, layer=args.roads_layer)
+        result = EdgeIndex.from_lines(np.asarray(roads.geometry.values), args.snap).snap(x, y, args.snap)
+        x, y = result['x'], result['y']
+    dem = BlockRaster(args.dem)
+    nodata = DEFAULT_NODATA if dem.nodata is None else dem.nodata
+    result['elevation'] = sample_points(dem, dem.gt, x, y, args.method, nodata)
+    write_results(args.output, records, result)
+    print(f"{len(records)} points written to {args.output}")
@@ -0,0 +1,183 @@
+/*
+ priority-flood depression filling (Barnes et al., 2014, "Priority-Flood: An optimal depression-filling and
+ watershed-labeling algorithm", Algorithm 3 with the epsilon modification)
+
+ cells are flooded inward from the grid border and from cells next to NoData, always expanding from the lowest cell
+ reached so far. a cell that is not higher than the cell it was reached from is in a pit or flat; it is raised to
+ epsilon above that cell and queued in a plain FIFO, so depressions are filled in O(1) per cell and only the
+ remaining cells pay the O(log n) heap cost. nothing recurses and memory is at most a few bytes per cell.
+
+ cells of equal elevation leave the heap lowest flat index first, so the visit order (and with it the heights given
+ to filled cells) doesn't depend on how the heap happens to be laid out; upstreamnumpy.py repeats it with heapq.
+
+ NoData cells are never queued or marked closed, so the pages of the closed mask that only cover NoData are never
+ touched (calloc leaves them unmapped) and a mostly NoData DEM only pays for its valid cells beyond the seeding scan.
+*/
+
+#include<math.h>
+#include<stdio.h>
+#include<stdlib.h>
+#include<string.h>
+#include"utilities.h"
+#include"priorityflood.h"
+
+typedef struct {
+    float z;
+    long k;
+} heapnode;
+
+// heap order: by elevation, then by flat index
+#define BEFORE(a,b) (((a).z<(b).z)||(((a).z==(b).z)&&((a).k<(b).k)))
+
+static heapnode *heap;
+static long nheap,heapcap,*pit,pithead,pittail,pitcap;
+static long heappeak,queuepeak;  // high-water marks of the last fill
+
+static void heappush(float z, long k)
+{
+    long c,p;
+    heapnode tmp;
+
+    if (nheap==heapcap)
+    {
+        heapcap*=2;
+        heap=(heapnode *)realloc(heap,heapcap*sizeof(heapnode));
+        if (!heap) nrerror("allocation failure in heappush()");
+    }
+    c=nheap++;
+    if (nheap>heappeak) heappeak=nheap;
+    heap[c].z=z;
+    heap[c].k=k;
+    while (c>0)
+    {
+        p=(c-1)/2;
+        if (!BEFORE(heap[c],heap[p])) break;
+        tmp=heap[p];heap[p]=heap[c];heap[c]=tmp;
+        c=p;
+    }
+}
+
+static long heappop()
+{
+    long c,l,k;
+    heapnode tmp;
+
+    k=heap[0].k;
+    heap[0]=heap[--nheap];
+    c=0;
+    for (;;)
+    {
+        l=2*c+1;
+        if (l>=nheap) break;
+        if ((l+1<nheap)&&BEFORE(heap[l+1],heap[l])) l++;
+        if (!BEFORE(heap[l],heap[c])) break;
+        tmp=heap[c];heap[c]=heap[l];heap[l]=tmp;
+        c=l;
+    }
+    return k;
+}
+
+static void pitpush(long k)
+{
+    if (pittail==pitcap)
+    {
+        if (pithead>=pitcap/2)
+        {
+            // at least half the queue has already been consumed; slide the live entries down instead of growing
+            memmove(pit,pit+pithead,(pittail-pithead)*sizeof(long));
+            pittail-=pithead;
+            pithead=0;
+        }
+        else
+        {
+            pitcap*=2;
+            pit=(long *)realloc(pit,pitcap*sizeof(long));
+            if (!pit) nrerror("allocation failure in pitpush()");
+        }
+    }
+    pit[pittail++]=k;
+    if (pittail-pithead>queuepeak) queuepeak=pittail-pithead;
+}
+
+long priorityflood(float *z, long nx, long ny, float nanval, float epsilon)
+/* fill depressions in the row-major ny*nx DEM z in place so that every valid interior cell has a strictly downhill
+   path to the border or to a NoData cell. raised cells are set epsilon above the cell they drain to, or one float
+   ulp above it if epsilon is 0 (or too small to change the elevation). returns the number of raised cells */
+{
+    long i,j,k,n,ni,nj,d,raised;
+    int seed;
+    float zn;
+    unsigned char *closed;
+    static const int di[8]={1,1,1,0,-1,-1,-1,0};
+    static const int dj[8]={-1,0,1,1,1,0,-1,-1};
+
+    closed=(unsigned char *)calloc(nx*ny,sizeof(unsigned char));
+    heapcap=2*(nx+ny)+8;
+    heap=(heapnode *)malloc(heapcap*sizeof(heapnode));
+    pitcap=1024;
+    pit=(long *)malloc(pitcap*sizeof(long));
+    if (!closed || !heap || !pit) nrerror("allocation failure in priorityflood()");
+    nheap=0;
+    pithead=pittail=0;
+    heappeak=queuepeak=0;
+    raised=0;
+
+    // Seed the flood with every valid cell on the border or next to NoData; these are never raised
+    for (i=0;i<ny;i++)
+        for (j=0;j<nx;j++)
+        {
+            k=i*nx+j;
+            if (z[k]==nanval) continue;
+            seed=(i==0)||(j==0)||(i==ny-1)||(j==nx-1);
+            for (d=0;(d<8)&&!seed;d++)
+                if (z[(i+di[d])*nx+j+dj[d]]==nanval) seed=1;
+            if (seed)
+            {
+                closed[k]=1;
+                heappush(z[k],k);
+            }
+        }
+
+    // Flood inward from the lowest open cell, draining the pit queue first
+    while ((nheap>0)||(pithead<pittail))
+    {
+        if (pithead<pittail)
+            k=pit[pithead++];
+        else
+            k=heappop();
+        i=k/nx;
+        j=k%nx;
+        zn=z[k]+epsilon;
+        if (zn<=z[k]) zn=nextafterf(z[k],INFINITY);
+        for (d=0;d<8;d++)
+        {
+            ni=i+di[d];
+            nj=j+dj[d];
+            if ((ni<0)||(nj<0)||(ni>=ny)||(nj>=nx)) continue;
+            n=ni*nx+nj;
+            if (closed[n]||(z[n]==nanval)) continue;
+            closed[n]=1;
+            if (z[n]<=z[k])
+            {
+                // The node's in a pit or on a flat; raise it just above the cell it drains to
+                z[n]=zn;
+                raised++;
+                pitpush(n);
+            }
+            else
+                heappush(z[n],n);
+        }
+    }
+
+    free(closed);
+    free(heap);
+    free(pit);
+    return raised;
+}
+
+void priorityfloodpeaks(long *maxheap, long *maxqueue)
+/* largest number of cells the heap and the pit queue held at once during the last priorityflood() */
+{
+    *maxheap=heappeak;
+    *maxqueue=queuepeak;
+}
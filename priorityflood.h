@@ -0,0 +1,7 @@
+#ifndef PRIORITYFLOOD_H
+#define PRIORITYFLOOD_H
+
+long priorityflood(float *z, long nx, long ny, float nanval, float epsilon);
+void priorityfloodpeaks(long *maxheap, long *maxqueue);
+
+#endif /* PRIORITYFLOOD_H*/
@@ -0,0 +1,299 @@
+"""
+In-memory replacement for the culvert loop of merge_roads.py, without arcpy.
+
+Roads and culverts are read once and the roads put into a shapely STRtree, so the roads touching every culvert are
+found in a single bulk query instead of a SelectLayerByLocation/CopyFeatures round trip through the geodatabase per
+culvert. The elevation of every road segment is taken from its high point (MaxEl), else its intersection (Inter_El),
+else its culvert end (Culv_El_Max), exactly as merge_roads.py does, and the segments higher than the culvert (compared
+at centimeter precision) are kept. The result is written once: one polyline per culvert and higher road, tagged with
+the culvert and road it came from, or with dissolve one merged polyline per culvert.
+
+With several workers, the culverts are cut into spatially coherent chunks along a Z-order curve and processed in a
+process pool. Every worker holds the same read-only road index, inherited on fork, and the (culvert, road) pairs are
+merged back in culvert order, so the output doesn't depend on the number of workers or the chunking.
+
+Roads prepared by roadprep are split at every culvert, so a culvert sits on the end of each segment it touches.
+RoadGraph builds that network once as a CSR adjacency of segment end nodes and finds the segments of all culverts by
+node lookup instead of a spatial query. Every culvert segment is classified by its far end (high point,
+intersection or another culvert, from the field that holds its elevation), and the elevation comparison runs over all
+culvert-segment incidences at once.
+"""
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+CULVERT_ELEVATION_FIELD = 'elevation'
+ROAD_HP_ELEVATION_FIELD = 'MaxEl'
+ROAD_CULVERT_ELEVATION_FIELD = 'Culv_El_Max'
+ROAD_INTERSECTION_ELEVATION_FIELD = 'Inter_El'
+TOLERANCE = 0.001  # culvert to road distance (CRS units) counted as intersecting, the ArcGIS default XY tolerance
+DECIMALS = 2  # elevations are compared rounded to centimeters
+CHUNK_SIZE = 4096  # culverts per parallel work item
+MORTON_BITS = 16  # grid resolution per axis of the Z-order curve that chunks the culverts
+
+END_KINDS = ('culvert', 'intersection', 'high point')  # far end of a culvert's segment, see segment_ends
+NODE_OFFSETS = [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+_shared = None  # (road index, culverts, road elevations, culvert elevations, tolerance) of the pool workers
+
+def _float_column(column):
+    """
+    A table column as float64 with missing values (None, NULL) as NaN.
+    """
+    return column.to_numpy(dtype=np.float64, na_value=np.nan)
+
+def road_elevations(hp, culvert, intersection):
+    """
+    Elevation of every road segment: its high point, or where it has none its intersection, or where it has neither
+    its culvert end. Missing values are NaN.
+    """
+    hp, culvert, intersection = (np.asarray(a, dtype=np.float64) for a in (hp, culvert, intersection))
+    return np.where(np.isnan(hp), np.where(np.isnan(intersection), culvert, intersection), hp)
+
+def segment_ends(hp, intersection):
+    """
+    Index into END_KINDS of the far end of every road segment from its culvert: a high point where it has a high
+    point elevation, else an intersection where it has an intersection elevation, else a culvert (see
+    road_elevations).
+    """
+    hp, intersection = np.asarray(hp, dtype=np.float64), np.asarray(intersection, dtype=np.float64)
+    return np.where(~np.isnan(hp), 2, np.where(~np.isnan(intersection), 1, 0)).astype(np.int8)
+
+def higher_roads(pairs, road_elevation, culvert_elevation, decimals=DECIMALS):
+    """
+    The (culvert, road) index pairs, a (2, n) array, whose road is higher than the culvert once both are rounded to
+    decimals. Pairs with a missing elevation are dropped.
+    """
+    c, r = pairs
+    return pairs[:, np.round(road_elevation[r], decimals) > np.round(culvert_elevation[c], decimals)]
+
+def _spread_bits(v):
+    """
+    The low 16 bits of v moved to the even bit positions.
+    """
+    v = v.astype(np.uint32)
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    return (v | (v << 1)) & 0x55555555
+
+def spatial_chunks(xy, chunk_size=CHUNK_SIZE):
+    """
+    Row positions of the points xy, an (n, 2) array, cut into chunks of at most chunk_size nearby points: consecutive
+    runs along a Z-order (Morton) curve over the bounding box. The positions within a chunk are sorted.
+    """
+    xy = np.nan_to_num(np.asarray(xy, dtype=np.float64))
+    if xy.shape[0] == 0:
+        return []
+    lo = xy.min(axis=0)
+    span = np.maximum(xy.max(axis=0) - lo, np.finfo(np.float64).tiny)
+    q = ((xy - lo) / span * ((1 << MORTON_BITS) - 1)).astype(np.uint32)
+    order = np.argsort(_spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << 1), kind='stable')
+    return [np.sort(order[i:i + chunk_size]) for i in range(0, order.size, chunk_size)]
+
+def _query(tree, culverts, tolerance):
+    if tolerance > 0:
+        return tree.query(culverts, predicate='dwithin', distance=tolerance)
+    return tree.query(culverts, predicate='intersects')
+
+def culvert_roads(culverts, roads, tolerance=TOLERANCE):
+    """
+    (culvert, road) index pairs, a (2, n) array sorted by culvert then road, of the road geometries within tolerance
+    of each culvert geometry.
+    """
+    from shapely import STRtree
+
+    pairs = _query(STRtree(roads), culverts, tolerance)
+    return pairs[:, np.lexsort((pairs[1], pairs[0]))]
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def _higher_chunk(chunk):
+    tree, culverts, road_elevation, culvert_elevation, tolerance = _shared
+    pairs = _query(tree, culverts[chunk], tolerance)
+    pairs[0] = chunk[pairs[0]]
+    return higher_roads(pairs, road_elevation, culvert_elevation)
+
+def find_higher_roads(culverts, roads, road_elevation, culvert_elevation, tolerance=TOLERANCE, workers=1,
+                      chunk_size=CHUNK_SIZE):
+    """
+    (culvert, road) index pairs, sorted by culvert then road, of the roads within tolerance of each culvert and
+    higher than it (see higher_roads). workers > 1 processes spatial chunks of the culverts in that many processes (0:
+    one per CPU); the result is the same.
+    """
+    import shapely
+
+    workers = workers or os.cpu_count()
+    shared = (shapely.STRtree(roads), culverts, road_elevation, culvert_elevation, tolerance)
+    if workers == 1 or len(culverts) <= chunk_size:
+        _init_worker(shared)
+        try:
+            pairs = _higher_chunk(np.arange(len(culverts)))
+        finally:
+            _init_worker(None)
+    else:
+        # at least a few chunks per worker, so a dense chunk doesn't hold up the rest
+        chunk_size = max(1, min(chunk_size, -(-len(culverts) // (4 * workers))))
+        chunks = spatial_chunks(shapely.get_coordinates(shapely.centroid(culverts)), chunk_size)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(shared,)) as pool:
+            pairs = np.concatenate(list(pool.map(_higher_chunk, chunks)), axis=1)
+    return pairs[:, np.lexsort((pairs[1], pairs[0]))]
+
+class RoadGraph:
+    """
+    The split road segments (an array of line geometries) as a graph between their end nodes, in CSR form: the
+    segments ending at node n are indices[indptr[n]:indptr[n + 1]], and ends[s] are the two nodes of segment s.
+    Segment ends are the same node when they round to the same point of a grid of spacing tolerance. The segment
+    elevations are kept as arrays: 'elevation' holds, for each of END_KINDS, the culvert end (Culv_El_Max),
+    intersection (Inter_El) and high point (MaxEl) elevation of every segment.
+    """
+    def __init__(self, segments, hp, culvert_end, intersection, tolerance=TOLERANCE):
+        import shapely
+
+        xy, index = shapely.get_coordinates(segments, return_index=True)
+        nseg = len(segments)
+        first = np.searchsorted(index, np.arange(nseg))
+        last = np.searchsorted(index, np.arange(nseg), side='right') - 1
+        valid = np.flatnonzero(first <= last)  # empty geometries have no ends
+        ends = np.round(np.concatenate((xy[first[valid]], xy[last[valid]])) / tolerance).astype(np.int64)
+        self.tolerance = tolerance
+        # grid points numbered row by row over the bounding box of the ends
+        self.origin = ends.min(axis=0) if ends.size else np.zeros(2, dtype=np.int64)
+        self.size = ends.max(axis=0) - self.origin + 1 if ends.size else np.ones(2, dtype=np.int64)
+        if self.size[0] > np.iinfo(np.int64).max // self.size[1]:
+            raise ValueError(f'tolerance {tolerance} is too fine for the extent of the roads')
+        self.keys, node = np.unique(self._keys(ends), return_inverse=True)
+        node = node.reshape(-1)
+        self.ends = np.full((nseg, 2), -1, dtype=np.intp)
+        self.ends[valid] = node.reshape(2, -1).T
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(node, minlength=self.keys.size))))
+        self.indices = np.tile(valid, 2)[np.argsort(node, kind='stable')]
+        self.elevation = np.stack([np.asarray(a, dtype=np.float64) for a in (culvert_end, intersection, hp)])
+        self.kind = segment_ends(hp, intersection)
+
+    def _keys(self, q):
+        q = q - self.origin
+        return q[:, 0] * self.size[1] + q[:, 1]
+
+    def nodes(self, x, y):
+        """
+        Node at each of the points (x, y), -1 for points not on a segment end. A point matches the node of its grid
+        point or, failing that, of one of the eight around it.
+        """
+        q = np.round(np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)])
+                     / self.tolerance) - self.origin
+        node = np.full(q.shape[0], -1, dtype=np.intp)
+        for offset in NODE_OFFSETS:
+            # grid points off the bounding box of the ends can't be a node
+            p = q + offset
+            todo = np.flatnonzero((node < 0) & (p >= 0).all(axis=1) & (p < self.size).all(axis=1))
+            if not todo.size or not self.keys.size:
+                continue
+            keys = self._keys(p[todo].astype(np.int64) + self.origin)
+            pos = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+            hit = self.keys[pos] == keys
+            node[todo[hit]] = pos[hit]
+        return node
+
+    def incidences(self, node):
+        """
+        (point, segment) index pairs, a (2, n) array sorted by point then segment, of the segments ending at each of
+        the nodes (-1 for none).
+        """
+        point = np.flatnonzero(node >= 0)
+        start = self.indptr[node[point]]
+        degree = self.indptr[node[point] + 1] - start
+        base = np.repeat(start - (np.cumsum(degree) - degree), degree)
+        pairs = np.stack([np.repeat(point, degree), self.indices[base + np.arange(base.size)]])
+        pairs = pairs[:, np.lexsort((pairs[1], pairs[0]))]
+        # a segment with both ends on the node (a loop) is listed twice
+        keep = np.ones(pairs.shape[1], dtype=bool)
+        keep[1:] = (pairs[:, 1:] != pairs[:, :-1]).any(axis=0)
+        return pairs[:, keep]
+
+    def higher_roads(self, x, y, culvert_elevation, decimals=DECIMALS):
+        """
+        (culvert, road) index pairs, sorted by culvert then road, of the segments ending at each culvert (x, y) whose
+        elevation, taken by the kind of their far end, is higher than the culvert's once both are rounded to
+        decimals. The roads of culvert i are pairs[1, indptr[i]:indptr[i + 1]] with
+        indptr = np.searchsorted(pairs[0], np.arange(len(x) + 1)).
+        """
+        pairs = self.incidences(self.nodes(x, y))
+        road_elevation = self.elevation[self.kind, np.arange(self.kind.size)]
+        return higher_roads(pairs, road_elevation, np.asarray(culvert_elevation, dtype=np.float64), decimals)
+
+def merge_roads(roads, culverts, culvert_field=CULVERT_ELEVATION_FIELD, hp_field=ROAD_HP_ELEVATION_FIELD,
+                culvert_end_field=ROAD_CULVERT_ELEVATION_FIELD,
+                intersection_field=ROAD_INTERSECTION_ELEVATION_FIELD, tolerance=TOLERANCE, dissolve=False,
+                workers=1, graph=False):
+    """
+    The roads (a GeoDataFrame of split road segments) higher than each culvert they touch (a GeoDataFrame of culvert
+    points), as a GeoDataFrame in the road CRS with the 'culvert' and 'road' row positions, the 'culvert_elevation',
+    the road 'elevation' and the kind of road 'end' it was taken from (see END_KINDS). With dissolve, the higher
+    roads of every culvert are merged into one feature. workers is passed on to find_higher_roads. With graph, the
+    roads of every culvert are looked up in a RoadGraph instead, which needs the roads split at the culverts (see
+    roadprep).
+    """
+    import geopandas as gpd
+
+    if culverts.crs != roads.crs:
+        culverts = culverts.to_crs(roads.crs)
+    hp, culvert_end, intersection = (_float_column(roads[f]) for f in (hp_field, culvert_end_field,
+                                                                     intersection_field))
+    road_elevation = road_elevations(hp, culvert_end, intersection)
+    culvert_elevation = _float_column(culverts[culvert_field])
+    if graph:
+        network = RoadGraph(roads.geometry.values, hp, culvert_end, intersection, tolerance)
+        pairs = network.higher_roads(culverts.geometry.x, culverts.geometry.y, culvert_elevation)
+    else:
+        pairs = find_higher_roads(culverts.geometry.values, roads.geometry.values, road_elevation,
+                                  culvert_elevation, tolerance, workers)
+    c, r = pairs
+    merged = gpd.GeoDataFrame({'culvert': c, 'road': r, 'culvert_elevation': culvert_elevation[c],
+                               'elevation': road_elevation[r],
+                               'end': np.array(END_KINDS)[segment_ends(hp, intersection)[r]]},
+                              geometry=roads.geometry.values[r], crs=roads.crs)
+    if dissolve:
+        merged = merged.dissolve(by='culvert', aggfunc={'culvert_elevation': 'first', 'elevation': 'max'})
+        merged = merged.reset_index()
+    return merged
+
+if __name__ == "__main__":
+
+    import geopandas as gpd
+
+    parser = argparse.ArgumentParser(description='Merge the road segments higher than each culvert.')
+    parser.add_argument('roads', help='split roads with elevations (any OGR source, e.g. a .gdb or .gpkg)')
+    parser.add_argument('culverts', help='culvert points with elevations')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output dataset, written by extension (.gpkg: GeoPackage, .gdb: feature class)')
+    parser.add_argument('--roads-layer', help='layer of the roads source')
+    parser.add_argument('--culverts-layer', help='layer of the culverts source')
+    parser.add_argument('--layer', default='merged_roads', help='output layer (default: %(default)s)')
+    parser.add_argument('--culvert-field', default=CULVERT_ELEVATION_FIELD, help='default: %(default)s')
+    parser.add_argument('--hp-field', default=ROAD_HP_ELEVATION_FIELD, help='default: %(default)s')
+    parser.add_argument('--culvert-end-field', default=ROAD_CULVERT_ELEVATION_FIELD, help='default: %(default)s')
+    parser.add_argument('--intersection-field', default=ROAD_INTERSECTION_ELEVATION_FIELD,
+                        help='default: %(default)s')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='culvert to road search distance (default: %(default)s)')
+    parser.add_argument('--dissolve', action='store_true', help='merge the higher roads of each culvert')
+    parser.add_argument('--graph', action='store_true',
+                        help='find the roads of each culvert by segment end (roads split at the culverts)')
+    parser.add_argument('-t', '--workers', type=int, default=1,
+                        help='worker processes (default: %(default)s, 0: one per CPU)')
+    args = parser.parse_args()
+
+    roads = gpd.read_file(args.roads, layer=args.roads_layer)
+    culverts = gpd.read_file(args.culverts, layer=args.culverts_layer)
+    print("Data Imported!")
+    merged = merge_roads(roads, culverts, args.culvert_field, args.hp_field, args.culvert_end_field,
+                         args.intersection_field, args.tolerance, args.dissolve, args.workers, args.graph)
+    merged.to_file(args.output, layer=args.layer)
+    print(f"{len(merged)} merged roads for {len(culverts)} culverts written to {args.output}")
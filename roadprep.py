@@ -0,0 +1,325 @@
+"""
+Road network preparation for roadmerge without arcpy: prepare_data.py as a pipeline of cached in-memory stages.
+
+prepare_data.py finds the highest point of every split road segment with ZonalStatistics(MAXIMUM) over the roads,
+a full-extent Con(dem == max) raster, RasterToPoint, a snap back onto the roads and a 4 m culvert distance filter,
+writing a full-extent raster or feature class at every step. Here every segment is densified to vertices at most
+half a cell apart and the DEM is sampled at those vertices with one array lookup, so the high point is the vertex
+with the largest sample. It lies on the road already, and the cost is proportional to road length, not DEM area.
+
+PreparePipeline runs the whole preparation as the stages of STAGES (snap, sample, split, high points, intersections,
+joins), which pass GeoDataFrames to each other instead of a dozen intermediate feature classes. Every stage output is
+cached on disk under a hash of its parameters and the keys of its inputs, which bottom out in the size and
+modification time of the source files, and stages are evaluated lazily: after a parameter change only the stages
+downstream of it run again, the rest are read back from the cache. Culverts are snapped onto the roads and the DEM
+sampled at points with pointsample.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from collections import namedtuple
+import numpy as np
+from pointsample import EdgeIndex, sample_points
+from upstreamlib import DEFAULT_NODATA, emit_event
+
+HP_DISTANCE = 4.0  # high points closer than this (CRS units) to a culvert are dropped
+SAMPLE_SPACING = 0.5  # densified vertex spacing along the roads, in cells
+DEFAULT_PREPARE_CACHE_DIR = os.environ.get('ROADPREP_CACHE_DIR', './data/prepare_cache')
+CACHE_VERSION = 1  # bump when a stage's output changes for the same inputs
+PARAMETERS = {
+    'snap_distance': 50.0,  # culverts are snapped onto the nearest road within this distance
+    'tolerance': 0.001,  # points this close to a line are on it (the ArcGIS default XY tolerance)
+    'spacing': SAMPLE_SPACING,
+    'hp_distance': HP_DISTANCE,
+    'join_distance': 50.0,  # search radius of the culvert elevation join, as in prepare_data.py
+    'hp_tolerance': 1.0,  # high points this close to a segment are its high point
+}
+# stage: (inputs, parameters); inputs are sources ('dem', 'roads', 'culverts') or earlier stages
+STAGES = {
+    'snap': (('culverts', 'roads'), ('snap_distance',)),
+    'sample': (('snap', 'dem'), ()),
+    'split': (('roads', 'sample'), ('tolerance',)),
+    'high_points': (('split', 'dem', 'sample'), ('spacing', 'hp_distance')),
+    'intersections': (('split', 'dem', 'sample'), ('tolerance',)),
+    'joins': (('split', 'sample', 'high_points', 'intersections'), ('tolerance', 'join_distance', 'hp_tolerance')),
+}
+SOURCES = ('dem', 'roads', 'culverts')
+
+Dem = namedtuple('Dem', ['array', 'gt', 'nodata'])
+
+def _to_crs(frame, crs):
+    return frame if frame.crs == crs else frame.to_crs(crs)
+
+def segment_maxima(index, values, nsegments):
+    """
+    Position of the largest of the values of each segment, where index gives the segment of every value (sorted), the
+    first one on ties. Segments without a non-NaN value get -1.
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    order = valid[np.lexsort((-values[valid], index[valid]))]  # by segment, largest value first
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = index[order[1:]] != index[order[:-1]]
+    best = np.full(nsegments, -1, dtype=np.intp)
+    best[index[order[first]]] = order[first]
+    return best
+
+def road_high_points(roads, dem, gt, nodata=DEFAULT_NODATA, spacing=SAMPLE_SPACING):
+    """
+    The highest point of every road segment (a GeoSeries of lines in the DEM CRS) on the DEM with geotransform gt, as a
+    GeoDataFrame of points with the 'road' row position and its elevation 'hp_el'. Segments are sampled at vertices
+    at most spacing cells apart; segments entirely off the DEM get no point.
+    """
+    import geopandas as gpd
+    import shapely
+
+    lines = shapely.segmentize(np.asarray(roads.values), spacing * min(abs(gt[1]), abs(gt[5])))
+    xy, index = shapely.get_coordinates(lines, return_index=True)
+    values = sample_points(dem, gt, xy[:, 0], xy[:, 1], 'nearest', nodata)
+    best = segment_maxima(index, values, len(lines))
+    road = np.flatnonzero(best >= 0)
+    best = best[road]
+    return gpd.GeoDataFrame({'road': road, 'hp_el': values[best]}, crs=roads.crs,
+                            geometry=gpd.points_from_xy(xy[best, 0], xy[best, 1]))
+
+def drop_near(points, culverts, distance=HP_DISTANCE):
+    """
+    The points (a GeoDataFrame) farther than distance from every culvert geometry (a GeoSeries).
+    """
+    from shapely import STRtree
+
+    culverts = _to_crs(culverts, points.crs)
+    near = STRtree(np.asarray(culverts.values)).query(points.geometry.values, predicate='dwithin', distance=distance)
+    keep = np.ones(len(points), dtype=bool)
+    keep[near[0]] = False
+    return points[keep]
+
+def snap_points(points, lines, distance):
+    """
+    The points (a GeoSeries) moved onto the nearest of the lines (a GeoSeries) within distance; points farther from
+    every line stay where they are.
+    """
+    import geopandas as gpd
+
+    snapped = EdgeIndex.from_lines(np.asarray(lines.values), distance).snap(points.x, points.y, distance)
+    return gpd.GeoSeries(gpd.points_from_xy(snapped['x'], snapped['y']), index=points.index, crs=points.crs)
+
+def split_lines(lines, points, tolerance):
+    """
+    The lines (an array of geometries) cut at the points within tolerance of them, as (pieces, source): the single-part
+    pieces and the position of the line each came from. Points at the ends of a line don't cut it.
+    """
+    import shapely
+    from shapely.ops import substring
+
+    parts, source = shapely.get_parts(lines, return_index=True)
+    pairs = shapely.STRtree(parts).query(points, predicate='dwithin', distance=tolerance)
+    at = shapely.line_locate_point(parts[pairs[1]], points[pairs[0]])
+    part = pairs[1]
+    inner = (at > tolerance) & (at < shapely.length(parts[part]) - tolerance)
+    part, at = part[inner], at[inner]
+    order = np.lexsort((at, part))
+    part, at = part[order], at[order]
+    pieces, piece_source = [], []
+    cut = np.unique(part)
+    whole = np.setdiff1d(np.arange(parts.size), cut)
+    bounds = np.searchsorted(part, cut), np.searchsorted(part, cut, side='right')
+    for p, lo, hi in zip(cut, *bounds):
+        stops = np.concatenate(([0.0], np.unique(at[lo:hi]), [parts[p].length]))
+        pieces += [substring(parts[p], a, b) for a, b in zip(stops[:-1], stops[1:])]
+        piece_source += [source[p]] * (stops.size - 1)
+    pieces = np.concatenate((parts[whole], np.array(pieces, dtype=object)))
+    piece_source = np.concatenate((source[whole], np.array(piece_source, dtype=source.dtype)))
+    order = np.argsort(piece_source, kind='stable')
+    return pieces[order], piece_source[order]
+
+def line_intersections(lines):
+    """
+    The distinct points where two of the lines (an array of geometries) cross or touch.
+    """
+    import shapely
+
+    pairs = shapely.STRtree(lines).query(lines, predicate='intersects')
+    pairs = pairs[:, pairs[0] < pairs[1]]
+    parts = shapely.get_parts(shapely.intersection(lines[pairs[0]], lines[pairs[1]]))
+    xy = shapely.get_coordinates(parts[shapely.get_type_id(parts) == 0])
+    return shapely.points(np.unique(xy, axis=0))
+
+def max_within(targets, points, values, distance):
+    """
+    The largest of the values of the points (an array of geometries) within distance of each target geometry, NaN
+    where there are none.
+    """
+    from shapely import STRtree
+
+    pairs = STRtree(points).query(targets, predicate='dwithin', distance=distance)
+    out = np.full(len(targets), np.nan)
+    np.fmax.at(out, pairs[0], np.asarray(values, dtype=np.float64)[pairs[1]])
+    return out
+
+def _snap(culverts, roads, snap_distance):
+    culverts = _to_crs(culverts, roads.crs)
+    return culverts.set_geometry(snap_points(culverts.geometry, roads.geometry, snap_distance))
+
+def _sample(culverts, dem):
+    culverts = culverts.copy()
+    xy = np.asarray([culverts.geometry.x, culverts.geometry.y])
+    culverts['elevation'] = sample_points(dem.array, dem.gt, xy[0], xy[1], 'nearest', dem.nodata)
+    return culverts
+
+def _split(roads, culverts, tolerance):
+    import geopandas as gpd
+
+    culverts = _to_crs(culverts, roads.crs)
+    pieces, source = split_lines(np.asarray(roads.geometry.values), np.asarray(culverts.geometry.values), tolerance)
+    attributes = roads.drop(columns=roads.geometry.name).iloc[source].reset_index(drop=True)
+    return gpd.GeoDataFrame(attributes.assign(road=source), geometry=pieces, crs=roads.crs)
+
+def _high_points(segments, dem, culverts, spacing, hp_distance):
+    return drop_near(road_high_points(segments.geometry, dem.array, dem.gt, dem.nodata, spacing), culverts.geometry,
+                     hp_distance)
+
+def _intersections(segments, dem, culverts, tolerance):
+    import geopandas as gpd
+
+    points = line_intersections(np.asarray(segments.geometry.values))
+    points = gpd.GeoDataFrame(geometry=points, crs=segments.crs)
+    # segments meeting at a culvert are the two sides of a split, not a junction
+    points = drop_near(points, culverts.geometry, tolerance).reset_index(drop=True)
+    points['inter_el'] = sample_points(dem.array, dem.gt, points.geometry.x, points.geometry.y, 'nearest',
+                                     dem.nodata)
+    return points
+
+def _joins(segments, culverts, high_points, intersections, tolerance, join_distance, hp_tolerance):
+    import geopandas as gpd
+
+    hp = np.asarray(high_points.geometry.values)
+    pieces, source = split_lines(np.asarray(segments.geometry.values), hp, tolerance)
+    roads = gpd.GeoDataFrame(segments.drop(columns=segments.geometry.name).iloc[source].reset_index(drop=True),
+                             geometry=pieces, crs=segments.crs)
+    roads['MaxEl'] = max_within(pieces, hp, high_points['hp_el'], hp_tolerance)
+    roads['Culv_El_Max'] = max_within(pieces, np.asarray(_to_crs(culverts, segments.crs).geometry.values),
+                                      culverts['elevation'], join_distance)
+    roads['Inter_El'] = max_within(pieces, np.asarray(intersections.geometry.values), intersections['inter_el'],
+                                   tolerance)
+    return roads
+
+STAGE_FUNCTIONS = {'snap': _snap, 'sample': _sample, 'split': _split, 'high_points': _high_points,
+                   'intersections': _intersections, 'joins': _joins}
+
+def source_key(path, layer=None):
+    """
+    Hash of a source file's (or a file geodatabase's) name, layer, sizes and modification times.
+    """
+    files = [path] if not os.path.isdir(path) else sorted(
+        os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+    stats = [(os.path.relpath(f, path), os.path.getsize(f), os.stat(f).st_mtime_ns) for f in files]
+    return hashlib.blake2b(json.dumps([os.path.abspath(path), layer, stats]).encode(), digest_size=16).hexdigest()
+
+class PreparePipeline:
+    """
+    The stages of STAGES over a DEM GeoTIFF and road and culvert sources (any OGR source, optionally a layer of it),
+    with the PARAMETERS overridden by params. get(stage) evaluates a stage and whatever it depends on, reading every
+    stage whose key is already in the cache instead of running it.
+    """
+    def __init__(self, dem, roads, culverts, cache_dir=DEFAULT_PREPARE_CACHE_DIR, roads_layer=None,
+                 culverts_layer=None, **params):
+        unknown = set(params) - set(PARAMETERS)
+        if unknown:
+            raise ValueError(f'unknown parameters {sorted(unknown)}, expected some of {list(PARAMETERS)}')
+        self.sources = {'dem': (dem, None), 'roads': (roads, roads_layer), 'culverts': (culverts, culverts_layer)}
+        self.params = {**PARAMETERS, **params}
+        self.cache_dir = cache_dir
+        self._keys = {}
+        self._values = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, name):
+        """
+        Cache key of a source or stage.
+        """
+        if name not in self._keys:
+            if name in SOURCES:
+                self._keys[name] = source_key(*self.sources[name])
+            else:
+                inputs, params = STAGES[name]
+                h = hashlib.blake2b(digest_size=16)
+                h.update(json.dumps([CACHE_VERSION, name, [self.key(i) for i in inputs],
+                                     [self.params[p] for p in params]]).encode())
+                self._keys[name] = h.hexdigest()
+        return self._keys[name]
+
+    def path(self, name):
+        """
+        Cache file of a stage.
+        """
+        return os.path.join(self.cache_dir, f'{name}-{self.key(name)}.pkl')
+
+    def _load_source(self, name):
+        import geopandas as gpd
+
+        path, layer = self.sources[name]
+        if name != 'dem':
+            return gpd.read_file(path, layer=layer)
+        from upstreamhandler import tiff_get_tags, tiff_to_array
+
+        _, gt, _, _, _, _, nodata = tiff_get_tags(path)
+        return Dem(tiff_to_array(path), gt, DEFAULT_NODATA if nodata is None else nodata)
+
+    def get(self, name):
+        """
+        Output of a stage (or a loaded source).
+        """
+        if name in self._values:
+            return self._values[name]
+        start = time.perf_counter()
+        if name in SOURCES:
+            value = self._load_source(name)
+        elif os.path.exists(self.path(name)):
+            with open(self.path(name), 'rb') as f:
+                value = pickle.load(f)
+            emit_event('prepare_stage', stage=name, cached=True, seconds=time.perf_counter() - start)
+        else:
+            inputs, params = STAGES[name]
+            value = STAGE_FUNCTIONS[name](*(self.get(i) for i in inputs), **{p: self.params[p] for p in params})
+            # write to a scratch file and rename it into place so readers never see a partial entry
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(name))
+            emit_event('prepare_stage', stage=name, cached=False, seconds=time.perf_counter() - start)
+        self._values[name] = value
+        return value
+
+    def stale(self):
+        """
+        The stages that get would have to run rather than read from the cache.
+        """
+        return [name for name in STAGES if not os.path.exists(self.path(name))]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Prepare roads and culverts with elevations for roadmerge.')
+    parser.add_argument('dem', help='DEM GeoTIFF')
+    parser.add_argument('roads', help='dissolved roads (any OGR source, e.g. a .gdb or .gpkg)')
+    parser.add_argument('culverts', help='culvert points')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output GeoPackage with the split_roads_elev, culverts_with_elevation, high_points and '
+                             'intersections layers')
+    parser.add_argument('--roads-layer', help='layer of the roads source')
+    parser.add_argument('--culverts-layer', help='layer of the culverts source')
+    parser.add_argument('--cache', default=DEFAULT_PREPARE_CACHE_DIR, help='stage cache (default: %(default)s)')
+    for name, default in PARAMETERS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=float, default=default, help='default: %(default)s')
+    args = parser.parse_args()
+
+    pipeline = PreparePipeline(args.dem, args.roads, args.culverts, args.cache, args.roads_layer,
+                               args.culverts_layer, **{name: getattr(args, name) for name in PARAMETERS})
+    print(f"Stages to run: {', '.join(pipeline.stale()) or 'none'}")
+    for stage, layer in [('joins', 'split_roads_elev'), ('sample', 'culverts_with_elevation'),
+                         ('high_points', 'high_points'), ('intersections', 'intersections')]:
+        pipeline.get(stage).to_file(args.output, layer=layer)
+    print(f"Prepared roads and culverts written to {args.output}")
@@ -1,7 +1,8 @@
 /*
  computes upstream average of input array, normalized by drainage area
 
- this file designed to be run from within a Python wrapper script
+ this file designed to be run from within a Python wrapper script; the averaging itself lives in upstreamcore.c, which
+ upstreamlib.py also loads in-process as a shared library
  
  expects input array to be averaged at ./data/tmp/input_var.flt
  expects input DEM at ./data/tmp/input_dem.flt
@@ -16,8 +17,31 @@
  one optional command line option, no argument:
     -s (provide this flag to write the upstream sum to output instead of the default area-normalized average)
 
+ optional number of variables (default 1); input_var.flt and output.flt then hold that many values per cell,
+ pixel-interleaved, and all of them are averaged in the same routing pass:
+    -n 5
+
+ optional hydrocorrection options:
+    -f 1  (fill mode: 0 = none, DEM already hydrocorrected; 1 = recursive pit and flat filling, default;
+           2 = priority-flood, recommended for large DEMs)
+    -e 0.01  (priority-flood flat gradient in elevation units; 0 raises filled cells by the smallest float step)
+
+ optional number of threads for flow accumulation (default 1; 0 = all cores). drainage basins are routed in
+ parallel and the output is identical for any number of threads:
+    -t 8
+
+ optional comma-separated list of products to compute together in one pass, each written to
+ ./data/tmp/output_<product>.flt instead of output.flt: area (contributing area), sum, avg, filled (hydrocorrected
+ DEM) and flowdir (D8 flow direction codes, one byte per cell). input_var.flt is only read for sum and avg:
+    -p area,sum,avg
+
+ one optional flag, no argument, to print progress to stderr as one JSON object per line: the events of
+ upstreamcore.c plus one per file read or written, {"event":"read","path":..,"bytes":..,"seconds":..}:
+    -j
+
  compile with:
-    gcc -o upstreamavg.exe upstreamavg.c utilities.c -lm -Wall
+    gcc -fopenmp -o upstreamavg.exe upstreamavg.c upstreamcore.c priorityflood.c utilities.c -lm -Wall
+ (add -DUPSTREAM_LARGE for rasters of 2^31 cells or more)
  run with, e.g.:
     ./upstreamavg.exe -x 200 -y 200 -d 1.0 -v -9999
 */
@@ -28,11 +52,47 @@
 #include<stdio.h>
 #include<stdlib.h>
 #include<string.h>
+#include<time.h>
 #include"utilities.h"
+#include"upstreamcore.h"
+
+// products selectable with -p
+#define PRODUCT_AREA 1
+#define PRODUCT_SUM 2
+#define PRODUCT_AVG 4
+#define PRODUCT_FILLED 8
+#define PRODUCT_FLOWDIR 16
+#define NPRODUCTS 5
+static const char *productnames[NPRODUCTS]={"area","sum","avg","filled","flowdir"};
+
+int flg_avg,fillmode,nthreads,flg_events,products;
+float dx,nanval,epsilon;
+long Nx,Ny,nvar;
+
+int parseproducts(const char *list)
+{
+    // Bit mask of the comma-separated product names in list, -1 if one of them is unknown
+    char name[32];
+    int p,mask,len;
 
-int *topovecind,*iup,*idown,*jup,*jdown,flg_avg;
-float **arr,**topo,**acc,**area,*topovec,dx,nanval;
-long Nx,Ny;
+    mask = 0;
+    while (*list)
+    {
+        len = strcspn(list,",");
+        for (p=0;p<NPRODUCTS;p++)
+            if ((len==(int)strlen(productnames[p]))&&(strncmp(list,productnames[p],len)==0)) break;
+        if (p==NPRODUCTS)
+        {
+            snprintf(name,sizeof(name),"%.*s",len,list);
+            printf("Unknown product: %s\n",name);
+            return -1;
+        }
+        mask |= 1<<p;
+        list += len;
+        if (*list==',') list++;
+    }
+    return mask;
+}
 
 void readcmdlineargs(int argc, char *argv[])
 {
@@ -47,16 +107,22 @@ void readcmdlineargs(int argc, char *argv[])
     Ny = -1;
     nanval = -9999;  // in case nanval isn't provided, guess the common no data value
     flg_avg = 1;  // flag determines whether the upstream avg is calculated (1, default) or the sum (0)
-
-    while ((opt = getopt(argc, argv, ":x:y:d:v:s")) != -1)
+    nvar = 1;
+    fillmode = FILL_RECURSIVE;
+    epsilon = 0.01;
+    nthreads = 1;
+    flg_events = 0;
+    products = 0;  // 0: the sum or average selected by -s, written to output.flt
+
+    while ((opt = getopt(argc, argv, ":x:y:d:v:sn:f:e:t:jp:")) != -1)
     {
         switch(opt)
         {
             case 'x':
-                Nx = atoi(optarg);  // size of x dimension
+                Nx = atol(optarg);  // size of x dimension
                 break;
             case 'y':
-                Ny = atoi(optarg);  // size of y dimension
+                Ny = atol(optarg);  // size of y dimension
                 break;
             case 'd':
                 dx = atof(optarg);  // grid spacing
@@ -67,6 +133,24 @@ void readcmdlineargs(int argc, char *argv[])
             case 's':  // calculate the sum instead of upstream avg
                 flg_avg = 0;
                 break;
+            case 'n':
+                nvar = atoi(optarg);  // number of pixel-interleaved variables
+                break;
+            case 'f':
+                fillmode = atoi(optarg);  // hydrocorrection mode
+                break;
+            case 'e':
+                epsilon = atof(optarg);  // priority-flood flat gradient
+                break;
+            case 't':
+                nthreads = atoi(optarg);  // flow accumulation threads
+                break;
+            case 'j':  // print JSON progress events to stderr
+                flg_events = 1;
+                break;
+            case 'p':
+                products = parseproducts(optarg);  // products computed in one pass
+                break;
             case '?':
                 printf("Unknown option: %c\n", optopt);
                 break;
@@ -82,285 +166,121 @@ void readcmdlineargs(int argc, char *argv[])
         printf("-x, -y, -d, -v flags are all mandatory!\n");
         exit(EXIT_FAILURE);
     }
-}
-
-void setupgridneighbors()
-{
-    int i,j;
-    for (i=1;i<=Ny;i++)
-    {
-        idown[i]=i-1;
-        iup[i]=i+1;
-    }
-    for (j=1;j<=Nx;j++)
-    {
-        jdown[j]=j-1;
-        jup[j]=j+1;
-    }
-    // open boundaries
-    idown[1]=1;
-    iup[Ny]=Ny;
-    jdown[1]=1;
-    jup[Nx]=Nx;
-}
-
-void allocatearrays()
-{
-    arr = matrix(1,Ny,1,Nx);
-    area = matrix(1,Ny,1,Nx);
-    topo = matrix(1,Ny,1,Nx);
-    acc = matrix(1,Ny,1,Nx);
-    topovec = vector(1,Ny*Nx);
-    topovecind = ivector(1,Ny*Nx);
-    idown=ivector(1,Ny);
-    iup=ivector(1,Ny);
-    jup=ivector(1,Nx);
-    jdown=ivector(1,Nx);
-}
-
-void freearrays()
-{
-    free_matrix(arr,1,Ny,1,Nx);
-    free_matrix(area,1,Ny,1,Nx);
-    free_matrix(topo,1,Ny,1,Nx);
-    free_matrix(acc,1,Ny,1,Nx);
-    free_vector(topovec,1,Ny*Nx);
-    free_ivector(idown,1,Ny);
-    free_ivector(iup,1,Ny);
-    free_ivector(jdown,1,Nx);
-    free_ivector(jup,1,Nx);
-}
-
-void fillinpitsandflats(int i, int j)
-{
-    float min,fillincrement;
-
-    fillincrement=0.01;
-    if ((i>1)&&(j>1)&&(i<Ny)&&(j<Nx)&&topo[i][j]!=nanval)
-    {
-        min=topo[i][j];
-        if (topo[iup[i]][j]<min) min=topo[iup[i]][j];
-        if (topo[idown[i]][j]<min) min=topo[idown[i]][j];
-        if (topo[i][jup[j]]<min) min=topo[i][jup[j]];
-        if (topo[i][jdown[j]]<min) min=topo[i][jdown[j]];
-        if (topo[iup[i]][jup[j]]<min) min=topo[iup[i]][jup[j]];
-        if (topo[idown[i]][jup[j]]<min) min=topo[idown[i]][jup[j]];
-        if (topo[idown[i]][jdown[j]]<min) min=topo[idown[i]][jdown[j]];
-        if (topo[iup[i]][jdown[j]]<min) min=topo[iup[i]][jdown[j]];
-        if (topo[i][j]<=min)
-        {
-            // The node's a pit or flat, increment its elevation and push all neighbor nodes
-            topo[i][j]=min+fillincrement;
-            fillinpitsandflats(i,j);
-            fillinpitsandflats(iup[i],j);
-            fillinpitsandflats(idown[i],j);
-            fillinpitsandflats(i,jup[j]);
-            fillinpitsandflats(i,jdown[j]);
-            fillinpitsandflats(iup[i],jup[j]);
-            fillinpitsandflats(idown[i],jup[j]);
-            fillinpitsandflats(idown[i],jdown[j]);
-            fillinpitsandflats(iup[i],jdown[j]);
-        }
-    }
-}
-
-int calculated8drainagedirections(int i, int j)
-{
-    float down,oneoversqrt2;
-    int flowdir;
-
-    oneoversqrt2=0.707106781186; // diagonal neighbors are a distance of sqrt(2) further away then non-diagonals; therefore need to divide by sqrt(2)
-    down=0.0;
-    flowdir=0;
-    if (oneoversqrt2*(topo[iup[i]][jdown[j]]-topo[i][j])<down)
-    {
-        down=oneoversqrt2*(topo[iup[i]][jdown[j]]-topo[i][j]);
-        flowdir=1;
-    }
-    if (topo[iup[i]][j]-topo[i][j]<down)
-    {
-        down=(topo[iup[i]][j]-topo[i][j]);
-        flowdir=2;
-    }
-    if (oneoversqrt2*(topo[iup[i]][jup[j]]-topo[i][j])<down)
-    {
-        down=oneoversqrt2*(topo[iup[i]][jup[j]]-topo[i][j]);
-        flowdir=4;
-    }
-    if (topo[i][jup[j]]-topo[i][j]<down)
+    if ((nvar<=0)||(fillmode<FILL_NONE)||(fillmode>FILL_PRIORITYFLOOD)||(epsilon<0.0)||(nthreads<0)||(products<0))
     {
-        down=(topo[i][jup[j]]-topo[i][j]);
-        flowdir=8;
-    }
-    if (oneoversqrt2*(topo[idown[i]][jup[j]]-topo[i][j])<down)
-    {
-        down=oneoversqrt2*(topo[idown[i]][jup[j]]-topo[i][j]);
-        flowdir=16;
-    }
-    if (topo[idown[i]][j]-topo[i][j]<down)
-    {
-        down=(topo[idown[i]][j]-topo[i][j]);
-        flowdir=32;
-    }
-    if (oneoversqrt2*(topo[idown[i]][jdown[j]]-topo[i][j])<down)
-    {
-        down=oneoversqrt2*(topo[idown[i]][jdown[j]]-topo[i][j]);
-        flowdir=64;
-    }
-    if (topo[i][jdown[j]]-topo[i][j]<down)
-    {
-        down=(topo[i][jdown[j]]-topo[i][j]);
-        flowdir=128;
+        printf("-n must be positive, -f must be 0, 1 or 2, -e and -t must not be negative and -p must list area, sum, "
+               "avg, filled or flowdir!\n");
+        exit(EXIT_FAILURE);
     }
-    return flowdir;
 }
 
-void flowaccumulated8(int i, int j)
+double wallclock()
 {
+    struct timespec ts;
 
-    int flowdir;
-
-    flowdir=calculated8drainagedirections(i,j);
-    if (flowdir==0)
-    {
-        printf("Error: topographic pit detected! Input DEM must be hydrocorrected.\n");
-        exit(EXIT_FAILURE);
-    }
-
-    if (flowdir==1)
-    {
-        acc[iup[i]][jdown[j]]+=acc[i][j];
-        area[iup[i]][jdown[j]]+=area[i][j];
-    }
-    if (flowdir==2)
-    {
-        acc[iup[i]][j]+=acc[i][j];
-        area[iup[i]][j]+=area[i][j];
-    }
-    if (flowdir==4)
-    {
-        acc[iup[i]][jup[j]]+=acc[i][j];
-        area[iup[i]][jup[j]]+=area[i][j];
-    }
-    if (flowdir==8)
-    {
-        acc[i][jup[j]]+=acc[i][j];
-        area[i][jup[j]]+=area[i][j];
-    }
-    if (flowdir==16)
-    {
-        acc[idown[i]][jup[j]]+=acc[i][j];
-        area[idown[i]][jup[j]]+=area[i][j];
-    }
-    if (flowdir==32)
-    {
-        acc[idown[i]][j]+=acc[i][j];
-        area[idown[i]][j]+=area[i][j];
-    }
-    if (flowdir==64)
-    {
-        acc[idown[i]][jdown[j]]+=acc[i][j];
-        area[idown[i]][jdown[j]]+=area[i][j];
-    }
-    if (flowdir==128)
-    {
-        acc[i][jdown[j]]+=acc[i][j];
-        area[i][jdown[j]]+=area[i][j];
-    }
+    clock_gettime(CLOCK_MONOTONIC,&ts);
+    return ts.tv_sec+1e-9*ts.tv_nsec;
 }
 
-void flowrouting()
+void printevent(const char *event)
 {
-    int i,j,t;
-
-    t=Nx*Ny+1;
-    while (t>1)
-    {
-        t--;
-        j=(topovecind[t])%Nx;
-        if (j==0) j=Nx;
-        i=(topovecind[t])/Nx+1;
-        if (j==Nx) i--;
-        if ((i>1)&&(i<Ny)&&(j>1)&&(j<Nx)&&(topo[i][j]!=nanval))
-            flowaccumulated8(i,j);
-    }
+    fprintf(stderr,"%s\n",event);
+    fflush(stderr);
 }
 
-void normalizeupstreamsum()
+void fileevent(const char *event, const char *path, long bytes, double start)
 {
-    int i,j;
+    char buf[512];
 
-    for (i=1;i<=Ny;i++)
-        for (j=1;j<=Nx;j++)
-            if ((topo[i][j]!=nanval) && (area[i][j]>0.0))  // check on area probably not necessary but leaving it just to be sure...
-                acc[i][j] /= area[i][j];
+    if (!flg_events) return;
+    snprintf(buf,sizeof(buf),"{\"event\":\"%s\",\"path\":\"%s\",\"bytes\":%ld,\"seconds\":%.6f}",event,path,bytes,
+             wallclock()-start);
+    printevent(buf);
 }
 
 int main(int argc, char *argv[])
 {
     FILE *fr0,*fr1,*fw0;
-    int i,j;
+    float *var,*dem,*out[NPRODUCTS-1];
+    unsigned char *flowdir;
+    char path[64];
+    long nread,size[NPRODUCTS];
+    int p,flg_output,flg_var;
+    double start;
 
     // Set parameters of the input grid from command line arguments
     readcmdlineargs(argc, argv);
+    if (flg_events) (void) setcallback(printevent);
+
+    // Without -p the sum or average selected by -s is the only product and goes to output.flt
+    flg_output = (products==0);
+    if (flg_output) products = flg_avg ? PRODUCT_AVG : PRODUCT_SUM;
+    flg_var = products&(PRODUCT_SUM|PRODUCT_AVG);
+    for (p=0;p<NPRODUCTS;p++)
+        size[p] = ((1<<p)&(PRODUCT_SUM|PRODUCT_AVG)) ? Nx*Ny*nvar : Nx*Ny;
 
     // Open input files
-    fr0 = fopen("./data/tmp/input_var.flt", "rb"); fileerrorcheck(fr0);  // input raster to be averaged
+    fr0 = NULL;
+    if (flg_var)
+    {
+        fr0 = fopen("./data/tmp/input_var.flt", "rb"); fileerrorcheck(fr0);  // input raster to be averaged
+    }
     fr1 = fopen("./data/tmp/input_dem.flt", "rb"); fileerrorcheck(fr1);  // input topography raster
 
-    // Array memory allocation
-    allocatearrays();
+    // Array memory allocation; flowdir is the last product and the only one that isn't float
+    var = flg_var ? vector(1,Ny*Nx*nvar) : NULL;
+    dem = vector(1,Ny*Nx);
+    for (p=0;p<NPRODUCTS-1;p++)
+        out[p] = (products&(1<<p)) ? vector(1,size[p]) : NULL;
+    flowdir = (products&PRODUCT_FLOWDIR) ? cvector(1,Ny*Nx) : NULL;
 
     // Load data
-    setupgridneighbors();
-    for (i=1;i<=Ny;i++)
+    if (flg_var)
     {
-        // Load  data from input files one row at a time; array pointers point to the first column of the i_th row
-		(void) fread(&arr[i][1],sizeof(float),Nx,fr0);  // input to be averaged
-        (void) fread(&topo[i][1],sizeof(float),Nx,fr1);  // digital elevation model (m)
+        start = wallclock();
+        nread = fread(&var[1],sizeof(float),Nx*Ny*nvar,fr0);  // input(s) to be averaged
+        fileevent("read","./data/tmp/input_var.flt",nread*sizeof(float),start);
+        fclose(fr0);
+    }
+    start = wallclock();
+    nread = fread(&dem[1],sizeof(float),Nx*Ny,fr1);  // digital elevation model (m)
+    fileevent("read","./data/tmp/input_dem.flt",nread*sizeof(float),start);
+    fclose(fr1);
+
+    // Hydrocorrect, route and normalize, computing every product in the same pass
+    (void) setthreads(nthreads);
+    if (upstreamproducts(&dem[1],var ? &var[1] : NULL,Nx,Ny,nvar,dx,nanval,fillmode,epsilon,
+                         out[0] ? &out[0][1] : NULL,out[1] ? &out[1][1] : NULL,out[2] ? &out[2][1] : NULL,
+                         out[3] ? &out[3][1] : NULL,flowdir ? &flowdir[1] : NULL)!=UPSTREAM_OK)
+    {
+        printf("Error: topographic pit detected! Input DEM must be hydrocorrected.\n");
+        exit(EXIT_FAILURE);
     }
-    fclose(fr0);fclose(fr1);
-    
-    // Hydrocorrection
-    for (i=1;i<=Ny;i++)
-        for (j=1;j<=Nx;j++)
-            fillinpitsandflats(i,j);
-
-    // Initialize remaining arrays
-    for (i=1;i<=Ny;i++)
-        for (j=1;j<=Nx;j++)
-        {
-            topovec[(i-1)*Nx+j]=topo[i][j];
-            if (topo[i][j]!=nanval)
-            {
-                acc[i][j]=dx*dx*arr[i][j];
-                area[i][j]=dx*dx;  // contributing area (m^2)
-            }
-            else
-            {
-                acc[i][j]=nanval;
-                area[i][j]=nanval;
-            }
-        }
-
-    // Sort the index table topovecind according to rank order of topography in topovec, lowest to highest
-    indexx(Nx*Ny, topovec, topovecind);
-
-    // Route flow
-    flowrouting();
-
-    // Normalize by drainage area
-    if (flg_avg)
-        normalizeupstreamsum();
 
-    // Write accumulated raster to file
-    fw0 = fopen("./data/tmp/output.flt","wb"); fileerrorcheck(fw0);
-    for (i=1;i<=Ny;i++)
-        (void) fwrite(&acc[i][1],sizeof(float),Nx,fw0);
-    fclose(fw0);
+    // Write the products to file
+    for (p=0;p<NPRODUCTS;p++)
+    {
+        if (!(products&(1<<p))) continue;
+        if (flg_output)
+            snprintf(path,sizeof(path),"./data/tmp/output.flt");
+        else
+            snprintf(path,sizeof(path),"./data/tmp/output_%s.flt",productnames[p]);
+        start = wallclock();
+        fw0 = fopen(path,"wb"); fileerrorcheck(fw0);
+        if (p==NPRODUCTS-1)
+            nread = fwrite(&flowdir[1],1,size[p],fw0);
+        else
+            nread = fwrite(&out[p][1],sizeof(float),size[p],fw0)*sizeof(float);
+        fclose(fw0);
+        fileevent("write",path,nread,start);
+    }
 
     // Free array allocations
-    freearrays();
+    if (var) free_vector(var,1,Ny*Nx*nvar);
+    free_vector(dem,1,Ny*Nx);
+    for (p=0;p<NPRODUCTS-1;p++)
+        if (out[p]) free_vector(out[p],1,size[p]);
+    if (flowdir) free_cvector(flowdir,1,Ny*Nx);
 
     return EXIT_SUCCESS;
 }
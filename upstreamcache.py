@@ -0,0 +1,117 @@
+"""
+Persistent on-disk cache of DEM flow topologies (hydrocorrected DEM, D8 flow directions and routing order).
+
+These depend only on the DEM and the hydrocorrection settings, so repeated covariate runs against the same DEM can
+skip straight to accumulation. Entries are keyed by a hash of the DEM contents and stored as .npy files, which are
+memory-mapped on load. The least recently used entries are evicted once the cache grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from upstreamlib import DEFAULT_EPSILON, DEFAULT_NODATA, Topology, flow_topology
+
+DEFAULT_CACHE_DIR = os.environ.get('UPSTREAM_CACHE_DIR', './data/cache')
+DEFAULT_MAX_BYTES = 20 * 1024**3
+CACHE_VERSION = 2  # bump when the stored layout or the routing semantics change
+
+def topology_key(dem, nodata=DEFAULT_NODATA, fill='recursive', epsilon=DEFAULT_EPSILON):
+    """
+    Content hash identifying the topology of dem under the given hydrocorrection settings. Grid spacing doesn't enter:
+    D8 directions and routing order are the same for any square cell size.
+    """
+    dem = np.ascontiguousarray(dem, dtype=np.float32)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([CACHE_VERSION, dem.shape, nodata, fill, epsilon if fill == 'priorityflood' else None])
+             .encode())
+    h.update(memoryview(dem).cast('B'))
+    return h.hexdigest()
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+class TopologyCache:
+    """
+    Directory of cached topologies, one subdirectory per key holding filled.npy, flowdir.npy and order.npy.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        Memory-mapped Topology stored under key, or None.
+        """
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return None
+        os.utime(path)  # mark as recently used for eviction
+        return Topology(*(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in Topology._fields))
+
+    def put(self, key, topology):
+        """
+        Store topology under key and evict old entries if the cache is over its size limit.
+        """
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+        # write to a scratch directory and rename it into place so readers never see a partial entry
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            for name, arr in zip(Topology._fields, topology):
+                np.save(os.path.join(tmp, f'{name}.npy'), np.asarray(arr))
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        self.evict()
+
+    def get_or_build(self, dem, nodata=DEFAULT_NODATA, fill='recursive', epsilon=DEFAULT_EPSILON):
+        """
+        Cached topology for dem, building and storing it first if it isn't cached yet.
+        """
+        key = topology_key(dem, nodata, fill, epsilon)
+        topology = self.get(key)
+        if topology is None:
+            self.put(key, flow_topology(dem, nodata, fill, epsilon))
+            topology = self.get(key)
+        return topology
+
+    def entries(self):
+        """
+        (last used, size in bytes, key) of every entry, least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = self._path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), _dir_size(path), key))
+        return sorted(entries)
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes (default: the cache's limit).
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+        return total
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        return self.evict(0)
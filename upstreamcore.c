@@ -0,0 +1,1108 @@
+/*
+ upstream averaging engine shared by the upstreamavg.exe command line tool and the libupstream.so shared library
+
+ the engine works directly on caller-owned, row-major float32 buffers of size Ny*Nx, so the Python wrapper can hand
+ over NumPy arrays without copying them through temporary files (see upstreamlib.py). any number of variables can be
+ averaged in the same pass; they are stored pixel-interleaved (Ny*Nx*nvar, the nvar values of a cell contiguous) so
+ each routing step touches one contiguous run of memory per cell
+
+ routing is done in three stages: the D8 flow direction of every cell is computed once into a uint8 grid, the valid
+ cells are put in topological (upstream to downstream) order from the in-degree of the D8 graph, and each cell then
+ pulls the accumulated values of its donors in a fixed neighbor order. everything after hydrocorrection is O(number
+ of valid cells) and the result does not depend on which valid topological order is used
+
+ the engine keeps few bytes per cell so that continental-scale tiles fit on one node: flow directions are a uint8
+ grid, validity (not NoData) is a packed bit mask, the DEM is only copied when it has to be hydrocorrected and the
+ copy is freed as soon as the directions are known, and the routing arrays (order, donor bit masks, contributing
+ area) are only allocated after that. flat cell indices are cellindex (upstreamcore.h): 32-bit by default and 64-bit
+ when compiled with -DUPSTREAM_LARGE, which rasters of 2^31 cells or more need
+
+ watershed-clipped DEMs are often mostly NoData, so only the valid cells are ever visited: the DEM is read once into
+ the valid mask, whose 64-bit words let every pass over the grid skip 64 NoData cells in one test (nextvalid), and
+ the routing order, allocated for the valid cells only, is the compact list of them that maps back to raster
+ positions. the per-cell routing arrays stay raster-addressed, so the routing loop needs no index translation, but
+ they are only touched at valid cells and the pages that only cover NoData are never mapped. hydrocorrection,
+ directions, ordering and routing thus cost in proportion to the valid cells, and each NoData cell of an output is
+ written once
+
+ upstreamproducts returns any combination of the contributing area, upstream sum, area-normalized average,
+ hydrocorrected DEM and flow direction grid from one hydrocorrection, ordering and routing pass; upstreamavg is the
+ sum-or-average case of it
+
+ the other entry points reuse a topology stored by flowtopology: routetopology routes new variables over it,
+ updatetopology recomputes only the cells downstream of a few changed cells, flowintervals labels the flow forest for
+ O(1) upstream queries at points (see upstreamquery.py) and catchmentlabels delineates the catchments of many
+ outlets in one pass
+
+ progress is reported through an optional callback (see setcallback) as one JSON object per event:
+    {"event":"call_start","call":"upstreamavg","nx":..,"ny":..,"nvar":..,"threads":..}
+    {"event":"stage_start","call":..,"stage":"hydrocorrect","t":..}  (t: seconds since the call started)
+    {"event":"fill","call":..,"mode":"recursive","raised":..,"iterations":..,"stack_peak":..}
+    {"event":"fill","call":..,"mode":"priorityflood","raised":..,"heap_peak":..,"queue_peak":..}
+    {"event":"stage_end","call":..,"stage":..,"t":..,"seconds":..,"cells":..}
+    {"event":"call_end","call":..,"status":..,"seconds":..}
+ raised counts the cells hydrocorrection changed, iterations the 0.01 m increments of the recursive fill, and the
+ peaks are the deepest recursion and the largest heap and pit queue of the fills. events are only emitted from the
+ calling thread, between stages
+
+ flow never crosses from one outlet basin into another, so with more than one thread (see setthreads) the routing
+ order is regrouped by basin and the basins are accumulated in parallel with OpenMP. since every cell still pulls its
+ donors in the same order the results are bit-identical to the serial ones
+
+ build the shared library with:
+    gcc -shared -fPIC -O2 -fopenmp -o libupstream.so upstreamcore.c priorityflood.c utilities.c -lm -Wall
+ (without -fopenmp everything runs serially)
+*/
+
+#include<math.h>
+#include<stdarg.h>
+#include<stdint.h>
+#include<stdio.h>
+#include<stdlib.h>
+#include<string.h>
+#include<time.h>
+#ifdef _OPENMP
+#include<omp.h>
+#endif
+#include"utilities.h"
+#include"priorityflood.h"
+#include"upstreamcore.h"
+
+// row and column offsets of the neighbor that flow direction code 1<<d points to
+static const int di[8]={1,1,1,0,-1,-1,-1,0};
+static const int dj[8]={-1,0,1,1,1,0,-1,-1};
+
+#ifdef UPSTREAM_LARGE
+#define cellvector lvector
+#define free_cellvector free_lvector
+#else
+#define cellvector ivector
+#define free_cellvector free_ivector
+#endif
+
+// packed valid cell mask, one bit per cell in 64-bit words
+#define ISVALID(k) ((valid[(k)>>6]>>((k)&63))&1)
+#define SETVALID(k) (valid[(k)>>6]|=(uint64_t)1<<((k)&63))
+
+// flag of the cells updatetopology recomputes
+#define AFFECTED 0x80
+
+static cellindex *order,*orderbuf;
+static int *iup,*idown,*jup,*jdown,topocopy,ownarea;
+static float *arr,*acc,**topo,*area,dx,nanval;
+static unsigned char *flowdir,*dirbuf,*donors;
+static uint64_t *valid;
+static long Nx,Ny,Ncells,nwords,nvalid,nvar,norder,flowoffset[8];
+static int nthreads=1;
+static double stagetime[NSTAGES],stagestart,callstart;
+static const char *callname,*stagenames[NSTAGES]={"hydrocorrect","directions","order","route","normalize"};
+static upstreamcallback callback=NULL;
+static long fillsteps,filldepth,fillpeak;  // recursive fill increments, recursion depth and its high-water mark
+
+static double wallclock()
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC,&ts);
+    return ts.tv_sec+1e-9*ts.tv_nsec;
+}
+
+static void emit(const char *fmt, ...)
+/* format one JSON event and hand it to the callback, if there is one */
+{
+    char event[512];
+    va_list ap;
+
+    if (!callback) return;
+    va_start(ap,fmt);
+    vsnprintf(event,sizeof(event),fmt,ap);
+    va_end(ap);
+    callback(event);
+}
+
+static void callbegin(const char *name)
+{
+    callname=name;
+    memset(stagetime,0,sizeof(stagetime));
+    callstart=wallclock();
+    emit("{\"event\":\"call_start\",\"call\":\"%s\",\"nx\":%ld,\"ny\":%ld,\"nvar\":%ld,\"threads\":%d}",
+         callname,Nx,Ny,nvar,nthreads);
+}
+
+static int callend(int status)
+{
+    emit("{\"event\":\"call_end\",\"call\":\"%s\",\"status\":%d,\"seconds\":%.6f}",callname,status,
+         wallclock()-callstart);
+    return status;
+}
+
+static void stagebegin(int stage)
+{
+    stagestart=wallclock();
+    emit("{\"event\":\"stage_start\",\"call\":\"%s\",\"stage\":\"%s\",\"t\":%.6f}",callname,stagenames[stage],
+         stagestart-callstart);
+}
+
+static void stageend(int stage, long cells)
+{
+    double t=wallclock();
+
+    stagetime[stage]+=t-stagestart;
+    emit("{\"event\":\"stage_end\",\"call\":\"%s\",\"stage\":\"%s\",\"t\":%.6f,\"seconds\":%.6f,\"cells\":%ld}",
+         callname,stagenames[stage],t-callstart,t-stagestart,cells);
+}
+
+static void setupflowoffsets()
+/* flat index offset of the receiver for each flow direction */
+{
+    int d;
+
+    for (d=0;d<8;d++)
+        flowoffset[d]=di[d]*Nx+dj[d];
+}
+
+static void setupgridneighbors()
+{
+    int i,j;
+    for (i=1;i<=Ny;i++)
+    {
+        idown[i]=i-1;
+        iup[i]=i+1;
+    }
+    for (j=1;j<=Nx;j++)
+    {
+        jdown[j]=j-1;
+        jup[j]=j+1;
+    }
+    // open boundaries
+    idown[1]=1;
+    iup[Ny]=Ny;
+    jdown[1]=1;
+    jup[Nx]=Nx;
+
+    setupflowoffsets();
+}
+
+static void allocatearrays(float *dem, int copydem, float *var, float *out, unsigned char *dirout,
+                           cellindex *orderout)
+{
+    // the DEM, the input variables and the output are the caller's buffers; the DEM is only copied (copydem) when
+    // hydrocorrection must not modify it, and there is no DEM when routing a stored topology
+    arr = var;
+    acc = out;
+    Ncells = Nx*Ny;
+    topocopy = dem && copydem;
+    topo = NULL;
+    if (topocopy)
+    {
+        topo = matrix(1,Ny,1,Nx);
+        memcpy(&topo[1][1],dem,Ncells*sizeof(float));
+    }
+    else if (dem)
+        topo = convert_matrix(dem,1,Ny,1,Nx);
+    // the flow direction grid and routing order live in the caller's buffers when they are given
+    dirbuf = dirout ? NULL : cvector(0,Ncells-1);
+    flowdir = dirout ? dirout : dirbuf;
+    order = orderout;
+    orderbuf = NULL;
+    donors = NULL;
+    area = NULL;
+    nwords = (Ncells+63)/64;
+    valid = (uint64_t *)calloc(nwords,sizeof(uint64_t));
+    if (!valid) nrerror("allocation failure in allocatearrays()");
+    idown=ivector(1,Ny);
+    iup=ivector(1,Ny);
+    jup=ivector(1,Nx);
+    jdown=ivector(1,Nx);
+}
+
+static void validcells(float *z, cellindex *ord, long nord)
+/* the valid cell mask and nvalid, from the DEM z (the cells that aren't NoData; hydrocorrection never changes them)
+   or, for a stored topology, from the nord cells of its routing order ord */
+{
+    long k,t,w;
+    uint64_t bits;
+
+    if (z)
+        for (w=0;w<nwords;w++)
+        {
+            bits=0;
+            for (k=64*w;(k<64*(w+1))&&(k<Ncells);k++)
+                if (z[k]!=nanval) bits|=(uint64_t)1<<(k&63);
+            valid[w]=bits;
+        }
+    else
+        for (t=0;t<nord;t++)
+            SETVALID(ord[t]);
+    for (nvalid=w=0;w<nwords;w++)
+        nvalid+=__builtin_popcountll(valid[w]);
+}
+
+static long skipnodata(long k)
+/* the first valid cell at or after k, or Ncells if there is none, a mask word at a time (see nextvalid) */
+{
+    long w=k>>6;
+    uint64_t bits;
+
+    if (k>=Ncells) return Ncells;
+    bits=valid[w]&(~(uint64_t)0<<(k&63));
+    while (!bits)
+    {
+        if (++w>=nwords) return Ncells;
+        bits=valid[w];
+    }
+    return 64*w+__builtin_ctzll(bits);
+}
+
+static inline long nextvalid(long k)
+/* the first valid cell at or after k, or Ncells if there is none; a word of 64 NoData cells is skipped in one test,
+   so for (k=nextvalid(0);k<Ncells;k=nextvalid(k+1)) visits the valid cells in raster order */
+{
+    return ((k<Ncells)&&ISVALID(k)) ? k : skipnodata(k);
+}
+
+static void fillnodata(float *buf, long nv)
+/* nodata in the nv values of every NoData cell of the caller's grid buf, leaving the valid cells to be written */
+{
+    long k,e,j;
+
+    for (k=0;k<Ncells;k=e+1)
+    {
+        e=nextvalid(k);
+        for (j=k*nv;j<e*nv;j++)
+            buf[j]=nanval;
+    }
+}
+
+static void freetopo()
+/* the elevations aren't needed once the flow directions are known */
+{
+    if (!topo) return;
+    if (topocopy) free_matrix(topo,1,Ny,1,Nx);
+    else free_convert_matrix(topo,1,Ny,1,Nx);
+    topo = NULL;
+}
+
+static void allocaterouting(float *areaout)
+/* the routing order of the valid cells (unless it is the caller's), the donor bit masks and the contributing area:
+   in areaout when it is given, otherwise only when there is something to route. the donor masks and our own area
+   are grids that are only ever touched at valid cells, so the pages that only cover NoData never take up memory */
+{
+    if (!order) order = orderbuf = cellvector(0,nvalid-1);
+    donors = zero_cvector(0,Ncells-1);
+    ownarea = !areaout && acc;
+    area = areaout ? areaout : (acc ? vector(0,Ncells-1) : NULL);
+}
+
+static void freearrays()
+{
+    freetopo();
+    if (area && ownarea) free_vector(area,0,Ncells-1);
+    if (dirbuf) free_cvector(dirbuf,0,Ncells-1);
+    if (orderbuf) free_cellvector(orderbuf,0,nvalid-1);
+    if (donors) free_cvector(donors,0,Ncells-1);
+    free(valid);
+    free_ivector(idown,1,Ny);
+    free_ivector(iup,1,Ny);
+    free_ivector(jdown,1,Nx);
+    free_ivector(jup,1,Nx);
+}
+
+static void fillinpitsandflats(int i, int j)
+{
+    float min,fillincrement;
+
+    fillincrement=0.01;
+    if ((i>1)&&(j>1)&&(i<Ny)&&(j<Nx)&&topo[i][j]!=nanval)
+    {
+        min=topo[i][j];
+        if (topo[iup[i]][j]<min) min=topo[iup[i]][j];
+        if (topo[idown[i]][j]<min) min=topo[idown[i]][j];
+        if (topo[i][jup[j]]<min) min=topo[i][jup[j]];
+        if (topo[i][jdown[j]]<min) min=topo[i][jdown[j]];
+        if (topo[iup[i]][jup[j]]<min) min=topo[iup[i]][jup[j]];
+        if (topo[idown[i]][jup[j]]<min) min=topo[idown[i]][jup[j]];
+        if (topo[idown[i]][jdown[j]]<min) min=topo[idown[i]][jdown[j]];
+        if (topo[iup[i]][jdown[j]]<min) min=topo[iup[i]][jdown[j]];
+        if (topo[i][j]<=min)
+        {
+            // The node's a pit or flat, increment its elevation and push all neighbor nodes
+            topo[i][j]=min+fillincrement;
+            fillsteps++;
+            if (++filldepth>fillpeak) fillpeak=filldepth;
+            fillinpitsandflats(i,j);
+            fillinpitsandflats(iup[i],j);
+            fillinpitsandflats(idown[i],j);
+            fillinpitsandflats(i,jup[j]);
+            fillinpitsandflats(i,jdown[j]);
+            fillinpitsandflats(iup[i],jup[j]);
+            fillinpitsandflats(idown[i],jup[j]);
+            fillinpitsandflats(idown[i],jdown[j]);
+            fillinpitsandflats(iup[i],jdown[j]);
+            filldepth--;
+        }
+    }
+}
+
+static int calculated8drainagedirections(int i, int j)
+{
+    float down,oneoversqrt2;
+    int flowdir;
+
+    oneoversqrt2=0.707106781186; // diagonal neighbors are a distance of sqrt(2) further away then non-diagonals; therefore need to divide by sqrt(2)
+    down=0.0;
+    flowdir=0;
+    if (oneoversqrt2*(topo[iup[i]][jdown[j]]-topo[i][j])<down)
+    {
+        down=oneoversqrt2*(topo[iup[i]][jdown[j]]-topo[i][j]);
+        flowdir=1;
+    }
+    if (topo[iup[i]][j]-topo[i][j]<down)
+    {
+        down=(topo[iup[i]][j]-topo[i][j]);
+        flowdir=2;
+    }
+    if (oneoversqrt2*(topo[iup[i]][jup[j]]-topo[i][j])<down)
+    {
+        down=oneoversqrt2*(topo[iup[i]][jup[j]]-topo[i][j]);
+        flowdir=4;
+    }
+    if (topo[i][jup[j]]-topo[i][j]<down)
+    {
+        down=(topo[i][jup[j]]-topo[i][j]);
+        flowdir=8;
+    }
+    if (oneoversqrt2*(topo[idown[i]][jup[j]]-topo[i][j])<down)
+    {
+        down=oneoversqrt2*(topo[idown[i]][jup[j]]-topo[i][j]);
+        flowdir=16;
+    }
+    if (topo[idown[i]][j]-topo[i][j]<down)
+    {
+        down=(topo[idown[i]][j]-topo[i][j]);
+        flowdir=32;
+    }
+    if (oneoversqrt2*(topo[idown[i]][jdown[j]]-topo[i][j])<down)
+    {
+        down=oneoversqrt2*(topo[idown[i]][jdown[j]]-topo[i][j]);
+        flowdir=64;
+    }
+    if (topo[i][jdown[j]]-topo[i][j]<down)
+    {
+        down=(topo[i][jdown[j]]-topo[i][j]);
+        flowdir=128;
+    }
+    return flowdir;
+}
+
+static int d8directions()
+/* D8 flow direction code of every valid interior cell (see calculated8drainagedirections); border and NoData cells
+   don't route flow and get 0 */
+{
+    int i,j;
+    long k;
+    unsigned char d;
+
+    memset(flowdir,0,Ncells);
+    for (i=2;i<Ny;i++)
+        for (k=nextvalid((i-1)*Nx+1);k<i*Nx-1;k=nextvalid(k+1))
+        {
+            j=k-(i-1)*Nx+1;
+            d=calculated8drainagedirections(i,j);
+            if (d==0) return UPSTREAM_ERR_PIT;
+            flowdir[k]=d;
+        }
+    return UPSTREAM_OK;
+}
+
+static int dirindex(unsigned char code)
+/* d such that code==1<<d, or -1 for cells that don't route flow */
+{
+    int d;
+
+    for (d=0;d<8;d++)
+        if (code==(1<<d)) return d;
+    return -1;
+}
+
+static void setupdonors(unsigned char *indeg)
+/* bit d of donors[k] is set when the neighbor k-flowoffset[d] drains into the valid cell k; indeg (if not NULL) gets
+   the number of donors of each valid cell. both start out zeroed and are only touched at valid cells */
+{
+    long k,r;
+    int d;
+
+    for (k=nextvalid(0);k<Ncells;k=nextvalid(k+1))
+        if ((d=dirindex(flowdir[k]))>=0)
+        {
+            r=k+flowoffset[d];
+            if (!ISVALID(r)) continue;
+            donors[r]|=1<<d;
+            if (indeg) indeg[r]++;
+        }
+}
+
+static void routingorder()
+/* Kahn's algorithm on the D8 graph: order[0..norder-1] lists every valid cell after all of the cells that drain into
+   it */
+{
+    long k,r,head;
+    int d;
+    unsigned char *indeg;
+
+    indeg = zero_cvector(0,Ncells-1);
+    setupdonors(indeg);
+
+    // sources first, then every cell as soon as its last donor has been ordered; order doubles as the FIFO queue
+    norder=0;
+    for (k=nextvalid(0);k<Ncells;k=nextvalid(k+1))
+        if (indeg[k]==0)
+            order[norder++]=k;
+    for (head=0;head<norder;head++)
+    {
+        k=order[head];
+        if ((d=dirindex(flowdir[k]))>=0)
+        {
+            r=k+flowoffset[d];
+            if (ISVALID(r)&&(--indeg[r]==0))
+                order[norder++]=r;
+        }
+    }
+    free_cvector(indeg,0,Ncells-1);
+}
+
+static void accumulate(cellindex *ord, long t0, long t1)
+/* upstream sums of dx*dx*arr for every variable and the contributing area of the cells ord[t0..t1-1], pulled from
+   the donors of each cell; every donor must already be done (earlier in ord or in an earlier call) */
+{
+    long t,k,n,v;
+    int d;
+    float *ak,*an,*ar=area;
+
+    for (t=t0;t<t1;t++)
+    {
+        k=ord[t];
+        ak=&acc[k*nvar];
+        for (v=0;v<nvar;v++)
+            ak[v]=dx*dx*arr[k*nvar+v];
+        ar[k]=dx*dx;  // contributing area (m^2)
+        if (donors[k])
+            for (d=0;d<8;d++)
+                if (donors[k]&(1<<d))
+                {
+                    n=k-flowoffset[d];
+                    an=&acc[n*nvar];
+                    for (v=0;v<nvar;v++)
+                        ak[v]+=an[v];
+                    ar[k]+=ar[n];
+                }
+    }
+}
+
+static int compareunits(const void *a, const void *b)
+/* work units ([start,end) pairs) by decreasing size */
+{
+    const cellindex *ua=a,*ub=b;
+    cellindex sa=ua[1]-ua[0],sb=ub[1]-ub[0];
+
+    return (sa<sb)-(sa>sb);
+}
+
+static long basinunits(cellindex *sorted, cellindex *units)
+/* sorted gets the routing order regrouped so the cells of each outlet basin are contiguous (and still upstream to
+   downstream), units the [start,end) ranges of sorted that make up the parallel work units: whole basins, merged
+   until a unit holds at least 1/(8*nthreads) of the cells, largest first so the big basins start early.
+   units needs room for 2*(8*nthreads+1) entries; returns the number of units */
+{
+    long t,k,r,b,nbasins,nunits,target;
+    int d;
+    cellindex *basin,*start;
+
+    // basin is a grid that is only touched at valid cells; the basins are numbered as their outlets are met, so the
+    // counting sort needs one entry per basin, not per cell
+    basin = cellvector(0,Ncells-1);
+    start = cellvector(0,norder);
+
+    // basin of every valid cell, labeled from downstream to upstream so each cell copies its receiver's basin; a
+    // cell that doesn't route flow or drains into NoData is an outlet and starts a new basin
+    nbasins=0;
+    for (t=norder-1;t>=0;t--)
+    {
+        k=order[t];
+        d=dirindex(flowdir[k]);
+        r=(d>=0) ? k+flowoffset[d] : k;
+        basin[k]=((d<0)||!ISVALID(r)) ? nbasins++ : basin[r];
+    }
+
+    // stable counting sort of the routing order by basin
+    memset(start,0,(nbasins+1)*sizeof(cellindex));
+    for (t=0;t<norder;t++)
+        start[basin[order[t]]+1]++;
+    for (b=0;b<nbasins;b++)
+        start[b+1]+=start[b];
+    for (t=0;t<norder;t++)
+    {
+        k=order[t];
+        sorted[start[basin[k]]++]=k;
+    }
+
+    // cut the regrouped order into units at basin boundaries
+    target=norder/(8*nthreads)+1;
+    nunits=0;
+    units[0]=0;
+    for (t=1;t<=norder;t++)
+        if ((t==norder)||((t-units[2*nunits]>=target)&&(basin[sorted[t]]!=basin[sorted[t-1]])))
+        {
+            units[2*nunits+1]=t;
+            nunits++;
+            if (t<norder) units[2*nunits]=t;
+        }
+    qsort(units,nunits,2*sizeof(cellindex),compareunits);
+
+    free_cellvector(basin,0,Ncells-1);
+    free_cellvector(start,0,norder);
+    return nunits;
+}
+
+static void flowrouting()
+/* upstream sums of dx*dx*arr for every variable and the contributing area, in topological order or basin by basin
+   in parallel */
+{
+    long u,nunits;
+    cellindex *sorted,*units;
+
+    if ((nthreads<=1)||(norder==0))
+    {
+        accumulate(order,0,norder);
+        return;
+    }
+    sorted = cellvector(0,norder-1);
+    units = cellvector(0,2*(8*nthreads+1)-1);
+    nunits = basinunits(sorted,units);
+    #pragma omp parallel for schedule(dynamic,1) num_threads(nthreads)
+    for (u=0;u<nunits;u++)
+        accumulate(sorted,units[2*u],units[2*u+1]);
+    free_cellvector(sorted,0,norder-1);
+    free_cellvector(units,0,2*(8*nthreads+1)-1);
+}
+
+static void normalizeupstreamsum(float *avg)
+/* the upstream sums divided by the contributing area, in place (avg==acc) or into a separate buffer whose NoData
+   cells are set to NoData */
+{
+    long t,k,v;
+    float *ar=area;
+
+    if (avg!=acc)
+        fillnodata(avg,nvar);
+    #pragma omp parallel for private(k,v) num_threads(nthreads) if(nthreads>1)
+    for (t=0;t<norder;t++)
+    {
+        k=order[t];
+        if (ar[k]>0.0)  // check on area probably not necessary but leaving it just to be sure...
+            for (v=0;v<nvar;v++)
+                avg[k*nvar+v]=acc[k*nvar+v]/ar[k];
+        else if (avg!=acc)
+            for (v=0;v<nvar;v++)
+                avg[k*nvar+v]=acc[k*nvar+v];
+    }
+}
+
+static void flowterminals(long *terminal)
+/* for every valid cell, the index of the cell its flow path ends in (a cell that doesn't route flow), or -1 if the
+   path runs into NoData; filled from downstream to upstream so each cell copies its receiver's terminal */
+{
+    long t,k,r,e;
+    int d;
+
+    for (k=0;k<Ncells;k=e+1)
+        for (e=nextvalid(k);k<e;k++)
+            terminal[k]=-1;
+    for (t=norder-1;t>=0;t--)
+    {
+        k=order[t];
+        if ((d=dirindex(flowdir[k]))<0)
+            terminal[k]=k;
+        else
+        {
+            r=k+flowoffset[d];
+            terminal[k]=ISVALID(r) ? terminal[r] : -1;
+        }
+    }
+}
+
+static void recomputecell(long k, float *avg)
+/* the upstream sums of cell k pulled from its donors exactly as accumulate does (the donors must be up to date), and
+   its average if avg is given */
+{
+    long n,v;
+    int d;
+    float *ak=&acc[k*nvar],*an,*ar;
+
+    for (v=0;v<nvar;v++)
+        ak[v]=dx*dx*arr[k*nvar+v];
+    for (d=0;d<8;d++)
+    {
+        n=k-flowoffset[d];
+        if ((n>=0)&&(n<Nx*Ny)&&(flowdir[n]==(1<<d)))
+        {
+            an=&acc[n*nvar];
+            for (v=0;v<nvar;v++)
+                ak[v]+=an[v];
+        }
+    }
+    if (avg)
+    {
+        ar=area;
+        for (v=0;v<nvar;v++)
+            avg[k*nvar+v]=(ar[k]>0.0) ? ak[v]/ar[k] : ak[v];
+    }
+}
+
+static long downstreamcells(float *z, cellindex *changed, long nchanged, unsigned char *state, cellindex *cells)
+/* the valid cells in changed and every valid cell downstream of them, listed in cells and flagged AFFECTED in state;
+   each flow path is followed until it leaves the grid's valid cells or joins one already listed, so the cost is
+   the size of the union of the paths. returns the number of cells */
+{
+    long c,k,ncells=0;
+    int d;
+
+    for (c=0;c<nchanged;c++)
+        for (k=changed[c];(z[k]!=nanval)&&!(state[k]&AFFECTED);k+=flowoffset[d])
+        {
+            state[k]|=AFFECTED;
+            cells[ncells++]=k;
+            if ((d=dirindex(flowdir[k]))<0) break;
+        }
+    return ncells;
+}
+
+static void initnodata()
+/* NoData cells neither route nor receive flow; every valid cell is in the routing order and gets overwritten, so
+   only the NoData cells of the caller's grids are set here (our own area is never read there) */
+{
+    if (nvar) fillnodata(acc,nvar);
+    if (area && !ownarea) fillnodata(area,1);
+}
+
+static void hydrocorrect(float *dem, int fillmode, float epsilon)
+/* the recursive fill is started from every valid cell in raster order (starting it from a NoData cell does nothing,
+   so this is the fill it always was) */
+{
+    long k,raised,heappeak,queuepeak;
+    float *z=&topo[1][1];
+
+    if (fillmode==FILL_RECURSIVE)
+    {
+        fillsteps=filldepth=fillpeak=0;
+        for (k=nextvalid(0);k<Ncells;k=nextvalid(k+1))
+            fillinpitsandflats(k/Nx+1,k%Nx+1);
+        if (callback)
+        {
+            for (raised=0,k=nextvalid(0);k<Ncells;k=nextvalid(k+1))
+                if (z[k]!=dem[k]) raised++;
+            emit("{\"event\":\"fill\",\"call\":\"%s\",\"mode\":\"recursive\",\"raised\":%ld,\"iterations\":%ld,"
+                 "\"stack_peak\":%ld}",callname,raised,fillsteps,fillpeak);
+        }
+    }
+    else if (fillmode==FILL_PRIORITYFLOOD)
+    {
+        raised=priorityflood(z,Nx,Ny,nanval,epsilon);
+        priorityfloodpeaks(&heappeak,&queuepeak);
+        emit("{\"event\":\"fill\",\"call\":\"%s\",\"mode\":\"priorityflood\",\"raised\":%ld,\"heap_peak\":%ld,"
+             "\"queue_peak\":%ld}",callname,raised,heappeak,queuepeak);
+    }
+}
+
+int setthreads(int n)
+/* number of threads used to accumulate flow (0 for all available cores); without OpenMP everything runs on one.
+   returns the number that will be used */
+{
+#ifdef _OPENMP
+    nthreads=(n>0) ? n : omp_get_max_threads();
+#else
+    nthreads=1;
+#endif
+    return nthreads;
+}
+
+int setcallback(upstreamcallback cb)
+/* report events to cb from now on (NULL to stop); see the top of this file for the events */
+{
+    callback=cb;
+    return UPSTREAM_OK;
+}
+
+int stagetimes(double *times)
+/* wall clock seconds the last call of an entry point spent in each stage (STAGE_* in upstreamcore.h) written to
+   times; returns NSTAGES */
+{
+    memcpy(times,stagetime,sizeof(stagetime));
+    return NSTAGES;
+}
+
+static int products(const char *name, float *dem, float *var, long nx, long ny, long nv, float d, float nodata,
+                    int fillmode, float epsilon, float *areaout, float *sumout, float *avgout, float *filled,
+                    unsigned char *dirout)
+{
+    int status;
+
+    Nx=nx;
+    Ny=ny;
+    nvar=(sumout || avgout) ? nv : 0;
+    dx=d;
+    nanval=nodata;
+
+    callbegin(name);
+
+    // Array memory allocation; the sums are accumulated in sumout, or in avgout and normalized there. the DEM is
+    // hydrocorrected straight into filled when it is given, and otherwise only copied if it is hydrocorrected
+    if (filled && (filled!=dem)) memcpy(filled,dem,Nx*Ny*sizeof(float));
+    allocatearrays(filled ? filled : dem,!filled && (fillmode!=FILL_NONE),var,sumout ? sumout : avgout,dirout,NULL);
+    setupgridneighbors();
+
+    // Hydrocorrection of the valid cells
+    stagebegin(STAGE_HYDROCORRECT);
+    validcells(dem,NULL,0);
+    hydrocorrect(dem,fillmode,epsilon);
+    stageend(STAGE_HYDROCORRECT,nvalid);
+
+    // Flow directions and topological routing order
+    stagebegin(STAGE_DIRECTIONS);
+    status=d8directions();
+    freetopo();
+    stageend(STAGE_DIRECTIONS,nvalid);
+    if ((status==UPSTREAM_OK)&&(areaout || acc))
+    {
+        allocaterouting(areaout);
+        initnodata();
+        stagebegin(STAGE_ORDER);
+        routingorder();
+        stageend(STAGE_ORDER,norder);
+
+        // Route flow
+        stagebegin(STAGE_ROUTE);
+        flowrouting();
+        stageend(STAGE_ROUTE,norder);
+
+        // Normalize by drainage area
+        stagebegin(STAGE_NORMALIZE);
+        if (avgout)
+            normalizeupstreamsum(avgout);
+        stageend(STAGE_NORMALIZE,avgout ? norder : 0);
+    }
+
+    // Free array allocations
+    freearrays();
+
+    return callend(status);
+}
+
+int upstreamproducts(float *dem, float *var, long nx, long ny, long nv, float d, float nodata, int fillmode,
+                     float epsilon, float *areaout, float *sumout, float *avgout, float *filled, unsigned char *dirout)
+/* any combination of the upstream products of dem (a row-major ny*nx array, left untouched) from a single
+   hydrocorrection, ordering and routing pass; each output may be NULL and is skipped then:
+    areaout  ny*nx contributing area (d*d per upstream cell)
+    sumout   ny*nx*nv upstream sum of d*d times the nv pixel-interleaved variables in var
+    avgout   ny*nx*nv upstream sum divided by the contributing area
+    filled   ny*nx hydrocorrected DEM (may be dem itself to fill it in place)
+    dirout   ny*nx D8 flow direction grid
+   NoData cells are nodata in the float outputs. var is only read when sumout or avgout is given; fillmode and
+   epsilon are as in upstreamavg */
+{
+    return products("upstreamproducts",dem,var,nx,ny,nv,d,nodata,fillmode,epsilon,areaout,sumout,avgout,filled,
+                    dirout);
+}
+
+int upstreamavg(float *dem, float *var, float *out, long nx, long ny, long nv, float d, float nodata, int flg_avg,
+                int fillmode, float epsilon, unsigned char *dirout)
+/* upstream sum (flg_avg=0) or area-normalized upstream average (flg_avg=1) of the nv pixel-interleaved variables in
+   var over dem, written to out; dem is a row-major ny*nx array and is left untouched, var and out are ny*nx*nv.
+   fillmode selects the hydrocorrection (FILL_NONE, FILL_RECURSIVE or FILL_PRIORITYFLOOD) and epsilon is the
+   priority-flood flat gradient.
+   if dirout is not NULL the ny*nx D8 flow direction grid is written to it as well */
+{
+    return products("upstreamavg",dem,var,nx,ny,nv,d,nodata,fillmode,epsilon,NULL,flg_avg ? NULL : out,
+                    flg_avg ? out : NULL,NULL,dirout);
+}
+
+int routegrid(float *dem, float *init, float *sums, long nx, long ny, long nv, float nodata, unsigned char *dirout,
+              long *terminal)
+/* low-level routing over an already hydrocorrected dem: every valid cell starts from its nv pixel-interleaved values
+   in init (already scaled to the quantity being summed, e.g. multiplied by the cell area) and sums gets the upstream
+   totals. cells on the grid border receive flow but don't route it, which lets a tile padded with a one-cell halo
+   of its neighbors be routed on its own. terminal (may be NULL) gets the flat index of the cell each flow path ends
+   in (see flowterminals) and dirout (may be NULL) the flow direction grid */
+{
+    int status;
+
+    Nx=nx;
+    Ny=ny;
+    nvar=nv;
+    dx=1.0;  // init is already scaled
+    nanval=nodata;
+
+    callbegin("routegrid");
+    allocatearrays(dem,0,init,sums,dirout,NULL);
+    setupgridneighbors();
+
+    stagebegin(STAGE_DIRECTIONS);
+    validcells(dem,NULL,0);
+    status=d8directions();
+    freetopo();
+    stageend(STAGE_DIRECTIONS,nvalid);
+    if (status==UPSTREAM_OK)
+    {
+        allocaterouting(NULL);
+        initnodata();
+        stagebegin(STAGE_ORDER);
+        routingorder();
+        stageend(STAGE_ORDER,norder);
+        stagebegin(STAGE_ROUTE);
+        flowrouting();
+        if (terminal)
+            flowterminals(terminal);
+        stageend(STAGE_ROUTE,norder);
+    }
+
+    freearrays();
+
+    return callend(status);
+}
+
+int flowtopology(float *dem, long nx, long ny, float nodata, int fillmode, float epsilon, float *filled,
+                 unsigned char *dirout, cellindex *orderout, long *norderout)
+/* everything upstream averaging needs that depends only on the DEM: the hydrocorrected DEM (filled, may be NULL),
+   the D8 flow direction grid (dirout) and the topological routing order of the valid cells (orderout, room for
+   nx*ny entries, of which *norderout are used). these can be stored and reused with routetopology */
+{
+    int status;
+
+    Nx=nx;
+    Ny=ny;
+    nvar=0;
+    nanval=nodata;
+
+    callbegin("flowtopology");
+    // hydrocorrect straight into filled when it is given
+    if (filled && (filled!=dem)) memcpy(filled,dem,Nx*Ny*sizeof(float));
+    allocatearrays(filled ? filled : dem,!filled && (fillmode!=FILL_NONE),NULL,NULL,dirout,orderout);
+    setupgridneighbors();
+    stagebegin(STAGE_HYDROCORRECT);
+    validcells(dem,NULL,0);
+    hydrocorrect(dem,fillmode,epsilon);
+    stageend(STAGE_HYDROCORRECT,nvalid);
+
+    stagebegin(STAGE_DIRECTIONS);
+    status=d8directions();
+    freetopo();
+    stageend(STAGE_DIRECTIONS,nvalid);
+    if (status==UPSTREAM_OK)
+    {
+        allocaterouting(NULL);
+        stagebegin(STAGE_ORDER);
+        routingorder();
+        stageend(STAGE_ORDER,norder);
+    }
+    *norderout=(status==UPSTREAM_OK) ? norder : 0;
+
+    freearrays();
+
+    return callend(status);
+}
+
+int routetopology(unsigned char *dir, cellindex *ord, long nord, float *var, float *out, long nx, long ny, long nv, float d,
+                  float nodata, int flg_avg)
+/* the accumulation stage of upstreamavg on a topology from flowtopology: no hydrocorrection, direction or ordering
+   work is repeated. cells missing from the routing order are NoData */
+{
+    Nx=nx;
+    Ny=ny;
+    nvar=nv;
+    dx=d;
+    nanval=nodata;
+
+    callbegin("routetopology");
+    allocatearrays(NULL,0,var,out,dir,ord);
+    norder=nord;
+    validcells(NULL,ord,nord);
+    setupgridneighbors();
+    allocaterouting(NULL);
+    initnodata();
+
+    stagebegin(STAGE_ROUTE);
+    setupdonors(NULL);
+    flowrouting();
+    stageend(STAGE_ROUTE,norder);
+    stagebegin(STAGE_NORMALIZE);
+    if (flg_avg)
+        normalizeupstreamsum(acc);
+    stageend(STAGE_NORMALIZE,flg_avg ? norder : 0);
+
+    freearrays();
+
+    return callend(UPSTREAM_OK);
+}
+
+int updatetopology(unsigned char *dir, float *dem, float *var, float *sums, long nx, long ny, long nv, float d,
+                   float nodata, cellindex *changed, long nchanged, float *areain, float *avg, cellindex *affected,
+                   long *naffected)
+/* incremental routetopology after the variables in var changed at the nchanged cells listed in changed. sums holds
+   the upstream sums of an earlier run over the same topology (routetopology with flg_avg=0 or upstreamproducts) and
+   is updated in place: only the cells downstream of a changed cell are recomputed, each pulling its donors as
+   flowrouting does, so the result is bit-identical to routing the whole grid again. dem is nodata exactly at the
+   NoData cells (e.g. the filled DEM of the topology). if avg is not NULL the averages of the recomputed cells are
+   written to it, from the contributing area in areain. affected (room for nx*ny entries) gets the *naffected
+   recomputed cells in routing order */
+{
+    long t,k,r,head,ncells;
+    int dr;
+    unsigned char *state;
+    cellindex *queue;
+
+    Nx=nx;
+    Ny=ny;
+    nvar=nv;
+    dx=d;
+    nanval=nodata;
+    flowdir=dir;
+    arr=var;
+    acc=sums;
+    area=avg ? areain : NULL;
+    setupflowoffsets();
+
+    callbegin("updatetopology");
+    stagebegin(STAGE_ORDER);
+    // low bits of state: number of affected donors not yet recomputed
+    state = zero_cvector(0,Nx*Ny-1);
+    ncells=downstreamcells(dem,changed,nchanged,state,affected);
+    for (t=0;t<ncells;t++)
+        if ((dr=dirindex(flowdir[affected[t]]))>=0)
+        {
+            r=affected[t]+flowoffset[dr];
+            if (state[r]&AFFECTED) state[r]++;
+        }
+    stageend(STAGE_ORDER,ncells);
+
+    // Kahn's algorithm restricted to the affected cells, recomputing each one as soon as its donors are done
+    stagebegin(STAGE_ROUTE);
+    queue = cellvector(0,ncells);
+    for (head=t=0;t<ncells;t++)
+        if (state[affected[t]]==AFFECTED)
+            queue[head++]=affected[t];
+    for (t=0;t<head;t++)
+    {
+        k=queue[t];
+        recomputecell(k,avg);
+        if ((dr=dirindex(flowdir[k]))>=0)
+        {
+            r=k+flowoffset[dr];
+            if ((state[r]&AFFECTED)&&(--state[r]==AFFECTED))
+                queue[head++]=r;
+        }
+    }
+    memcpy(affected,queue,ncells*sizeof(cellindex));
+    *naffected=ncells;
+    stageend(STAGE_ROUTE,ncells);
+
+    free_cellvector(queue,0,ncells);
+    free_cvector(state,0,Nx*Ny-1);
+    area=NULL;
+
+    return callend(UPSTREAM_OK);
+}
+
+int flowintervals(unsigned char *dir, cellindex *ord, long nord, long nx, long ny, cellindex *first,
+                  cellindex *count)
+/* depth-first interval labels of the D8 flow forest of a topology from flowtopology (each valid cell's parent is the
+   cell it drains into, unless that is NoData): a cell and everything upstream of it are the count[k] consecutive
+   positions of a pre-order walk from the outlets that start at first[k], so upstream totals are differences of two
+   prefix sums over the walk. NoData cells get first=-1 and count=0 */
+{
+    long t,k,r,next;
+    int d;
+    cellindex *cursor;
+
+    Nx=nx;
+    Ny=ny;
+    nvar=0;
+    flowdir=dir;
+    setupflowoffsets();
+
+    callbegin("flowintervals");
+    stagebegin(STAGE_ROUTE);
+    for (k=0;k<Nx*Ny;k++)
+    {
+        first[k]=-1;
+        count[k]=0;
+    }
+    for (t=0;t<nord;t++)
+        count[ord[t]]=1;
+    // upstream cell counts, upstream to downstream
+    for (t=0;t<nord;t++)
+    {
+        k=ord[t];
+        if (((d=dirindex(flowdir[k]))>=0)&&(count[r=k+flowoffset[d]]>0))
+            count[r]+=count[k];
+    }
+
+    // walk positions, downstream to upstream: an outlet starts a new run, and every other cell takes the next free
+    // position after its receiver and the donors of the receiver labeled before it
+    cursor = cellvector(0,Nx*Ny-1);
+    next=0;
+    for (t=nord-1;t>=0;t--)
+    {
+        k=ord[t];
+        if (((d=dirindex(flowdir[k]))>=0)&&(count[r=k+flowoffset[d]]>0))
+        {
+            first[k]=cursor[r];
+            cursor[r]+=count[k];
+        }
+        else
+        {
+            first[k]=next;
+            next+=count[k];
+        }
+        cursor[k]=first[k]+1;
+    }
+    free_cellvector(cursor,0,Nx*Ny-1);
+    stageend(STAGE_ROUTE,nord);
+
+    return callend(UPSTREAM_OK);
+}
+
+int catchmentlabels(unsigned char *dir, cellindex *ord, long nord, long nx, long ny, cellindex *outlets,
+                    long noutlets, int *labels)
+/* catchment label raster of noutlets outlet cells from a topology from flowtopology: every cell gets the number
+   (1..noutlets, in the order of outlets) of the first outlet its flow path reaches, itself included, or 0 if the
+   path reaches none (and NoData cells, outlets on NoData included). one pass over the routing order from downstream
+   to upstream, in which each cell copies its receiver's label; a cell listed twice keeps its last number */
+{
+    long t,k,o;
+    int d;
+
+    Nx=nx;
+    Ny=ny;
+    nvar=0;
+    flowdir=dir;
+    setupflowoffsets();
+
+    callbegin("catchmentlabels");
+    stagebegin(STAGE_ROUTE);
+    memset(labels,0,Nx*Ny*sizeof(int));
+    // the valid cells are the ones in the routing order; mark them -1 (unlabeled) so outlets on NoData are skipped
+    for (t=0;t<nord;t++)
+        labels[ord[t]]=-1;
+    for (o=0;o<noutlets;o++)
+        if (labels[outlets[o]]) labels[outlets[o]]=o+1;
+    // only outlets are labeled before their turn, and a NoData receiver is never labeled
+    for (t=nord-1;t>=0;t--)
+    {
+        k=ord[t];
+        if (labels[k]==-1)
+            labels[k]=((d=dirindex(flowdir[k]))>=0) ? labels[k+flowoffset[d]] : 0;
+    }
+    stageend(STAGE_ROUTE,nord);
+
+    return callend(UPSTREAM_OK);
+}
@@ -0,0 +1,52 @@
+#ifndef UPSTREAMCORE_H
+#define UPSTREAMCORE_H
+
+#define UPSTREAM_OK 0
+#define UPSTREAM_ERR_PIT 1
+
+// hydrocorrection modes
+#define FILL_NONE 0  // DEM is already hydrocorrected
+#define FILL_RECURSIVE 1  // recursive 0.01 m pit and flat filling
+#define FILL_PRIORITYFLOOD 2  // heap-based priority-flood with epsilon flat gradient (see priorityflood.c)
+
+// flat cell index of the routing order: 32-bit, or 64-bit when compiled with -DUPSTREAM_LARGE (needed for rasters
+// of 2^31 cells or more; 64-bit on the LP64 platforms the library is built on)
+#ifdef UPSTREAM_LARGE
+typedef long cellindex;
+#else
+typedef int cellindex;
+#endif
+
+// stages timed by every entry point (see stagetimes)
+#define STAGE_HYDROCORRECT 0
+#define STAGE_DIRECTIONS 1
+#define STAGE_ORDER 2
+#define STAGE_ROUTE 3
+#define STAGE_NORMALIZE 4
+#define NSTAGES 5
+
+// receives every instrumentation event as a JSON object (see setcallback and the top of upstreamcore.c)
+typedef void (*upstreamcallback)(const char *event);
+
+int setthreads(int n);
+int setcallback(upstreamcallback cb);
+int stagetimes(double *times);
+int upstreamavg(float *dem, float *var, float *out, long nx, long ny, long nv, float d, float nodata, int flg_avg,
+                int fillmode, float epsilon, unsigned char *dirout);
+int upstreamproducts(float *dem, float *var, long nx, long ny, long nv, float d, float nodata, int fillmode,
+                     float epsilon, float *areaout, float *sumout, float *avgout, float *filled, unsigned char *dirout);
+int routegrid(float *dem, float *init, float *sums, long nx, long ny, long nv, float nodata, unsigned char *dirout,
+              long *terminal);
+int flowtopology(float *dem, long nx, long ny, float nodata, int fillmode, float epsilon, float *filled,
+                 unsigned char *dirout, cellindex *orderout, long *norderout);
+int routetopology(unsigned char *dir, cellindex *ord, long nord, float *var, float *out, long nx, long ny, long nv, float d,
+                  float nodata, int flg_avg);
+int updatetopology(unsigned char *dir, float *dem, float *var, float *sums, long nx, long ny, long nv, float d,
+                   float nodata, cellindex *changed, long nchanged, float *areain, float *avg, cellindex *affected,
+                   long *naffected);
+int flowintervals(unsigned char *dir, cellindex *ord, long nord, long nx, long ny, cellindex *first,
+                  cellindex *count);
+int catchmentlabels(unsigned char *dir, cellindex *ord, long nord, long nx, long ny, cellindex *outlets,
+                    long noutlets, int *labels);
+
+#endif /* UPSTREAMCORE_H*/
@@ -1,21 +1,40 @@
 """
 Handles tiff i/o and translates them to/from flt32 files. Wrapper for upstream averaging in c.
+
+The default path reads the rasters into NumPy arrays and runs the C core in-process through upstreamlib; the
+flt/subprocess helpers are kept for running the standalone upstreamavg.exe.
+
+Progress (file reads and writes, every stage of the engine and how long it took) is logged through the
+'upstream.progress' logger, and the full instrumentation events go to EVENT_LOG as JSON lines when it is set.
 """
+import json
+import logging
 import subprocess
+import sys
+import time
 import numpy as np
 from osgeo import gdal
 import os
+from upstreamcache import TopologyCache
+from upstreamlib import (CORE_SOURCES, MAX_CELLS_32, emit_event, log_events, route_topology, set_event_callback,
+                         set_threads)
+from upstreamtiff import write_array
 
 deminfile = './data/input_DEM.tif'
 varinfile = './data/input_var.tif'
 outfile = './data/upstreamavg.tif'
-TMP_DIR = './data/tmp'
+TMP_DIR = os.environ.get('UPSTREAM_TMP_DIR', './data/tmp')  # scratch for the .flt files; one per concurrent run
 iot_dem = './data/io_test/Plainfield_DEM.tif'
 iot_var = './data/io_test/Plainfield_Slope.tif'
-DEM_FLT_INFILE = './data/tmp/input_dem.flt'
-VAR_FLT_INFILE = './data/tmp/input_var.flt'
-UPSTRMAVG_FLT_OUTFILE = './data/tmp/output.flt'
-EXECUTABLE = './data/tmp/upstreamavg.exe'
+DEM_FLT_INFILE = os.path.join(TMP_DIR, 'input_dem.flt')
+VAR_FLT_INFILE = os.path.join(TMP_DIR, 'input_var.flt')
+UPSTRMAVG_FLT_OUTFILE = os.path.join(TMP_DIR, 'output.flt')
+EXECUTABLE = os.path.join(TMP_DIR, 'upstreamavg.exe')
+FILL_MODE = 'recursive'  # hydrocorrection: 'recursive', 'priorityflood' (large DEMs) or 'none'
+CACHE_DIR = './data/cache'  # hydrocorrected DEMs and flow topologies are reused from here across runs
+THREADS = 0  # threads for flow accumulation, 0 = all cores
+COG_OUTPUT = True  # write Cloud-Optimized GeoTIFFs (tiled, compressed, with overviews) instead of plain tiled ones
+EVENT_LOG = None  # e.g. './data/upstream_events.jsonl' to keep every instrumentation event as a JSON line
 tif_tags = ['metadata', 'gt', 'proj', 'dx', 'Nx', 'Ny', 'nodata']
 source_info = {}
 
@@ -46,37 +65,80 @@ def tiff_to_flt(tiff_inf, flt_outf):
     with open(flt_outf, 'wb') as f:
         f.write(arr.astype(np.float32).tobytes())
 
+def tiff_to_array(tiff_inf):
+    """
+    Read the first band of a tiff file as a float32 array.
+    """
+    start = time.perf_counter()
+    raster = gdal.Open(tiff_inf)
+    if raster is None:
+        raise FileNotFoundError(f"Could not open TIFF file: {tiff_inf}")
+    arr = np.ascontiguousarray(raster.GetRasterBand(1).ReadAsArray(), dtype=np.float32)
+    emit_event('read', path=tiff_inf, bytes=os.path.getsize(tiff_inf), seconds=time.perf_counter() - start)
+    return arr
+
+def tiffs_to_stack(tiff_infs):
+    """
+    Read every band of one or more tiff files into a pixel-interleaved float32 array of shape (Ny, Nx, nbands), or
+    (Ny, Nx) if there is only one band in total.
+    """
+    bands = []
+    for tiff_inf in tiff_infs:
+        start = time.perf_counter()
+        raster = gdal.Open(tiff_inf)
+        if raster is None:
+            raise FileNotFoundError(f"Could not open TIFF file: {tiff_inf}")
+        bands += [raster.GetRasterBand(b + 1).ReadAsArray() for b in range(raster.RasterCount)]
+        emit_event('read', path=tiff_inf, bytes=os.path.getsize(tiff_inf), seconds=time.perf_counter() - start)
+    if len(bands) == 1:
+        return np.ascontiguousarray(bands[0], dtype=np.float32)
+    return np.stack(bands, axis=-1).astype(np.float32)
+
 def invoke_upstream(x, y, d, v, exe):
     """
-    Invoke upstreamavg.c with the given parameters.
+    Invoke upstreamavg.c with the given parameters. The JSON events it prints to stderr are passed on to the event
+    callback as they arrive; anything else on stderr is passed through. Raises CalledProcessError if it fails.
     """
-    subprocess.run(['gcc', '-o', exe, 'upstreamavg.c', 'utilities.c', '-lm', '-Wall'])
-    subprocess.run([exe, '-x', str(x), '-y', str(y), '-d', str(d), '-v', str(v)])
+    defines = ['-DUPSTREAM_LARGE'] if x * y > MAX_CELLS_32 else []
+    subprocess.run(['gcc', '-fopenmp'] + defines + ['-o', exe, 'upstreamavg.c'] + CORE_SOURCES + ['-lm', '-Wall'],
+                   check=True)
+    proc = subprocess.Popen([exe, '-x', str(x), '-y', str(y), '-d', str(d), '-v', str(v), '-j'],
+                            stderr=subprocess.PIPE, text=True)
+    for line in proc.stderr:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            sys.stderr.write(line)
+            continue
+        emit_event(**event)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
     print('Upstream averaging executed successfully.')
 
-def flt_to_tiff(flt_inf, tiff_outf, gt, proj, Nx, Ny, nodata):
+def flt_to_tiff(flt_inf, tiff_outf, gt, proj, Nx, Ny, nodata, cog=COG_OUTPUT):
     """
-    Convert a flt file to a tiff file.
+    Convert a flt file to a tiff file. The flt is memory-mapped and copied over one strip of blocks at a time.
     """
-    arr = np.fromfile(flt_inf, dtype=np.float32)
-    arr = arr.reshape((Ny, Nx))
-    to_gtiff = gdal.GetDriverByName('GTiff')
-    out_raster = to_gtiff.Create(tiff_outf, Nx, Ny, 1, gdal.GDT_Float32)
-    out_raster.GetRasterBand(1).WriteArray(arr)
-    out_raster.SetGeoTransform(gt)
-    out_raster.SetProjection(proj)
-    out_raster.GetRasterBand(1).SetNoDataValue(nodata)
-    out_raster.FlushCache()
-    out_raster = None
+    arr = np.memmap(flt_inf, dtype=np.float32, mode='r', shape=(Ny, Nx))
+    array_to_tiff(arr, tiff_outf, gt, proj, nodata, cog)
     return arr
 
-def tmp_destroy():
+def array_to_tiff(arr, tiff_outf, gt, proj, nodata, cog=COG_OUTPUT):
+    """
+    Write a float32 or uint8 array to a tiled, compressed tiff with overviews (a Cloud-Optimized GeoTIFF if cog); a
+    2D array becomes a single band and a pixel-interleaved (Ny, Nx, nbands) array becomes a multi-band tiff. nodata
+    may be None for rasters without one.
+    """
+    write_array(arr, tiff_outf, gt, proj, nodata, cog)
+    return arr
+
+def tmp_destroy(tmp_dir=TMP_DIR):
     """
     Remove the temporary directory and its contents.
     """
-    if os.path.exists(TMP_DIR):
-        for file in os.listdir(TMP_DIR):
-            file_path = os.path.join(TMP_DIR, file)
+    if os.path.exists(tmp_dir):
+        for file in os.listdir(tmp_dir):
+            file_path = os.path.join(tmp_dir, file)
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path):
                     os.unlink(file_path)
@@ -84,21 +146,26 @@ def tmp_destroy():
                     os.rmdir(file_path)
             except Exception as e:
                 print(f'Failed to delete {file_path}. Reason: {e}')
-        os.rmdir(TMP_DIR)
-    return print(f'Temporary directory {TMP_DIR} removed.')
+        os.rmdir(tmp_dir)
+    return print(f'Temporary directory {tmp_dir} removed.')
     
 
 if __name__ == "__main__":
 
-    os.makedirs(TMP_DIR, exist_ok=True)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('upstream.events').propagate = False
+    if EVENT_LOG:
+        logging.getLogger('upstream.events').addHandler(logging.FileHandler(EVENT_LOG))
+    set_event_callback(log_events())
 
-    
     deminfile = './data/' + input("Enter DEM filename with extension: ").strip()
-    varinfile = './data/' + input("Enter variable filename with extension: ").strip()
+    varinfiles = ['./data/' + f.strip() for f in
+                  input("Enter variable filename(s) with extension, comma-separated (all bands are averaged): ").split(',')]
     outfile = './data/' + (input("Enter output filename with extension (default: upstreamavg.tif): ").strip() or 'upstreamavg.tif')
+    flowdirfile = input("Enter flow direction output filename with extension (leave blank to skip): ").strip()
 
-    if os.path.isfile(deminfile) and os.path.isfile(varinfile):
-        print(f"Files found:\nDEM file: {deminfile}\nVariable file: {varinfile}")
+    if os.path.isfile(deminfile) and all(os.path.isfile(f) for f in varinfiles):
+        print(f"Files found:\nDEM file: {deminfile}\nVariable file(s): {', '.join(varinfiles)}")
     else:
         print("Error: One or both files do not exist. Please check the paths.")
         exit(1)
@@ -108,15 +175,21 @@ if __name__ == "__main__":
 
     print(f"Tags for {deminfile}: {source_info}")
     
-    tiff_to_flt(deminfile, DEM_FLT_INFILE)
-    tiff_to_flt(varinfile, VAR_FLT_INFILE)
+    dem = tiff_to_array(deminfile)
+    var = tiffs_to_stack(varinfiles)
+    out = np.empty_like(var)
 
-    print(f"Invoking upstream handler with {DEM_FLT_INFILE} and {VAR_FLT_INFILE}")
-    invoke_upstream(source_info['Nx'], source_info['Ny'], source_info['dx'], source_info['nodata'], EXECUTABLE)
+    print(f"Invoking upstream averaging on {deminfile} and {', '.join(varinfiles)}")
+    set_threads(THREADS)
+    topology = TopologyCache(CACHE_DIR).get_or_build(dem, source_info['nodata'], fill=FILL_MODE)
+    route_topology(topology, var, out, source_info['dx'], source_info['nodata'])
+    print('Upstream averaging executed successfully.')
 
     ##outfile = input('Enter path for output file (default: ./data/upstreamavg.tif): ').strip() or outfile
-    flt_to_tiff(UPSTRMAVG_FLT_OUTFILE, outfile, source_info['gt'], source_info['proj'], source_info['Nx'], source_info['Ny'], source_info['nodata'])
+    array_to_tiff(out, outfile, source_info['gt'], source_info['proj'], source_info['nodata'])
+    if flowdirfile:
+        array_to_tiff(np.asarray(topology.flowdir), './data/' + flowdirfile, source_info['gt'], source_info['proj'], None)
+        print(f"Flow directions written to ./data/{flowdirfile}")
 
-    tmp_destroy()
     print(f"Output written to {outfile}")
     print('Done.')
\ No newline at end of file
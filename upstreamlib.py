@@ -0,0 +1,510 @@
+"""
+In-process binding to the upstream averaging engine in upstreamcore.c.
+
+The C core is compiled once into a shared library next to this file and called through ctypes, so the DEM,
+variable and output rasters are handed over as NumPy buffers instead of round-tripping through ./data/tmp/*.flt.
+Where the library can't be built or loaded (no compiler), the same functions run on the pure-NumPy engine in
+upstreamnumpy instead.
+"""
+import ctypes
+import json
+import logging
+import os
+import subprocess
+import warnings
+from collections import namedtuple
+import numpy as np
+import upstreamnumpy
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+CORE_SOURCES = ['upstreamcore.c', 'priorityflood.c', 'utilities.c']
+CORE_HEADERS = ['upstreamcore.h', 'priorityflood.h', 'utilities.h']
+LIB_PATH = os.path.join(SRC_DIR, 'libupstream.so')
+LARGE_LIB_PATH = os.path.join(SRC_DIR, 'libupstream64.so')  # built with -DUPSTREAM_LARGE: 64-bit cell indices
+MAX_CELLS_32 = 2**31 - 1  # rasters with more cells are routed by the 64-bit build (see cellindex in upstreamcore.h)
+DEFAULT_NODATA = -9999.0
+UPSTREAM_OK = 0
+UPSTREAM_ERR_PIT = 1
+FILL_MODES = {'none': 0, 'recursive': 1, 'priorityflood': 2}  # see upstreamcore.h
+DEFAULT_EPSILON = 0.01
+STAGES = ('hydrocorrect', 'directions', 'order', 'route', 'normalize')  # STAGE_* in upstreamcore.h
+PRODUCTS = ('area', 'sum', 'avg', 'filled', 'flowdir')  # see upstream_products and upstreamavg.c -p
+BACKEND = os.environ.get('UPSTREAM_BACKEND', 'auto')  # 'native', 'numpy', or 'auto' (native unless it can't be built)
+
+_f32_buffer = np.ctypeslib.ndpointer(dtype=np.float32, flags='C_CONTIGUOUS')
+_u8_buffer = np.ctypeslib.ndpointer(dtype=np.uint8, flags='C_CONTIGUOUS')
+_i32_buffer = np.ctypeslib.ndpointer(dtype=np.int32, flags='C_CONTIGUOUS')
+_index_buffers = {False: np.ctypeslib.ndpointer(dtype=np.int32, flags='C_CONTIGUOUS'),
+                  True: np.ctypeslib.ndpointer(dtype=np.int64, flags='C_CONTIGUOUS')}
+_event_callback_type = ctypes.CFUNCTYPE(None, ctypes.c_char_p)
+
+# everything upstream averaging needs that depends only on the DEM: the hydrocorrected DEM, the D8 flow direction
+# grid and the upstream-to-downstream routing order of the valid cells (flat indices, see index_dtype)
+Topology = namedtuple('Topology', ['filled', 'flowdir', 'order'])
+_libs = {}  # loaded library per build (large or not)
+_last_lib = None  # the build the last engine call went to, for stage_times
+_lib_error = None
+_event_callback = None
+_threads = 1
+
+def library_is_stale(lib_path=LIB_PATH):
+    """
+    True if the shared library is missing or older than any of the C sources it is built from.
+    """
+    if not os.path.isfile(lib_path):
+        return True
+    built = os.path.getmtime(lib_path)
+    return any(os.path.getmtime(os.path.join(SRC_DIR, f)) > built for f in CORE_SOURCES + CORE_HEADERS)
+
+def build_library(lib_path=LIB_PATH, large=False):
+    """
+    Compile the C core into a shared library, with 64-bit cell indices if large.
+    """
+    sources = [os.path.join(SRC_DIR, f) for f in CORE_SOURCES]
+    defines = ['-DUPSTREAM_LARGE'] if large else []
+    subprocess.run(['gcc', '-shared', '-fPIC', '-O2', '-fopenmp'] + defines + ['-o', lib_path] + sources +
+                   ['-lm', '-Wall'], check=True)
+    return lib_path
+
+def index_dtype(ncells):
+    """
+    dtype of the routing order of a raster with ncells cells: int32, or int64 beyond MAX_CELLS_32.
+    """
+    return np.int64 if ncells > MAX_CELLS_32 else np.int32
+
+def load_library(large=False):
+    """
+    Load the shared library (the 64-bit index build if large), building it first if it is missing or out of date.
+    Handles are cached so the compile and load happen at most once per process and build; the thread count and
+    event callback are carried over to every build.
+    """
+    lib_path = LARGE_LIB_PATH if large else LIB_PATH
+    if lib_path not in _libs:
+        if library_is_stale(lib_path):
+            build_library(lib_path, large)
+        lib = ctypes.CDLL(lib_path)
+        index_buffer = _index_buffers[large]
+        lib.stagetimes.argtypes = [np.ctypeslib.ndpointer(dtype=np.float64, flags='C_CONTIGUOUS')]
+        lib.stagetimes.restype = ctypes.c_int
+        lib.setcallback.argtypes = [_event_callback_type]
+        lib.setcallback.restype = ctypes.c_int
+        lib.setthreads.argtypes = [ctypes.c_int]
+        lib.setthreads.restype = ctypes.c_int
+        lib.upstreamavg.argtypes = [_f32_buffer, _f32_buffer, _f32_buffer, ctypes.c_long, ctypes.c_long,
+                                    ctypes.c_long, ctypes.c_float, ctypes.c_float, ctypes.c_int, ctypes.c_int, ctypes.c_float,
+                                    ctypes.c_void_p]
+        lib.upstreamavg.restype = ctypes.c_int
+        lib.upstreamproducts.argtypes = [_f32_buffer, ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_long,
+                                         ctypes.c_float, ctypes.c_float, ctypes.c_int, ctypes.c_float,
+                                         ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                         ctypes.c_void_p]
+        lib.upstreamproducts.restype = ctypes.c_int
+        lib.routegrid.argtypes = [_f32_buffer, _f32_buffer, _f32_buffer, ctypes.c_long, ctypes.c_long, ctypes.c_long,
+                                  ctypes.c_float, ctypes.c_void_p, ctypes.c_void_p]
+        lib.routegrid.restype = ctypes.c_int
+        lib.flowtopology.argtypes = [_f32_buffer, ctypes.c_long, ctypes.c_long, ctypes.c_float, ctypes.c_int,
+                                     ctypes.c_float, _f32_buffer, _u8_buffer, index_buffer,
+                                     ctypes.POINTER(ctypes.c_long)]
+        lib.flowtopology.restype = ctypes.c_int
+        lib.routetopology.argtypes = [_u8_buffer, index_buffer, ctypes.c_long, _f32_buffer, _f32_buffer,
+                                      ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_float, ctypes.c_float, ctypes.c_int]
+        lib.routetopology.restype = ctypes.c_int
+        lib.updatetopology.argtypes = [_u8_buffer, _f32_buffer, _f32_buffer, _f32_buffer, ctypes.c_long, ctypes.c_long,
+                                       ctypes.c_long, ctypes.c_float, ctypes.c_float, index_buffer, ctypes.c_long,
+                                       ctypes.c_void_p, ctypes.c_void_p, index_buffer, ctypes.POINTER(ctypes.c_long)]
+        lib.updatetopology.restype = ctypes.c_int
+        lib.flowintervals.argtypes = [_u8_buffer, index_buffer, ctypes.c_long, ctypes.c_long, ctypes.c_long,
+                                      index_buffer, index_buffer]
+        lib.flowintervals.restype = ctypes.c_int
+        lib.catchmentlabels.argtypes = [_u8_buffer, index_buffer, ctypes.c_long, ctypes.c_long, ctypes.c_long,
+                                        index_buffer, ctypes.c_long, _i32_buffer]
+        lib.catchmentlabels.restype = ctypes.c_int
+        lib.setthreads(_threads)
+        if _event_callback is not None:
+            lib.setcallback(_native_event)
+        _libs[lib_path] = lib
+    return _libs[lib_path]
+
+def _native(ncells):
+    """
+    The library build that can index ncells cells.
+    """
+    global _last_lib
+    _last_lib = load_library(ncells > MAX_CELLS_32)
+    return _last_lib
+
+def native_available():
+    """
+    True if calls go to the C core, False if they go to the NumPy engine. With BACKEND 'auto' a failed build or
+    load is reported once as a warning and remembered; with 'native' it raises.
+    """
+    global _lib_error
+    if BACKEND == 'numpy':
+        return False
+    if BACKEND == 'native':
+        load_library()
+        return True
+    if LIB_PATH not in _libs and _lib_error is None:
+        try:
+            load_library()
+        except (OSError, subprocess.CalledProcessError) as e:
+            _lib_error = e
+            warnings.warn(f'Could not build or load the C core ({e}); using the NumPy backend')
+    return LIB_PATH in _libs
+
+def set_threads(n=0):
+    """
+    Accumulate flow on n threads from now on (0 for all cores, 1 for serial). Drainage basins are routed in parallel,
+    so the speedup depends on how evenly the DEM splits into basins; results are identical for any n. Returns the
+    number of threads that will be used (always 1 on the NumPy backend).
+    """
+    global _threads
+    if n < 0:
+        raise ValueError('n must not be negative')
+    if not native_available():
+        return 1
+    _threads = n
+    return max(lib.setthreads(n) for lib in _libs.values())
+
+def stage_times():
+    """
+    Wall clock seconds the last engine call spent in each of STAGES, as a dict (stages it didn't run are 0).
+    """
+    if not native_available():
+        return dict(upstreamnumpy.stagetime)
+    times = np.zeros(len(STAGES))
+    (_last_lib or load_library()).stagetimes(times)
+    return dict(zip(STAGES, times.tolist()))
+
+def emit_event(event, **fields):
+    """
+    Pass an event to the callback set with set_event_callback, if any. The engine emits its own events; wrappers
+    use this to report file reads and writes ({'event': 'read', 'path': ..., 'bytes': ..., 'seconds': ...}).
+    """
+    if _event_callback is not None:
+        _event_callback(dict(event=event, **fields))
+
+# the C core holds on to this pointer, so it lives as long as the module
+_native_event = _event_callback_type(lambda event: emit_event(**json.loads(event)))
+
+def set_event_callback(callback):
+    """
+    Call callback with every instrumentation event from now on, as a dict (None to stop). Every engine call emits
+    call_start, stage_start/stage_end per stage (with wall clock times and cells processed), a fill event with the
+    cells raised and the fill's iterations and queue high-water marks, and call_end; see upstreamcore.c for the
+    fields. Events arrive from the calling thread, between stages. Returns the previous callback.
+    """
+    global _event_callback
+    previous, _event_callback = _event_callback, callback
+    if native_available():
+        for lib in _libs.values():
+            lib.setcallback(_native_event if callback is not None else _event_callback_type())
+    else:
+        upstreamnumpy.callback = callback
+    return previous
+
+def log_events(events=None, progress=None):
+    """
+    Event callback logging every event as a JSON line to the events logger (default: 'upstream.events') and a one
+    line progress message for every finished stage, call and file to the progress logger (default:
+    'upstream.progress'), both at INFO. Use it as set_event_callback(log_events()).
+    """
+    events = events or logging.getLogger('upstream.events')
+    progress = progress or logging.getLogger('upstream.progress')
+
+    def callback(event):
+        events.info(json.dumps(event))
+        if event['event'] == 'stage_end':
+            progress.info(f"{event['call']}: {event['stage']} done in {event['seconds']:.2f} s "
+                          f"({event['cells']} cells)")
+        elif event['event'] == 'fill':
+            progress.info(f"{event['call']}: filled {event['raised']} cells ({event['mode']})")
+        elif event['event'] == 'call_end':
+            progress.info(f"{event['call']}: finished in {event['seconds']:.2f} s (status {event['status']})")
+        elif event['event'] == 'tile':
+            progress.info(f"tile {event['done']}/{event['total']} routed (pass {event['phase']})")
+        elif event['event'] in ('read', 'write'):
+            progress.info(f"{event['event']} {event['path']}: {event['bytes'] / 1024**2:.1f} MiB in "
+                          f"{event['seconds']:.2f} s")
+    return callback
+
+def _check_output(out, shape, dtype=np.float32, name='out'):
+    """
+    Outputs are filled in place, so they must already be writable C-contiguous arrays of the right dtype and shape.
+    """
+    if not isinstance(out, np.ndarray) or out.dtype != dtype or not out.flags['C_CONTIGUOUS'] \
+            or not out.flags['WRITEABLE']:
+        raise ValueError(f'{name} must be a writable, C-contiguous {np.dtype(dtype).name} array')
+    if out.shape != shape:
+        raise ValueError(f'{name} has shape {out.shape}, expected {shape}')
+
+def fill_mode_code(fill):
+    """
+    Translate a hydrocorrection mode name ('none', 'recursive' or 'priorityflood') to its C constant.
+    """
+    if fill not in FILL_MODES:
+        raise ValueError(f"Unknown fill mode {fill!r}, expected one of {sorted(FILL_MODES)}")
+    return FILL_MODES[fill]
+
+def stack_variables(var):
+    """
+    Return var as a float32 C-contiguous array of shape (Ny, Nx) or (Ny, Nx, nvar). A list or tuple of 2D rasters is
+    stacked pixel-interleaved (the values of one cell contiguous), which is the layout the C core routes in one pass.
+    """
+    if isinstance(var, (list, tuple)):
+        var = np.stack(var, axis=-1)
+    return np.ascontiguousarray(var, dtype=np.float32)
+
+def upstream_average(dem, var, out, dx, nodata=DEFAULT_NODATA, average=True, fill='recursive',
+                     epsilon=DEFAULT_EPSILON, flowdir=None):
+    """
+    Compute the upstream average (or upstream sum if average=False) of var over dem and write it into out.
+
+    dem is a 2D array. var is a raster of the same shape, a (Ny, Nx, nvar) stack of rasters or a list of rasters; all
+    variables are accumulated together in a single routing pass. float32 C-contiguous arrays are used without
+    copying. out must be a preallocated float32 array with the shape of the (stacked) var. fill selects the hydrocorrection: 'recursive' is the original
+    0.01 m pit filling, 'priorityflood' is the heap-based fill (use it on large DEMs) and 'none' skips filling.
+    epsilon is the gradient priority-flood imposes across filled flats. If flowdir is a uint8 array of the same
+    shape, the D8 flow direction grid is written to it (codes 1, 2, 4, ..., 128 for SW, S, SE, E, NE, N, NW, W in
+    row-major order with row 0 at the top; 0 for border and NoData cells). Returns out.
+    """
+    dem = np.ascontiguousarray(dem, dtype=np.float32)
+    var = stack_variables(var)
+    if dem.ndim != 2 or var.shape[:2] != dem.shape or var.ndim not in (2, 3):
+        raise ValueError(f'var must be a raster or a stack of rasters matching the 2D dem, '
+                         f'got {dem.shape} and {var.shape}')
+    _check_output(out, var.shape)
+    if flowdir is not None:
+        _check_output(flowdir, dem.shape, np.uint8, 'flowdir')
+    fillmode = fill_mode_code(fill)
+    if epsilon < 0:
+        raise ValueError('epsilon must not be negative')
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+    Ny, Nx = dem.shape
+    nvar = var.shape[2] if var.ndim == 3 else 1
+    if native_available():
+        status = _native(Nx * Ny).upstreamavg(dem, var, out, Nx, Ny, nvar, dx, nodata, int(average), fillmode,
+                                              epsilon, None if flowdir is None else flowdir.ctypes.data)
+    else:
+        status = upstreamnumpy.upstreamavg(dem, var, out, dx, nodata, average, fillmode, epsilon, flowdir)
+    if status == UPSTREAM_ERR_PIT:
+        raise RuntimeError('Topographic pit detected! Input DEM must be hydrocorrected.')
+    return out
+
+def upstream_products(dem, var=None, dx=1.0, nodata=DEFAULT_NODATA, products=PRODUCTS, fill='recursive',
+                      epsilon=DEFAULT_EPSILON):
+    """
+    Compute any combination of PRODUCTS from a single hydrocorrection, ordering and routing pass and return them as a
+    dict of new arrays: 'area' the contributing area (dx*dx per upstream cell), 'sum' and 'avg' the upstream sum and
+    area-normalized average of var (shaped like the stacked var), 'filled' the hydrocorrected DEM and 'flowdir' the
+    D8 flow direction grid. NoData cells are nodata in the float products. var is only needed for 'sum' and 'avg';
+    the other arguments are those of upstream_average.
+    """
+    unknown = set(products) - set(PRODUCTS)
+    if unknown:
+        raise ValueError(f'Unknown products {sorted(unknown)}, expected some of {PRODUCTS}')
+    dem = np.ascontiguousarray(dem, dtype=np.float32)
+    if dem.ndim != 2:
+        raise ValueError(f'dem must be a 2D array, got shape {dem.shape}')
+    routed = {'sum', 'avg'} & set(products)
+    if routed:
+        if var is None:
+            raise ValueError(f'var is needed for {sorted(routed)}')
+        var = stack_variables(var)
+        if var.shape[:2] != dem.shape or var.ndim not in (2, 3):
+            raise ValueError(f'var must be a raster or a stack of rasters matching the 2D dem, '
+                             f'got {dem.shape} and {var.shape}')
+    fillmode = fill_mode_code(fill)
+    if epsilon < 0:
+        raise ValueError('epsilon must not be negative')
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+    Ny, Nx = dem.shape
+    nvar = (var.shape[2] if var.ndim == 3 else 1) if routed else 0
+    shapes = {'area': dem.shape, 'sum': var.shape if routed else None, 'avg': var.shape if routed else None,
+              'filled': dem.shape, 'flowdir': dem.shape}
+    out = {p: np.empty(shapes[p], dtype=np.uint8 if p == 'flowdir' else np.float32) for p in PRODUCTS
+           if p in products}
+    if native_available():
+        status = _native(Nx * Ny).upstreamproducts(dem, var.ctypes.data if routed else None, Nx, Ny, nvar, dx,
+                                                   nodata, fillmode, epsilon,
+                                                   *(out[p].ctypes.data if p in out else None for p in PRODUCTS))
+    else:
+        status = upstreamnumpy.upstreamproducts(dem, var if routed else None, dx, nodata, fillmode, epsilon,
+                                                *(out.get(p) for p in PRODUCTS))
+    if status == UPSTREAM_ERR_PIT:
+        raise RuntimeError('Topographic pit detected! Input DEM must be hydrocorrected.')
+    return out
+
+def route_grid(dem, init, sums, nodata=DEFAULT_NODATA, flowdir=None, terminal=None):
+    """
+    Route already-scaled per-cell values over an already hydrocorrected DEM and write the upstream totals into sums.
+
+    This is the building block for tiled processing: init is a (Ny, Nx, nch) float32 stack of what each cell
+    contributes (e.g. variable times cell area, and the cell area itself), and cells on the grid border receive flow
+    without passing it on. If given, flowdir (uint8) receives the D8 grid and terminal (int64) the flat index of the
+    cell where each cell's flow path ends, or -1 if it runs into NoData. Returns sums.
+    """
+    dem = np.ascontiguousarray(dem, dtype=np.float32)
+    init = np.ascontiguousarray(init, dtype=np.float32)
+    if dem.ndim != 2 or init.ndim != 3 or init.shape[:2] != dem.shape:
+        raise ValueError(f'init must be a (Ny, Nx, nch) stack matching the 2D dem, got {dem.shape} and {init.shape}')
+    _check_output(sums, init.shape, name='sums')
+    if flowdir is not None:
+        _check_output(flowdir, dem.shape, np.uint8, 'flowdir')
+    if terminal is not None:
+        _check_output(terminal, dem.shape, np.int64, 'terminal')
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+    Ny, Nx = dem.shape
+    if native_available():
+        status = _native(Nx * Ny).routegrid(dem, init, sums, Nx, Ny, init.shape[2], nodata,
+                                            None if flowdir is None else flowdir.ctypes.data,
+                                            None if terminal is None else terminal.ctypes.data)
+    else:
+        status = upstreamnumpy.routegrid(dem, init, sums, nodata, flowdir, terminal)
+    if status == UPSTREAM_ERR_PIT:
+        raise RuntimeError('Topographic pit detected! Input DEM must be hydrocorrected.')
+    return sums
+
+def flow_topology(dem, nodata=DEFAULT_NODATA, fill='recursive', epsilon=DEFAULT_EPSILON):
+    """
+    Hydrocorrect dem and build its flow topology once, for reuse with route_topology (see upstreamcache for storing
+    it between runs).
+    """
+    dem = np.ascontiguousarray(dem, dtype=np.float32)
+    if dem.ndim != 2:
+        raise ValueError(f'dem must be a 2D array, got shape {dem.shape}')
+    fillmode = fill_mode_code(fill)
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+    Ny, Nx = dem.shape
+    filled = np.empty_like(dem)
+    flowdir = np.empty(dem.shape, dtype=np.uint8)
+    order = np.empty(Nx * Ny, dtype=index_dtype(Nx * Ny))
+    if native_available():
+        norder = ctypes.c_long(0)
+        status = _native(Nx * Ny).flowtopology(dem, Nx, Ny, nodata, fillmode, epsilon, filled, flowdir, order,
+                                               ctypes.byref(norder))
+        norder = norder.value
+    else:
+        status, norder = upstreamnumpy.flowtopology(dem, nodata, fillmode, epsilon, filled, flowdir, order)
+    if status == UPSTREAM_ERR_PIT:
+        raise RuntimeError('Topographic pit detected! Input DEM must be hydrocorrected.')
+    order.resize(norder, refcheck=False)  # shrinks in place instead of copying
+    return Topology(filled, flowdir, order)
+
+def route_topology(topology, var, out, dx, nodata=DEFAULT_NODATA, average=True):
+    """
+    The accumulation stage of upstream_average on a prebuilt Topology: same arguments and results, but no
+    hydrocorrection, flow directions or ordering are recomputed.
+    """
+    var = stack_variables(var)
+    if var.shape[:2] != topology.flowdir.shape or var.ndim not in (2, 3):
+        raise ValueError(f'var must be a raster or a stack of rasters matching the topology, '
+                         f'got {topology.flowdir.shape} and {var.shape}')
+    _check_output(out, var.shape)
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+    Ny, Nx = topology.flowdir.shape
+    nvar = var.shape[2] if var.ndim == 3 else 1
+    flowdir = np.ascontiguousarray(topology.flowdir, dtype=np.uint8)
+    order = np.ascontiguousarray(topology.order, dtype=index_dtype(Nx * Ny))
+    if native_available():
+        _native(Nx * Ny).routetopology(flowdir, order, len(order), var, out, Nx, Ny, nvar, dx, nodata, int(average))
+    else:
+        upstreamnumpy.routetopology(flowdir, order, var, out, dx, nodata, average)
+    return out
+
+def _flat_cells(cells, shape, name='cells'):
+    """
+    cells given as a boolean mask, a (rows, cols) tuple or flat indices, as a flat index array of index_dtype.
+    """
+    if isinstance(cells, tuple):
+        cells = np.ravel_multi_index(cells, shape)
+    cells = np.asarray(cells)
+    if cells.dtype == bool:
+        cells = np.flatnonzero(cells)
+    ncells = shape[0] * shape[1]
+    cells = np.ascontiguousarray(cells, dtype=index_dtype(ncells)).reshape(-1)
+    if cells.size and (cells.min() < 0 or cells.max() >= ncells):
+        raise ValueError(f'{name} must lie within the topology')
+    return cells
+
+def update_topology(topology, var, sums, changed, dx, nodata=DEFAULT_NODATA, area=None, out=None):
+    """
+    Bring the upstream sums of a route_topology(..., average=False) (or upstream_products 'sum') run up to date after
+    var was edited at the cells in changed (a boolean mask, a (rows, cols) tuple or flat indices). sums is updated
+    in place; only the cells downstream of a changed cell are recomputed, so the cost follows the affected flow
+    paths rather than the raster, and the result is bit-identical to routing the whole raster again. If out is
+    given, the averages of the recomputed cells are written to it from the contributing area in area (see
+    upstream_products). Returns the flat indices of the recomputed cells in routing order.
+    """
+    var = stack_variables(var)
+    shape = topology.flowdir.shape
+    if var.shape[:2] != shape or var.ndim not in (2, 3):
+        raise ValueError(f'var must be a raster or a stack of rasters matching the topology, '
+                         f'got {shape} and {var.shape}')
+    _check_output(sums, var.shape, name='sums')
+    if out is not None:
+        if area is None:
+            raise ValueError('area is needed to renormalize out')
+        _check_output(out, var.shape)
+        area = np.ascontiguousarray(area, dtype=np.float32)
+        if area.shape != shape:
+            raise ValueError(f'area has shape {area.shape}, expected {shape}')
+    if nodata is None:
+        nodata = DEFAULT_NODATA
+    Ny, Nx = shape
+    nvar = var.shape[2] if var.ndim == 3 else 1
+    changed = _flat_cells(changed, shape, 'changed cells')
+    flowdir = np.ascontiguousarray(topology.flowdir, dtype=np.uint8)
+    filled = np.ascontiguousarray(topology.filled, dtype=np.float32)
+    if native_available():
+        affected = np.empty(Nx * Ny, dtype=index_dtype(Nx * Ny))
+        naffected = ctypes.c_long(0)
+        _native(Nx * Ny).updatetopology(flowdir, filled, var, sums, Nx, Ny, nvar, dx, nodata, changed, changed.size,
+                                        None if out is None else area.ctypes.data,
+                                        None if out is None else out.ctypes.data, affected, ctypes.byref(naffected))
+        affected.resize(naffected.value, refcheck=False)
+    else:
+        affected = upstreamnumpy.updatetopology(flowdir, filled, var, sums, dx, nodata, changed, area, out)
+    return affected
+
+def flow_intervals(topology):
+    """
+    Depth-first interval labels of the D8 flow forest of a Topology (see flowintervals in upstreamcore.c): cell k and
+    every cell upstream of it occupy positions first[k] to first[k] + count[k] - 1 of one pre-order walk from the
+    outlets, so upstream totals are differences of prefix sums over the walk (see upstreamquery.py). Returns
+    (first, count), two (Ny, Nx) arrays of index_dtype; NoData cells have first -1 and count 0.
+    """
+    Ny, Nx = topology.flowdir.shape
+    flowdir = np.ascontiguousarray(topology.flowdir, dtype=np.uint8)
+    order = np.ascontiguousarray(topology.order, dtype=index_dtype(Nx * Ny))
+    first = np.empty((Ny, Nx), dtype=index_dtype(Nx * Ny))
+    count = np.empty((Ny, Nx), dtype=index_dtype(Nx * Ny))
+    if native_available():
+        _native(Nx * Ny).flowintervals(flowdir, order, len(order), Nx, Ny, first, count)
+    else:
+        upstreamnumpy.flowintervals(flowdir, order, first, count)
+    return first, count
+
+def catchment_labels(topology, outlets):
+    """
+    Catchment label raster of many outlets in one pass over the routing order of a Topology: every cell gets the
+    number (1 to the number of outlets, in the order given) of the first outlet its flow path reaches, the outlet
+    itself included, and cells that reach no outlet (and NoData cells) get 0. So the catchments of nested outlets
+    don't overlap: each cell belongs to its nearest downstream outlet. outlets are given like update_topology's
+    changed cells; an outlet listed twice keeps its last number. Returns an int32 (Ny, Nx) array.
+    """
+    Ny, Nx = topology.flowdir.shape
+    outlets = _flat_cells(outlets, (Ny, Nx), 'outlets')
+    flowdir = np.ascontiguousarray(topology.flowdir, dtype=np.uint8)
+    order = np.ascontiguousarray(topology.order, dtype=index_dtype(Nx * Ny))
+    labels = np.empty((Ny, Nx), dtype=np.int32)
+    if native_available():
+        _native(Nx * Ny).catchmentlabels(flowdir, order, len(order), Nx, Ny, outlets, outlets.size, labels)
+    else:
+        upstreamnumpy.catchmentlabels(flowdir, order, outlets, labels)
+    return labels
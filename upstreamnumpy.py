@@ -0,0 +1,738 @@
+"""
+Pure-NumPy implementation of the upstream averaging engine, used by upstreamlib when the C core in upstreamcore.c
+can't be built or loaded (e.g. in containers without gcc).
+
+The functions mirror the entry points of upstreamcore.c and take the same already-validated buffers. D8 directions
+are computed with shifted-array stencils in the same float32 arithmetic as calculated8drainagedirections, and flow
+is accumulated in batches by topological depth: all cells at the same depth pull their donors at once, one neighbor
+direction at a time in the same fixed order as the C core. On a hydrocorrected DEM the upstream sums and averages are
+therefore bit-identical to the native ones.
+
+Hydrocorrection applies the local rule of both C fills (a valid interior cell with no strictly lower neighbor is
+raised epsilon above its lowest neighbor) as a vectorized fixed-point iteration. Filled depressions drain the same
+way, but the heights chosen inside them can differ from the native fills, which depend on the order cells are
+visited in, so flow across filled flats may be routed differently. With exact_fill set, the fills instead replay the
+C core's visiting order cell by cell (the priority flood with heapq and a FIFO queue, the recursive fill depth first
+on an explicit stack) and give its filled DEM bit for bit; that is far too slow for large DEMs and only meant for
+comparing the backends (benchmark.py --check-backends).
+"""
+import collections
+import heapq
+import time
+import numpy as np
+
+UPSTREAM_OK = 0
+UPSTREAM_ERR_PIT = 1
+FILL_NONE = 0  # see upstreamcore.h
+FILL_RECURSIVE = 1
+FILL_PRIORITYFLOOD = 2
+RECURSIVE_FILL_INCREMENT = 0.01
+ONE_OVER_SQRT2 = np.float32(0.707106781186)
+STAGES = ('hydrocorrect', 'directions', 'order', 'route', 'normalize')
+
+# wall clock seconds the last call spent in each stage, as stagetimes() reports for the C core
+stagetime = dict.fromkeys(STAGES, 0.0)
+# receives the events of upstreamcore.c as dicts (set through upstreamlib.set_event_callback); fill events carry
+# raised and iterations (fill waves) but none of the C fills' peaks unless exact_fill is set
+callback = None
+# fill cell by cell in the C core's order instead of with the vectorized fill()
+exact_fill = False
+_call = {'name': None, 'start': 0.0}
+
+# row and column offsets of the neighbor that flow direction code 1<<d points to, as in upstreamcore.c
+DI = (1, 1, 1, 0, -1, -1, -1, 0)
+DJ = (-1, 0, 1, 1, 1, 0, -1, -1)
+
+# d for flow direction code 1<<d, -1 for the codes of cells that don't route flow
+DIRINDEX = np.full(256, -1, dtype=np.int8)
+DIRINDEX[[1 << d for d in range(8)]] = range(8)
+
+def _emit(event, **fields):
+    if callback is not None:
+        callback(dict(event=event, call=_call['name'], **fields))
+
+def _begin(name, shape, nvar):
+    for stage in STAGES:
+        stagetime[stage] = 0.0
+    _call.update(name=name, start=time.perf_counter())
+    _emit('call_start', nx=shape[1], ny=shape[0], nvar=nvar, threads=1)
+
+def _end(status):
+    _emit('call_end', status=status, seconds=time.perf_counter() - _call['start'])
+    return status
+
+class _stage:
+    """
+    Context manager adding the time spent in its block to stagetime[name] and emitting its stage_start and
+    stage_end events.
+    """
+    def __init__(self, name, cells):
+        self.name, self.cells = name, int(cells)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        _emit('stage_start', stage=self.name, t=self.start - _call['start'])
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        stagetime[self.name] += end - self.start
+        _emit('stage_end', stage=self.name, t=end - _call['start'], seconds=end - self.start, cells=self.cells)
+
+def flow_offsets(Nx):
+    """
+    Flat index offset of the receiver for each flow direction.
+    """
+    return np.array([DI[d] * Nx + DJ[d] for d in range(8)], dtype=np.intp)
+
+def _unique_neighbors(cells, offsets, mask, stamp):
+    """
+    The distinct neighbors of cells where mask is set; stamp is scratch space of the grid size, used to drop
+    repeats without sorting.
+    """
+    neighbors = (cells[:, None] + offsets).reshape(-1)
+    neighbors = neighbors[mask[neighbors]]
+    last = np.arange(neighbors.size)
+    stamp[neighbors] = last
+    return neighbors[stamp[neighbors] == last]
+
+def _segments(ptr, nodes):
+    """
+    Positions of the CSR entries ptr[node]..ptr[node+1]-1 of all nodes, concatenated.
+    """
+    count = ptr[nodes + 1] - ptr[nodes]
+    first = np.cumsum(count) - count
+    return np.repeat(ptr[nodes] - first, count) + np.arange(count.sum())
+
+def minimumspanningtree(nnodes, a, b, weight):
+    """
+    Edges (a, b, weight) of a minimum spanning forest of the graph on nnodes nodes, found with Boruvka's algorithm:
+    in every round each component takes its lightest outgoing edge (ties broken by edge position, so the choices
+    can't form a cycle) and the components joined by them are merged by pointer jumping. Parallel edges are fine.
+    """
+    comp = np.arange(nnodes)
+    edge = np.arange(a.size)
+    tree = []
+    while edge.size:
+        ca, cb = comp[a[edge]], comp[b[edge]]
+        cross = ca != cb
+        edge, ca, cb = edge[cross], ca[cross], cb[cross]
+        if edge.size == 0:
+            break
+        w = weight[edge]
+        lightest = np.full(nnodes, np.inf, dtype=weight.dtype)
+        np.minimum.at(lightest, ca, w)
+        np.minimum.at(lightest, cb, w)
+        chosen = np.full(nnodes, edge.size, dtype=np.intp)
+        pos = np.arange(edge.size)
+        np.minimum.at(chosen, ca, np.where(w == lightest[ca], pos, edge.size))
+        np.minimum.at(chosen, cb, np.where(w == lightest[cb], pos, edge.size))
+        c = np.flatnonzero(chosen < edge.size)
+        pick = chosen[c]
+        tree.append(np.unique(edge[pick]))
+        parent = np.arange(nnodes)
+        parent[c] = np.where(ca[pick] == c, cb[pick], ca[pick])
+        # two components that chose the same edge point at each other; the lower one becomes the root
+        mutual = (parent[parent[c]] == c) & (c < parent[c])
+        parent[c[mutual]] = c[mutual]
+        while True:
+            nxt = parent[parent]
+            if np.array_equal(nxt, parent):
+                break
+            parent = nxt
+        comp = parent[comp]
+    tree = np.concatenate(tree) if tree else np.empty(0, dtype=np.intp)
+    return a[tree], b[tree], weight[tree]
+
+def _raise(low, epsilon):
+    """
+    epsilon above low, or one float ulp above it where epsilon is too small to make a difference.
+    """
+    raised = low + epsilon
+    tiny = raised <= low
+    raised[tiny] = np.nextafter(low[tiny], np.float32(np.inf))
+    return raised
+
+def fill(z, nanval, epsilon):
+    """
+    Fill depressions and flats in the 2D float32 DEM z in place so every valid interior cell has a strictly lower
+    neighbor. Cells on the border or next to NoData keep their elevation, and so does every cell with a strictly
+    downhill path to one of them (found by following the steepest descent with pointer jumping).
+
+    The other cells descend into pits. The spill level of each pit (the lowest level at which it overflows to a
+    drained cell) is solved on the much smaller graph of adjacent pit basins. The cells at or below their pit's
+    spill level are then filled in waves outward from the rest, each set epsilon (or one float ulp) above the
+    lowest neighbor it can drain to unless it is already higher; cells next to the filled ones that are left without
+    a lower neighbor are raised the same way. Returns the number of raised cells and the number of waves it took.
+    """
+    Ny, Nx = z.shape
+    if Ny < 3 or Nx < 3:
+        return 0, 0
+    flat = z.reshape(-1)
+    n = flat.size
+    offsets = flow_offsets(Nx)
+    epsilon = np.float32(epsilon)
+    nodata = z == nanval
+    fixed = nodata.copy()
+    fixed[0, :] = fixed[-1, :] = fixed[:, 0] = fixed[:, -1] = True
+    for d in range(8):
+        fixed[1:-1, 1:-1] |= nodata[1 + DI[d]:Ny - 1 + DI[d], 1 + DJ[d]:Nx - 1 + DJ[d]]
+    free = ~fixed.reshape(-1)
+    stamp = np.empty(n, dtype=np.intp)
+
+    # follow the steepest descent to its end; cells whose path ends in a pit rather than a fixed cell are
+    # undrained and labeled with their pit (1, 2, ...; 0 for everything drained)
+    flowdir = np.zeros(z.shape, dtype=np.uint8)
+    d8directions(z, nanval, flowdir)
+    d = DIRINDEX[flowdir.reshape(-1)]
+    end = np.arange(n)
+    routes = free & (d >= 0)
+    end[routes] += offsets[d[routes]]
+    while True:
+        nxt = end[end]
+        if np.array_equal(nxt, end):
+            break
+        end = nxt
+    pits = np.flatnonzero(free & ~routes)
+    if pits.size == 0:
+        return 0, 0
+    pitlabel = np.zeros(n, dtype=np.intp)
+    pitlabel[pits] = np.arange(1, pits.size + 1)
+    label = pitlabel[end].reshape(z.shape)
+    del end, pitlabel, routes
+
+    # passes between adjacent basins: the higher of the two cells on either side of the boundary
+    a, b, height = [], [], []
+    inner = label[1:-1, 1:-1]
+    zinner = z[1:-1, 1:-1]
+    for d in range(8):
+        other = label[1 + DI[d]:Ny - 1 + DI[d], 1 + DJ[d]:Nx - 1 + DJ[d]]
+        cross = (inner > 0) & (other != inner)
+        a.append(inner[cross])
+        b.append(other[cross])
+        height.append(np.maximum(zinner[cross], z[1 + DI[d]:Ny - 1 + DI[d], 1 + DJ[d]:Nx - 1 + DJ[d]][cross]))
+    a, b, height = np.concatenate(a), np.concatenate(b), np.concatenate(height)
+
+    # the lowest path between two basins runs along the minimum spanning tree of the pass graph, so the spill level
+    # of a basin is the highest pass on its tree path to the drained cells
+    a, b, height = minimumspanningtree(pits.size + 1, a, b, height)
+    a, b, height = np.concatenate((a, b)), np.concatenate((b, a)), np.concatenate((height, height))
+    edge = np.argsort(a, kind='stable')
+    a, b, height = a[edge], b[edge], height[edge]
+    ptr = np.zeros(pits.size + 2, dtype=np.intp)
+    np.cumsum(np.bincount(a, minlength=pits.size + 1), out=ptr[1:])
+    level = np.full(pits.size + 1, -np.inf, dtype=np.float32)
+    seen = np.zeros(pits.size + 1, dtype=bool)
+    seen[0] = True
+    active = np.zeros(1, dtype=np.intp)
+    while active.size:
+        e = _segments(ptr, active)
+        e = e[~seen[b[e]]]
+        level[b[e]] = np.maximum(level[a[e]], height[e])
+        active = b[e]
+        seen[active] = True
+
+    # lake cells (at or below their spill level), filled in waves outward from the others; a cell can drain to a
+    # neighbor that is done and no higher than its spill level
+    label = label.reshape(-1)
+    lake = (label > 0) & (flat <= level[label])
+    spill = np.where(lake, level[label], flat)
+    del label
+    w = flat.copy()
+    done = ~lake
+    active = np.flatnonzero(lake)
+    waves = 0
+    while active.size:
+        waves += 1
+        low = np.full(active.size, np.inf, dtype=np.float32)
+        for o in offsets:
+            nb = active + o
+            np.minimum(low, np.where(done[nb] & (spill[nb] <= spill[active]), w[nb], np.inf), out=low)
+        reached = low < np.inf
+        active, low = active[reached], low[reached]
+        w[active] = np.where(flat[active] > low, flat[active], _raise(low, epsilon))
+        done[active] = True
+        active = _unique_neighbors(active, offsets, lake, stamp)
+        active = active[~done[active]]
+
+    # cells just above a filled lake can be left without a lower neighbor; raise them too, rechecking the
+    # neighbors of every raised cell
+    active = _unique_neighbors(np.flatnonzero(w > flat), offsets, free, stamp)
+    while active.size:
+        waves += 1
+        low = w[active + offsets[0]]
+        for o in offsets[1:]:
+            np.minimum(low, w[active + o], out=low)
+        pit = w[active] <= low
+        active = active[pit]
+        w[active] = _raise(low[pit], epsilon)
+        active = _unique_neighbors(active, offsets, free, stamp)
+    nraised = int(np.count_nonzero(w > flat))
+    flat[:] = w
+    return nraised, waves
+
+def recursivefill(z, nanval):
+    """
+    Fill pits and flats in the 2D float32 DEM z in place exactly as fillinpitsandflats in upstreamcore.c does: a
+    valid interior cell with no strictly lower neighbor is raised by RECURSIVE_FILL_INCREMENT and then itself and
+    its neighbors are refilled, depth first in the same neighbor order. The recursion runs on an explicit stack, and
+    the fill is only started from the cells that are pits at the outset (in raster order, like the C core): any
+    other cell only becomes a pit when a neighbor is raised, and is refilled right after. Returns the number of
+    increments and the deepest nesting of the fill, the iterations and stack_peak of the C core's fill event.
+    """
+    Ny, Nx = z.shape
+    if Ny < 3 or Nx < 3:
+        return 0, 0
+    inner = np.zeros(z.shape, dtype=bool)
+    inner[1:-1, 1:-1] = z[1:-1, 1:-1] != nanval
+    pits = inner.copy()
+    for d in range(8):
+        pits[1:-1, 1:-1] &= ~(z[1 + DI[d]:Ny - 1 + DI[d], 1 + DJ[d]:Nx - 1 + DJ[d]] < z[1:-1, 1:-1])
+    starts = np.flatnonzero(pits).tolist()
+    del pits
+    inner = bytearray(inner.tobytes())
+    # storing into a float32 memoryview rounds like the C core's float arithmetic
+    zv = memoryview(z.reshape(-1))
+    increment = float(np.float32(RECURSIVE_FILL_INCREMENT))
+    # iup j, idown j, i jup, i jdown, iup jup, idown jup, idown jdown, iup jdown, as in fillinpitsandflats
+    offsets = (Nx, -Nx, 1, -1, Nx + 1, 1 - Nx, -Nx - 1, Nx - 1)
+    o1, o2, o3, o4, o5, o6, o7, o8 = offsets
+    reverse = offsets[::-1]
+    steps = depth = peak = 0
+    for start in starts:
+        stack = [start]
+        while stack:
+            k = stack.pop()
+            if k < 0:
+                depth += k
+                continue
+            if not inner[k]:
+                continue
+            zk = zv[k]
+            around = (zv[k + o1], zv[k + o2], zv[k + o3], zv[k + o4], zv[k + o5], zv[k + o6], zv[k + o7], zv[k + o8])
+            if zk > min(zk, *around):
+                continue
+            # the call on the cell itself comes first and keeps raising it until it has a lower neighbor; the
+            # neighbors are refilled after the innermost of these calls, which leaves nothing for the outer ones
+            # to do, so only their nesting is kept
+            calls = 0
+            while zk <= min(zk, *around):
+                zv[k] = zk + increment
+                zk = zv[k]
+                calls += 1
+            steps += calls
+            depth += calls
+            peak = max(peak, depth)
+            # -calls marks where the calls return; the neighbors go on top in reverse so they're popped in order
+            stack.append(-calls)
+            stack.extend([k + o for o in reverse])
+    return steps, peak
+
+def priorityflood(z, nanval, epsilon):
+    """
+    Fill depressions in the 2D float32 DEM z in place exactly as priorityflood in priorityflood.c does: flooded
+    inward from the valid cells on the border or next to NoData, always from the lowest open cell (lowest flat index
+    among equal elevations) and from the queue of raised cells first, raising every cell that is not higher than the
+    cell it is reached from epsilon (or one float ulp) above it. Returns the number of raised cells and the largest
+    number of cells the heap and the queue held, the raised, heap_peak and queue_peak of the C core's fill event.
+    """
+    Ny, Nx = z.shape
+    nodata = z == nanval
+    seed = ~nodata
+    border = np.zeros(z.shape, dtype=bool)
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = True
+    if Ny > 2 and Nx > 2:
+        for d in range(8):
+            border[1:-1, 1:-1] |= nodata[1 + DI[d]:Ny - 1 + DI[d], 1 + DJ[d]:Nx - 1 + DJ[d]]
+    seed &= border
+    del nodata, border
+    closed = bytearray(seed.tobytes())
+    flat = z.reshape(-1)
+    heap = [(float(flat[k]), int(k)) for k in np.flatnonzero(seed)]
+    heapq.heapify(heap)
+    del seed
+    zv = memoryview(flat)
+    nan = float(np.float32(nanval))
+    epsilon = float(np.float32(epsilon))
+    scratch = memoryview(np.zeros(1, dtype=np.float32))
+    offsets = flow_offsets(Nx).tolist()
+    queue = collections.deque()
+    raised = 0
+    heappeak, queuepeak = len(heap), 0
+    while heap or queue:
+        k = queue.popleft() if queue else heapq.heappop(heap)[1]
+        zk = zv[k]
+        scratch[0] = zk + epsilon
+        zn = scratch[0]
+        if zn <= zk:
+            zn = float(np.nextafter(np.float32(zk), np.float32(np.inf)))
+        i, j = divmod(k, Nx)
+        if 0 < i < Ny - 1 and 0 < j < Nx - 1:
+            neighbors = [k + o for o in offsets]
+        else:
+            neighbors = [(i + di) * Nx + j + dj for di, dj in zip(DI, DJ) if 0 <= i + di < Ny and 0 <= j + dj < Nx]
+        for n in neighbors:
+            if closed[n] or zv[n] == nan:
+                continue
+            closed[n] = 1
+            if zv[n] <= zk:
+                zv[n] = zn
+                raised += 1
+                queue.append(n)
+                queuepeak = max(queuepeak, len(queue))
+            else:
+                heapq.heappush(heap, (zv[n], n))
+                heappeak = max(heappeak, len(heap))
+    return raised, heappeak, queuepeak
+
+def hydrocorrect(z, nanval, fillmode, epsilon):
+    """
+    Fill z in place according to fillmode with fill(), or with recursivefill() and priorityflood() (bit-identical to
+    the C core, but slow) if exact_fill is set; the recursive mode uses the original 0.01 m increment.
+    """
+    if fillmode == FILL_NONE:
+        return
+    recursive = fillmode == FILL_RECURSIVE
+    if not exact_fill:
+        raised, waves = fill(z, nanval, RECURSIVE_FILL_INCREMENT if recursive else epsilon)
+        _emit('fill', mode='recursive' if recursive else 'priorityflood', raised=raised, iterations=waves)
+    elif recursive:
+        before = z.copy() if callback is not None else None
+        steps, peak = recursivefill(z, nanval)
+        if before is not None:
+            _emit('fill', mode='recursive', raised=int(np.count_nonzero(z != before)), iterations=steps,
+                  stack_peak=peak)
+    else:
+        raised, heappeak, queuepeak = priorityflood(z, nanval, epsilon)
+        _emit('fill', mode='priorityflood', raised=raised, heap_peak=heappeak, queue_peak=queuepeak)
+
+def d8directions(z, nanval, flowdir):
+    """
+    D8 flow direction code of every valid interior cell of z written to flowdir (see
+    calculated8drainagedirections in upstreamcore.c: steepest drop, diagonals scaled by 1/sqrt(2), first direction
+    wins ties); border and NoData cells get 0. Returns UPSTREAM_ERR_PIT if a valid interior cell has no lower
+    neighbor.
+    """
+    Ny, Nx = z.shape
+    flowdir[:] = 0
+    if Ny < 3 or Nx < 3:
+        return UPSTREAM_OK
+    c = z[1:-1, 1:-1]
+    down = np.zeros(c.shape, dtype=np.float32)
+    code = flowdir[1:-1, 1:-1]
+    for d in range(8):
+        drop = z[1 + DI[d]:Ny - 1 + DI[d], 1 + DJ[d]:Nx - 1 + DJ[d]] - c
+        if DI[d] and DJ[d]:
+            drop *= ONE_OVER_SQRT2
+        steeper = drop < down
+        down[steeper] = drop[steeper]
+        code[steeper] = 1 << d
+    valid = c != nanval
+    code[~valid] = 0
+    if np.any(code[valid] == 0):
+        return UPSTREAM_ERR_PIT
+    return UPSTREAM_OK
+
+def routinglevels(flowdir, valid):
+    """
+    The valid cells grouped by topological depth in the D8 graph (level 0 has no donors, every other cell is one
+    level below its deepest donor), as a list of flat index arrays, and the flat index of the valid receiver of
+    every cell (-1 if it doesn't route flow or drains into NoData).
+    """
+    n = flowdir.size
+    d = DIRINDEX[flowdir.reshape(-1)]
+    k = np.flatnonzero(d >= 0)
+    r = k + flow_offsets(flowdir.shape[1])[d[k]]
+    into = valid[r]
+    receiver = np.full(n, -1, dtype=np.intp)
+    receiver[k[into]] = r[into]
+    indeg = np.bincount(r[into], minlength=n)
+    frontier = np.flatnonzero(valid & (indeg == 0))
+    levels = []
+    while frontier.size:
+        levels.append(frontier)
+        r = receiver[frontier]
+        r, ndonors = np.unique(r[r >= 0], return_counts=True)
+        indeg[r] -= ndonors
+        frontier = r[indeg[r] == 0]
+    return levels, receiver
+
+def flowrouting(acc, area, flowdir, levels, receiver):
+    """
+    Add the upstream totals into acc ((Ny*Nx, nvar), holding each cell's own contribution) and area (Ny*Nx). Levels
+    are processed in order, and within a level every cell adds its donors one direction at a time in the same order
+    as the C core's pull loop, so the sums are rounded identically.
+    """
+    d = DIRINDEX[flowdir.reshape(-1)]
+    offsets = flow_offsets(flowdir.shape[1])
+    # bit d of donors is set when the neighbor in direction d drains into the cell
+    donors = np.zeros(receiver.size, dtype=np.uint8)
+    k = np.flatnonzero(receiver >= 0)
+    for bit in range(8):
+        donors[receiver[k[d[k] == bit]]] |= np.uint8(1 << bit)
+    for cells in levels[1:]:
+        bits = donors[cells]
+        for bit in range(8):
+            r = cells[(bits & (1 << bit)) != 0]
+            if r.size:
+                acc[r] += acc[r - offsets[bit]]
+                area[r] += area[r - offsets[bit]]
+
+def _route(var, sums, avg, area, dx, nanval, flowdir, valid, levels, receiver):
+    """
+    Route dx*dx*var into sums and its area-normalized average into avg (either may be None; with only avg the sums
+    are accumulated there) and the contributing area into area (may be None). NoData cells get nanval.
+    """
+    n = flowdir.size
+    acc = sums if sums is not None else avg
+    nvar = 0 if acc is None else acc.size // n
+    acc = np.empty((n, 0), dtype=np.float32) if acc is None else acc.reshape(n, nvar)
+    dx2 = np.float32(dx) * np.float32(dx)
+    ar = np.full(n, dx2, dtype=np.float32)  # contributing area (m^2)
+    norder = np.count_nonzero(valid)
+    with _stage('route', norder):
+        acc[:] = nanval
+        if nvar:
+            acc[valid] = dx2 * var.reshape(n, nvar)[valid]
+        flowrouting(acc, ar, flowdir, levels, receiver)
+        if area is not None:
+            area.reshape(-1)[:] = np.where(valid, ar, np.float32(nanval))
+    with _stage('normalize', norder if avg is not None else 0):
+        if avg is not None:
+            norm = valid & (ar > 0)
+            if sums is None:
+                acc[norm] /= ar[norm, None]
+            else:
+                avg = avg.reshape(n, nvar)
+                avg[:] = acc
+                avg[norm] = acc[norm] / ar[norm, None]
+
+def flowterminals(terminal, flowdir, levels, receiver):
+    """
+    For every valid cell, the flat index of the cell its flow path ends in (a cell that doesn't route flow), or -1
+    if the path runs into NoData; filled from downstream to upstream so each cell copies its receiver's terminal.
+    """
+    term = terminal.reshape(-1)
+    term[:] = -1
+    routes = DIRINDEX[flowdir.reshape(-1)] >= 0
+    for cells in reversed(levels):
+        r = receiver[cells]
+        term[cells] = np.where(routes[cells], np.where(r >= 0, term[r], -1), cells)
+
+def upstreamavg(dem, var, out, dx, nanval, flg_avg, fillmode, epsilon, dirout=None):
+    """
+    upstreamavg() of upstreamcore.c: upstream sum or average of var ((Ny, Nx) or (Ny, Nx, nvar)) over dem, written
+    to out. dem is left untouched. Returns UPSTREAM_OK or UPSTREAM_ERR_PIT.
+    """
+    _begin('upstreamavg', dem.shape, var.size // dem.size)
+    z = dem.copy()
+    with _stage('hydrocorrect', z.size):
+        hydrocorrect(z, nanval, fillmode, epsilon)
+    flowdir = dirout if dirout is not None else np.empty(z.shape, dtype=np.uint8)
+    with _stage('directions', z.size):
+        status = d8directions(z, nanval, flowdir)
+    if status != UPSTREAM_OK:
+        return _end(status)
+    valid = z.reshape(-1) != nanval
+    with _stage('order', np.count_nonzero(valid)):
+        levels, receiver = routinglevels(flowdir, valid)
+    _route(var, None if flg_avg else out, out if flg_avg else None, None, dx, nanval, flowdir, valid, levels,
+           receiver)
+    return _end(UPSTREAM_OK)
+
+def upstreamproducts(dem, var, dx, nanval, fillmode, epsilon, areaout, sumout, avgout, filled, dirout):
+    """
+    upstreamproducts() of upstreamcore.c: any of the contributing area, upstream sum and average of var, filled DEM
+    and flow directions from one pass; outputs that are None are skipped. dem is left untouched.
+    """
+    _begin('upstreamproducts', dem.shape, 0 if var is None else var.size // dem.size)
+    if filled is None:
+        z = dem.copy()
+    else:
+        z = filled
+        z[:] = dem
+    with _stage('hydrocorrect', z.size):
+        hydrocorrect(z, nanval, fillmode, epsilon)
+    flowdir = dirout if dirout is not None else np.empty(z.shape, dtype=np.uint8)
+    with _stage('directions', z.size):
+        status = d8directions(z, nanval, flowdir)
+    if status != UPSTREAM_OK or (areaout is None and sumout is None and avgout is None):
+        return _end(status)
+    valid = z.reshape(-1) != nanval
+    with _stage('order', np.count_nonzero(valid)):
+        levels, receiver = routinglevels(flowdir, valid)
+    _route(var, sumout, avgout, areaout, dx, nanval, flowdir, valid, levels, receiver)
+    return _end(UPSTREAM_OK)
+
+def routegrid(dem, init, sums, nanval, dirout=None, terminal=None):
+    """
+    routegrid() of upstreamcore.c: route the already-scaled values in init over the hydrocorrected dem into sums,
+    optionally writing the flow direction grid to dirout and the end of every flow path to terminal.
+    """
+    _begin('routegrid', dem.shape, init.size // dem.size)
+    flowdir = dirout if dirout is not None else np.empty(dem.shape, dtype=np.uint8)
+    with _stage('directions', dem.size):
+        status = d8directions(dem, nanval, flowdir)
+    if status != UPSTREAM_OK:
+        return _end(status)
+    valid = dem.reshape(-1) != nanval
+    with _stage('order', np.count_nonzero(valid)):
+        levels, receiver = routinglevels(flowdir, valid)
+    _route(init, sums, None, None, 1.0, nanval, flowdir, valid, levels, receiver)
+    if terminal is not None:
+        with _stage('route', np.count_nonzero(valid)):
+            flowterminals(terminal, flowdir, levels, receiver)
+    return _end(UPSTREAM_OK)
+
+def flowtopology(dem, nanval, fillmode, epsilon, filled, dirout, orderout):
+    """
+    flowtopology() of upstreamcore.c: the hydrocorrected DEM (filled), flow directions (dirout) and a topological
+    routing order of the valid cells (the first norder entries of orderout). Returns (status, norder).
+    """
+    _begin('flowtopology', dem.shape, 0)
+    filled[:] = dem
+    with _stage('hydrocorrect', dem.size):
+        hydrocorrect(filled, nanval, fillmode, epsilon)
+    with _stage('directions', dem.size):
+        status = d8directions(filled, nanval, dirout)
+    if status != UPSTREAM_OK:
+        return _end(status), 0
+    valid = filled.reshape(-1) != nanval
+    with _stage('order', np.count_nonzero(valid)):
+        levels, _ = routinglevels(dirout, valid)
+    order = np.concatenate(levels) if levels else np.empty(0, dtype=np.intp)
+    orderout[:order.size] = order
+    return _end(UPSTREAM_OK), order.size
+
+def routetopology(flowdir, order, var, out, dx, nanval, flg_avg):
+    """
+    routetopology() of upstreamcore.c: the accumulation stage on a stored topology; cells missing from order are
+    NoData.
+    """
+    _begin('routetopology', flowdir.shape, var.size // flowdir.size)
+    valid = np.zeros(flowdir.size, dtype=bool)
+    valid[order] = True
+    with _stage('order', order.size):
+        levels, receiver = routinglevels(flowdir, valid)
+    _route(var, None if flg_avg else out, out if flg_avg else None, None, dx, nanval, flowdir, valid, levels,
+           receiver)
+    return _end(UPSTREAM_OK)
+
+def updatetopology(flowdir, dem, var, sums, dx, nanval, changed, area, avg):
+    """
+    updatetopology() of upstreamcore.c: recompute the upstream sums (and, if avg is given, the averages) of the
+    valid cells in changed and of every cell downstream of them, in place. Returns the recomputed cells in routing
+    order.
+    """
+    _begin('updatetopology', flowdir.shape, var.size // flowdir.size)
+    n = flowdir.size
+    nvar = var.size // n
+    z = dem.reshape(-1)
+    code = flowdir.reshape(-1)
+    d = DIRINDEX[code]
+    offsets = flow_offsets(flowdir.shape[1])
+    with _stage('order', changed.size):
+        # the union of the downstream paths, advancing every path one step at a time
+        affected = np.zeros(n, dtype=bool)
+        frontier = np.unique(changed[z[changed] != nanval])
+        cells = [frontier]
+        while frontier.size:
+            affected[frontier] = True
+            routes = frontier[d[frontier] >= 0]
+            r = np.unique(routes + offsets[d[routes]])
+            frontier = r[(z[r] != nanval) & ~affected[r]]
+            cells.append(frontier)
+        cells = np.sort(np.concatenate(cells))
+        # topological levels of the affected cells as in routinglevels, on their positions in cells
+        receiver = np.full(cells.size, -1, dtype=np.intp)
+        routes = np.flatnonzero(d[cells] >= 0)
+        r = cells[routes] + offsets[d[cells[routes]]]
+        into = affected[r]
+        receiver[routes[into]] = np.searchsorted(cells, r[into])
+        indeg = np.bincount(receiver[routes[into]], minlength=cells.size)
+        frontier = np.flatnonzero(indeg == 0)
+        levels = []
+        while frontier.size:
+            levels.append(cells[frontier])
+            r = receiver[frontier]
+            r, ndonors = np.unique(r[r >= 0], return_counts=True)
+            indeg[r] -= ndonors
+            frontier = r[indeg[r] == 0]
+    arr = var.reshape(n, nvar)
+    acc = sums.reshape(n, nvar)
+    dx2 = np.float32(dx) * np.float32(dx)
+    with _stage('route', cells.size):
+        # every cell pulls its donors one direction at a time in the C core's order, as in flowrouting
+        for level in levels:
+            acc[level] = dx2 * arr[level]
+            for bit in range(8):
+                donor = level - offsets[bit]
+                pulls = (donor >= 0) & (donor < n)
+                pulls[pulls] = code[donor[pulls]] == 1 << bit
+                if pulls.any():
+                    acc[level[pulls]] += acc[donor[pulls]]
+            if avg is not None:
+                ar = area.reshape(-1)[level]
+                norm = ar > 0
+                out = avg.reshape(n, nvar)
+                out[level] = acc[level]
+                out[level[norm]] = acc[level[norm]] / ar[norm, None]
+    _end(UPSTREAM_OK)
+    return np.concatenate(levels) if levels else np.empty(0, dtype=np.intp)
+
+def flowintervals(flowdir, order, first, count):
+    """
+    flowintervals() of upstreamcore.c: depth-first interval labels (first, count) of the flow forest of a stored
+    topology. Siblings may be walked in a different order than the C core's, which labels the same intervals
+    differently but equally validly.
+    """
+    _begin('flowintervals', flowdir.shape, 0)
+    valid = np.zeros(flowdir.size, dtype=bool)
+    valid[order] = True
+    with _stage('route', order.size):
+        levels, receiver = routinglevels(flowdir, valid)
+        size = count.reshape(-1)
+        size[:] = valid
+        for cells in levels:
+            r = receiver[cells]
+            np.add.at(size, r[r >= 0], size[cells[r >= 0]])
+        start = first.reshape(-1)
+        start[:] = -1
+        roots = np.flatnonzero(valid & (receiver < 0))
+        start[roots] = np.cumsum(size[roots]) - size[roots]
+        cursor = start + 1
+        # downstream to upstream; the donors of a receiver take consecutive runs after it
+        for cells in reversed(levels):
+            cells = cells[receiver[cells] >= 0]
+            if not cells.size:
+                continue
+            cells = cells[np.argsort(receiver[cells], kind='stable')]
+            r = receiver[cells]
+            sizes = size[cells]
+            total = np.cumsum(sizes)
+            group = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+            before = np.repeat(total[group] - sizes[group], np.diff(np.r_[group, cells.size]))
+            start[cells] = cursor[r] + total - sizes - before
+            cursor[r[group]] += np.add.reduceat(sizes, group)
+            cursor[cells] = start[cells] + 1
+    return _end(UPSTREAM_OK)
+
+def catchmentlabels(flowdir, order, outlets, labels):
+    """
+    catchmentlabels() of upstreamcore.c: the number of the first outlet on every cell's flow path (0 for none, and
+    for NoData cells even if they are listed as outlets), filled from downstream to upstream so each cell copies its
+    receiver's label.
+    """
+    _begin('catchmentlabels', flowdir.shape, 0)
+    valid = np.zeros(flowdir.size, dtype=bool)
+    valid[order] = True
+    with _stage('route', order.size):
+        levels, receiver = routinglevels(flowdir, valid)
+        lab = labels.reshape(-1)
+        lab[:] = 0
+        number = np.arange(1, outlets.size + 1)
+        onvalid = valid[outlets]
+        lab[outlets[onvalid]] = number[onvalid]
+        for cells in reversed(levels):
+            cells = cells[(lab[cells] == 0) & (receiver[cells] >= 0)]
+            lab[cells] = lab[receiver[cells]]
+    return _end(UPSTREAM_OK)
@@ -0,0 +1,191 @@
+"""
+Upstream sums, contributing areas and averages at points (culverts, outlets) without writing a full output raster.
+
+UpstreamIndex labels the D8 flow forest of a DEM's topology once with depth-first intervals (see flow_intervals):
+every cell and the cells upstream of it are one contiguous run of a pre-order walk from the outlets. With the prefix
+sums of each variable along that walk, the upstream sum at a cell is the difference of two prefix sums and its
+contributing area is the length of its run, so every query point costs O(1) once the index is built. Prefix sums are
+kept in float64; results match upstream_average to float32 rounding.
+
+Points are given in the raster CRS and can be snapped to the cell with the largest contributing area within a radius,
+which moves culverts digitized next to a channel onto it. The catchments of all points can be delineated together as
+one label raster (see catchment_labels) for per-culvert zonal statistics.
+"""
+import argparse
+import csv
+import os
+import numpy as np
+from upstreamlib import DEFAULT_NODATA, catchment_labels, flow_intervals, stack_variables
+from upstreamnumpy import DIRINDEX, flow_offsets
+
+QUERY_CHUNK = 1 << 22  # snap candidates (points times cells within the radius) examined at once
+
+class UpstreamIndex:
+    """
+    Reusable point-query index of a Topology with square cells of size dx. gt is the GDAL geotransform of the grid
+    (x = gt[0] + col * gt[1], y = gt[3] + row * gt[5] at cell corners); without it points are (col, row) cell
+    coordinates.
+    """
+    def __init__(self, topology, dx, gt=None):
+        self.topology = topology
+        self.first, self.count = flow_intervals(topology)
+        self.shape = self.first.shape
+        self.dx = dx
+        self.gt = gt if gt is not None else (0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+        first = self.first.reshape(-1)
+        valid = np.flatnonzero(first >= 0)
+        self.walk = np.empty(valid.size, dtype=valid.dtype)  # cell at every position of the walk
+        self.walk[first[valid]] = valid
+        self.prefix = {}
+
+    def add_variable(self, name, var):
+        """
+        Index var (a raster, a (Ny, Nx, nvar) stack or a list of rasters) under name for sum and mean queries.
+        """
+        var = stack_variables(var)
+        if var.shape[:2] != self.shape or var.ndim not in (2, 3):
+            raise ValueError(f'var must be a raster or a stack of rasters matching the index, '
+                             f'got {self.shape} and {var.shape}')
+        values = var.reshape(self.first.size, -1)[self.walk].astype(np.float64) * np.float64(self.dx) ** 2
+        prefix = np.zeros((values.shape[0] + 1, values.shape[1]))
+        np.cumsum(values, axis=0, out=prefix[1:])
+        self.prefix[name] = prefix if var.ndim == 3 else prefix[:, 0]
+
+    def cells(self, x, y, snap_radius=0.0):
+        """
+        (rows, cols) of the cells containing the points (x, y), each moved to the cell with the largest contributing
+        area whose center is within snap_radius (CRS units) of the center of that cell, nearest first on ties. Points
+        with no valid cell there get -1.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        gt = self.gt
+        Ny, Nx = self.shape
+        rows = np.floor((y - gt[3]) / gt[5]).astype(np.intp)
+        cols = np.floor((x - gt[0]) / gt[1]).astype(np.intp)
+        ri, rj = int(snap_radius / abs(gt[5])), int(snap_radius / abs(gt[1]))
+        di, dj = np.mgrid[-ri:ri + 1, -rj:rj + 1]
+        dist = np.hypot(di * gt[5], dj * gt[1]).reshape(-1)
+        nearest = np.argsort(dist, kind='stable')
+        nearest = nearest[dist[nearest] <= snap_radius]
+        di, dj = di.reshape(-1)[nearest], dj.reshape(-1)[nearest]
+        step = max(1, QUERY_CHUNK // di.size)
+        for p in range(0, rows.size, step):
+            ci = rows[p:p + step, None] + di
+            cj = cols[p:p + step, None] + dj
+            inside = (ci >= 0) & (ci < Ny) & (cj >= 0) & (cj < Nx)
+            size = np.where(inside, self.count[np.clip(ci, 0, Ny - 1), np.clip(cj, 0, Nx - 1)], 0)
+            best = np.argmax(size, axis=1)
+            pick = np.arange(best.size)
+            found = size[pick, best] > 0
+            rows[p:p + step] = np.where(found, ci[pick, best], -1)
+            cols[p:p + step] = np.where(found, cj[pick, best], -1)
+        return rows, cols
+
+    def query(self, x, y, snap_radius=0.0):
+        """
+        Upstream totals at the points (x, y): a dict with the (snapped) 'row' and 'col', the contributing 'area' and,
+        for every indexed variable, its upstream '<name>_sum' and area-normalized '<name>_mean' (with a trailing
+        variable axis for stacks). Points without a valid cell get NaN.
+        """
+        rows, cols = self.cells(x, y, snap_radius)
+        found = rows >= 0
+        start = self.first[rows[found], cols[found]]
+        ncells = self.count[rows[found], cols[found]]
+        area = np.full(rows.shape, np.nan)
+        area[found] = ncells * np.float64(self.dx) ** 2
+        result = {'row': rows, 'col': cols, 'area': area}
+        for name, prefix in self.prefix.items():
+            total = np.full(rows.shape + prefix.shape[1:], np.nan)
+            total[found] = prefix[start + ncells] - prefix[start]
+            result[f'{name}_sum'] = total
+            result[f'{name}_mean'] = total / (area if prefix.ndim == 1 else area[:, None])
+        return result
+
+    def catchments(self, rows, cols):
+        """
+        Catchment label raster of the outlet cells (rows, cols) (see catchment_labels; outlet i gets label i + 1) and
+        their area table: 'catchment_area' of the cells labeled with each outlet, 'contributing_area' of everything
+        upstream of it, nested catchments included, and 'downstream', the label of the next outlet downstream (0 for
+        none).
+        """
+        outlets = np.ravel_multi_index((rows, cols), self.shape)
+        labels = catchment_labels(self.topology, outlets)
+        dx2 = np.float64(self.dx) ** 2
+        d = DIRINDEX[np.asarray(self.topology.flowdir).reshape(-1)[outlets]]
+        receiver = outlets + flow_offsets(self.shape[1])[d]
+        table = {'catchment_area': np.bincount(labels.reshape(-1), minlength=outlets.size + 1)[1:] * dx2,
+                 'contributing_area': self.count.reshape(-1)[outlets] * dx2,
+                 'downstream': np.where(d >= 0, labels.reshape(-1)[np.where(d >= 0, receiver, 0)], 0)}
+        return labels, table
+
+def read_points(path, xfield='x', yfield='y'):
+    """
+    The rows of a CSV file of points and their x and y coordinates.
+    """
+    with open(path, newline='') as f:
+        records = list(csv.DictReader(f))
+    x = np.array([float(r[xfield]) for r in records])
+    y = np.array([float(r[yfield]) for r in records])
+    return records, x, y
+
+def write_results(path, records, result):
+    """
+    Write the point records with the query results appended as columns (one column per band of a stack).
+    """
+    columns = {}
+    for key, values in result.items():
+        if values.ndim == 2:
+            for b in range(values.shape[1]):
+                columns[f'{key}_{b + 1}'] = values[:, b]
+        else:
+            columns[key] = values
+    fields = (list(records[0]) if records else []) + list(columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for i, r in enumerate(records):
+            writer.writerow({**r, **{k: v[i].item() for k, v in columns.items()}})
+
+if __name__ == "__main__":
+
+    from upstreamcache import DEFAULT_CACHE_DIR, TopologyCache
+    from upstreamhandler import tiff_get_tags, tiff_to_array
+    from upstreamtiff import write_array
+
+    parser = argparse.ArgumentParser(description='Upstream sums, areas and averages at points.')
+    parser.add_argument('dem', help='DEM GeoTIFF')
+    parser.add_argument('points', help='CSV file of points in the DEM CRS')
+    parser.add_argument('variables', nargs='*', help='variable GeoTIFFs to sum and average upstream')
+    parser.add_argument('-o', '--output', required=True, help='output CSV: the points with the results appended')
+    parser.add_argument('--xy', nargs=2, default=('x', 'y'), metavar=('X', 'Y'),
+                        help='coordinate columns of the points (default: x y)')
+    parser.add_argument('--snap', type=float, default=0.0,
+                        help='snap points to the largest contributing area within this radius (default: 0)')
+    parser.add_argument('--fill', default='recursive', choices=['none', 'recursive', 'priorityflood'],
+                        help='hydrocorrection (default: %(default)s)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIR, help='topology cache (default: %(default)s)')
+    parser.add_argument('--labels', help='also write the catchment of every point as a label raster (GeoTIFF) and '
+                                         'add its label and catchment areas to the output')
+    args = parser.parse_args()
+
+    _, gt, proj, dx, _, _, nodata = tiff_get_tags(args.dem)
+    nodata = DEFAULT_NODATA if nodata is None else nodata
+    topology = TopologyCache(args.cache).get_or_build(tiff_to_array(args.dem), nodata, fill=args.fill)
+    index = UpstreamIndex(topology, dx, gt)
+    for path in args.variables:
+        index.add_variable(os.path.splitext(os.path.basename(path))[0], tiff_to_array(path))
+    records, x, y = read_points(args.points, *args.xy)
+    result = index.query(x, y, args.snap)
+    if args.labels:
+        # points without a valid cell get label 0 and no catchment
+        found = np.flatnonzero(result['row'] >= 0)
+        labels, table = index.catchments(result['row'][found], result['col'][found])
+        write_array(labels, args.labels, gt, proj, 0)
+        result['label'] = np.zeros(len(records), dtype=np.int32)
+        result['label'][found] = np.arange(1, found.size + 1)
+        for key, values in table.items():
+            result[key] = np.full(len(records), np.nan if key.endswith('area') else 0)
+            result[key][found] = values
+    write_results(args.output, records, result)
+    print(f"Results for {len(records)} points written to {args.output}")
@@ -0,0 +1,292 @@
+"""
+Long-running local upstream analytics service over HTTP.
+
+Every upstreamhandler.py run pays for GDAL startup, a compile, decoding the DEM, hydrocorrection and ordering before
+it routes anything. The service does that once per DEM and keeps the flow topology in memory, so a request for the
+upstream averages of new variable rasters or for upstream totals at points only pays for reading the variables and
+routing them.
+
+Requests are JSON POSTs to localhost and are served on their own threads:
+
+    POST /load     {"dem": path, "fill": "recursive"}  load and condition a DEM ahead of time
+    POST /average  {"dem": path, "variables": [paths], "output": path, "average": true}
+                   upstream averages (or sums) of the variables written to the output GeoTIFF, which must be
+                   under the output root (relative paths are taken relative to it)
+    POST /points   {"dem": path, "points": [[x, y], ...], "variables": {name: path}, "snap": 0.0}
+                   contributing areas and upstream sums and means at the points (see upstreamquery)
+    GET  /status   loaded DEMs and their memory
+    GET  /metrics  request counts, errors and latency percentiles per endpoint
+
+Loaded DEMs are evicted least recently used first once their topologies, and the point indexes built on them,
+exceed the memory cap. The C core keeps its state in globals, so engine calls are run one at a time (each is
+multithreaded itself) while file I/O and point queries run concurrently.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from upstreamcache import DEFAULT_CACHE_DIR, TopologyCache
+from upstreamlib import DEFAULT_NODATA, Topology, route_topology, set_threads
+from upstreamquery import UpstreamIndex
+
+DEFAULT_PORT = 8765
+DEFAULT_OUTPUT_ROOT = './data/output'  # /average only writes below this directory
+DEFAULT_MAX_BYTES = 8 * 1024**3  # memory cap of the loaded topologies and point indexes
+LATENCY_WINDOW = 10000  # latencies kept per endpoint for the percentiles
+
+engine_lock = threading.Lock()  # the C core (and its NumPy stand-in) keep per-call state in module globals
+
+class LoadedDem:
+    """
+    A DEM with its topology held in memory, its grid tags and, once points have been queried, its UpstreamIndex
+    with the variables indexed so far.
+    """
+    def __init__(self, path, fill, cache):
+        from upstreamhandler import tiff_get_tags, tiff_to_array
+
+        _, self.gt, self.proj, self.dx, _, _, nodata = tiff_get_tags(path)
+        self.nodata = DEFAULT_NODATA if nodata is None else nodata
+        self.path, self.fill = path, fill
+        dem = tiff_to_array(path)
+        with engine_lock:
+            topology = cache.get_or_build(dem, self.nodata, fill=fill)
+        del dem
+        # the cache hands out memory maps; keep the arrays resident
+        self.topology = Topology(*(np.array(a) for a in topology))
+        self.index = None
+        self.variables = {}  # indexed variable name: (path, modification time)
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        nbytes = sum(a.nbytes for a in self.topology)
+        if self.index is not None:
+            nbytes += self.index.first.nbytes + self.index.count.nbytes + self.index.walk.nbytes
+            nbytes += sum(p.nbytes for p in self.index.prefix.values())
+        return nbytes
+
+    def query_points(self, x, y, variables, snap_radius=0.0):
+        """
+        UpstreamIndex.query at the points (x, y) with the variables ({name: GeoTIFF path}) indexed, (re)indexing any
+        that are new or whose file changed since. Queries of one DEM run one at a time; they are O(1) per point.
+        """
+        from upstreamhandler import tiffs_to_stack
+
+        with self.lock:
+            if self.index is None:
+                with engine_lock:
+                    self.index = UpstreamIndex(self.topology, self.dx, self.gt)
+            for name, path in variables.items():
+                stamp = (path, os.path.getmtime(path))
+                if self.variables.get(name) != stamp:
+                    self.index.add_variable(name, tiffs_to_stack([path]))
+                    self.variables[name] = stamp
+            return self.index.query(x, y, snap_radius)
+
+class DemStore:
+    """
+    Loaded DEMs by (path, fill), least recently used first, evicted once they take more than max_bytes. A DEM is
+    loaded only once even when several requests ask for it at the same time. Outputs are only written below
+    output_root.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, output_root=DEFAULT_OUTPUT_ROOT):
+        self.cache = TopologyCache(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(output_root, exist_ok=True)
+        self.output_root = os.path.realpath(output_root)
+        self.dems = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}  # (path, fill): lock held while that DEM loads
+
+    def get(self, path, fill='recursive'):
+        """
+        The LoadedDem of path, loading it first if needed.
+        """
+        key = (os.path.abspath(path), fill)
+        with self.lock:
+            if key in self.dems:
+                self.dems.move_to_end(key)
+                return self.dems[key]
+            loading = self.loading.setdefault(key, threading.Lock())
+        with loading:
+            with self.lock:
+                if key in self.dems:
+                    return self.dems[key]
+            try:
+                dem = LoadedDem(path, fill, self.cache)
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+            with self.lock:
+                self.dems[key] = dem
+                self.evict(keep=key)
+            return dem
+
+    def output_path(self, path):
+        """
+        path resolved against the output root (symbolic links followed); raises ValueError if it lies outside it.
+        """
+        resolved = os.path.realpath(os.path.join(self.output_root, path))
+        if os.path.commonpath([self.output_root, resolved]) != self.output_root or resolved == self.output_root:
+            raise ValueError(f'output {path} is not under the output root {self.output_root}')
+        return resolved
+
+    def evict(self, keep=None):
+        """
+        Drop least recently used DEMs (never keep) until the rest fit in max_bytes; call with the lock held.
+        """
+        total = sum(dem.nbytes for dem in self.dems.values())
+        for key in list(self.dems):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                total -= self.dems.pop(key).nbytes
+                logging.getLogger('upstream.progress').info(f"evicted {key[0]} ({key[1]})")
+
+    def status(self):
+        with self.lock:
+            return [{'dem': path, 'fill': fill, 'shape': list(dem.topology.flowdir.shape), 'bytes': dem.nbytes,
+                     'variables': sorted(dem.variables)} for (path, fill), dem in self.dems.items()]
+
+class Metrics:
+    """
+    Request count, error count and recent latencies of every endpoint.
+    """
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {'count': 0, 'errors': 0,
+                                                         'latencies': deque(maxlen=self.window)})
+            entry['count'] += 1
+            entry['errors'] += int(error)
+            entry['latencies'].append(seconds)
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for endpoint, entry in self.endpoints.items():
+                latencies = np.array(entry['latencies'])
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies.size else (0.0, 0.0, 0.0)
+                summary[endpoint] = {'count': entry['count'], 'errors': entry['errors'],
+                                     'mean_seconds': float(latencies.mean()) if latencies.size else 0.0,
+                                     'p50_seconds': float(p50), 'p95_seconds': float(p95), 'p99_seconds': float(p99)}
+            return summary
+
+def handle_load(store, request):
+    dem = store.get(request['dem'], request.get('fill', 'recursive'))
+    return {'dem': dem.path, 'shape': list(dem.topology.flowdir.shape), 'bytes': dem.nbytes}
+
+def handle_average(store, request):
+    from upstreamhandler import array_to_tiff, tiffs_to_stack
+
+    output = store.output_path(request['output'])
+    dem = store.get(request['dem'], request.get('fill', 'recursive'))
+    var = tiffs_to_stack(request['variables'])
+    out = np.empty_like(var)
+    with engine_lock:
+        route_topology(dem.topology, var, out, dem.dx, dem.nodata, request.get('average', True))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    array_to_tiff(out, output, dem.gt, dem.proj, dem.nodata)
+    return {'output': output}
+
+def handle_points(store, request):
+    dem = store.get(request['dem'], request.get('fill', 'recursive'))
+    points = np.asarray(request['points'], dtype=np.float64).reshape(-1, 2)
+    variables = request.get('variables', {})
+    result = dem.query_points(points[:, 0], points[:, 1], variables, request.get('snap', 0.0))
+    with store.lock:
+        store.evict(keep=(os.path.abspath(dem.path), dem.fill))
+    # only the requested variables, NaN (no valid cell) as null
+    keep = {'row', 'col', 'area'} | {f'{name}_{stat}' for name in variables for stat in ('sum', 'mean')}
+    return {k: np.where(np.isnan(v), None, v).tolist() if v.dtype.kind == 'f' else v.tolist()
+            for k, v in result.items() if k in keep}
+
+ENDPOINTS = {'/load': handle_load, '/average': handle_average, '/points': handle_points}
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON request handler of the service; the server carries the DemStore (store) and Metrics (metrics).
+    """
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, {'dems': self.server.store.status()})
+        elif self.path == '/metrics':
+            self._reply(200, self.server.metrics.summary())
+        else:
+            self._reply(404, {'error': f'unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        if self.path not in ENDPOINTS:
+            self._reply(404, {'error': f'unknown endpoint {self.path}'})
+            return
+        start = time.perf_counter()
+        status = 200
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            body = ENDPOINTS[self.path](self.server.store, request)
+        except (KeyError, ValueError, TypeError, FileNotFoundError) as e:
+            status, body = 400, {'error': f'{type(e).__name__}: {e}'}
+        except Exception as e:
+            logging.getLogger('upstream.progress').exception(f"{self.path} failed")
+            status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+        seconds = time.perf_counter() - start
+        self.server.metrics.record(self.path, seconds, status != 200)
+        body['seconds'] = seconds
+        self._reply(status, body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('upstream.progress').info(f"{self.address_string()} {format % args}")
+
+def make_server(host='127.0.0.1', port=DEFAULT_PORT, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                output_root=DEFAULT_OUTPUT_ROOT):
+    """
+    A ThreadingHTTPServer for the service, writing /average outputs only below output_root; call serve_forever()
+    on it.
+    """
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.store = DemStore(cache_dir, max_bytes, output_root)
+    server.metrics = Metrics()
+    return server
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve upstream averages and point queries from warm DEMs.')
+    parser.add_argument('--host', default='127.0.0.1', help='default: %(default)s (local only)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='default: %(default)s')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIR, help='topology cache (default: %(default)s)')
+    parser.add_argument('--max-gb', type=float, default=DEFAULT_MAX_BYTES / 1024**3,
+                        help='memory cap of the loaded DEMs in GiB (default: %(default)s)')
+    parser.add_argument('--output-root', default=DEFAULT_OUTPUT_ROOT,
+                        help='directory /average may write outputs to (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='routing threads (default: all cores)')
+    parser.add_argument('--preload', nargs='*', default=[], help='DEM GeoTIFFs to load at startup')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    set_threads(args.threads)
+    server = make_server(args.host, args.port, args.cache, int(args.max_gb * 1024**3), args.output_root)
+    for path in args.preload:
+        server.store.get(path)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
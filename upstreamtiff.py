@@ -0,0 +1,131 @@
+"""
+Block-by-block GeoTIFF output for the upstream products: tiled BigTIFFs compressed with a predictor and carrying
+internal overviews, or Cloud-Optimized GeoTIFFs (COGs) for serving map tiles.
+
+Blocks are handed to GDAL as soon as they are computed and compressed on all cores (NUM_THREADS), so the output is
+never held in memory as a whole. The COG driver can only copy a finished dataset, so a COG is first written to a
+tiled scratch GeoTIFF next to the output and translated once the writer is closed.
+"""
+import os
+import time
+import numpy as np
+from osgeo import gdal
+from upstreamlib import emit_event
+
+COMPRESSION = 'ZSTD'  # or 'DEFLATE'; falls back to DEFLATE when GDAL is built without ZSTD
+BLOCK_SIZE = 512
+GDAL_TYPES = {'float32': gdal.GDT_Float32, 'uint8': gdal.GDT_Byte, 'int32': gdal.GDT_Int32}
+
+def compression(compress=COMPRESSION):
+    """
+    compress if the GTiff driver supports it, DEFLATE otherwise.
+    """
+    options = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return compress if compress in options else 'DEFLATE'
+
+def creation_options(dtype, compress=COMPRESSION, cog=False):
+    """
+    GDAL creation options for a compressed tiled GeoTIFF (or COG) of the given dtype. Floating point rasters use the
+    floating point predictor; integer rasters (flow direction codes, catchment labels) are categorical and compress
+    better without one.
+    """
+    floating = np.dtype(dtype).kind == 'f'
+    options = [f'COMPRESS={compression(compress)}', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+    if cog:
+        options += [f'BLOCKSIZE={BLOCK_SIZE}', 'PREDICTOR=' + ('FLOATING_POINT' if floating else 'NO'),
+                    'OVERVIEWS=AUTO', 'RESAMPLING=' + overview_resampling(dtype)]
+    else:
+        options += ['TILED=YES', f'BLOCKXSIZE={BLOCK_SIZE}', f'BLOCKYSIZE={BLOCK_SIZE}',
+                    f'PREDICTOR={3 if floating else 1}']
+    return options
+
+def overview_resampling(dtype):
+    """
+    Averages for continuous rasters, nearest neighbor for categorical (integer) ones.
+    """
+    return 'AVERAGE' if np.dtype(dtype).kind == 'f' else 'NEAREST'
+
+def overview_factors(Nx, Ny):
+    """
+    Decimation factors 2, 4, 8, ... down to the first overview that fits in one block.
+    """
+    factors = []
+    f = 2
+    while max(Nx, Ny) / (f // 2) > BLOCK_SIZE:
+        factors.append(f)
+        f *= 2
+    return factors
+
+class TiffWriter:
+    """
+    Write a raster block by block to a compressed tiled GeoTIFF (or a COG if cog=True); overviews are added on
+    close. Blocks are (rows, cols) or (rows, cols, bands) arrays; writing windows aligned to BLOCK_SIZE keeps GDAL
+    from recompressing partially written blocks.
+    """
+    def __init__(self, path, Nx, Ny, nbands=1, dtype=np.float32, gt=None, proj=None, nodata=None, cog=False,
+                 compress=COMPRESSION):
+        self.path, self.cog, self.compress = path, cog, compress
+        self.dtype = np.dtype(dtype)
+        self.Nx, self.Ny, self.nbands = Nx, Ny, nbands
+        self.scratch = path + '.tmp.tif' if cog else path
+        self.ds = gdal.GetDriverByName('GTiff').Create(self.scratch, Nx, Ny, nbands, GDAL_TYPES[self.dtype.name],
+                                                       options=creation_options(self.dtype, compress))
+        if self.ds is None:
+            raise IOError(f"Could not create {self.scratch}")
+        if gt is not None:
+            self.ds.SetGeoTransform(gt)
+        if proj is not None:
+            self.ds.SetProjection(proj)
+        if nodata is not None:
+            for b in range(nbands):
+                self.ds.GetRasterBand(b + 1).SetNoDataValue(nodata)
+
+    def write(self, i0, j0, block):
+        block = np.asarray(block, dtype=self.dtype)
+        for b in range(self.nbands):
+            self.ds.GetRasterBand(b + 1).WriteArray(block[:, :, b] if block.ndim == 3 else block, xoff=j0, yoff=i0)
+
+    def close(self, overviews=True):
+        """
+        Finish the file: build internal overviews, or translate the scratch file into the COG (which builds its
+        own overviews).
+        """
+        if self.cog:
+            self.ds.FlushCache()
+            options = creation_options(self.dtype, self.compress, cog=True)
+            if not overviews:
+                options = [o for o in options if not o.startswith('OVERVIEWS=')] + ['OVERVIEWS=NONE']
+            gdal.Translate(self.path, self.ds, format='COG', creationOptions=options)
+            self.ds = None
+            os.remove(self.scratch)
+            return self.path
+        factors = overview_factors(self.Nx, self.Ny)
+        if overviews and factors:
+            config = {'COMPRESS_OVERVIEW': compression(self.compress), 'GDAL_NUM_THREADS': 'ALL_CPUS',
+                      'PREDICTOR_OVERVIEW': '3' if self.dtype.kind == 'f' else '1'}
+            previous = {k: gdal.GetConfigOption(k) for k in config}
+            for k, v in config.items():
+                gdal.SetConfigOption(k, v)
+            try:
+                self.ds.BuildOverviews(overview_resampling(self.dtype), factors)
+            finally:
+                for k, v in previous.items():
+                    gdal.SetConfigOption(k, v)
+        self.ds.FlushCache()
+        self.ds = None
+        return self.path
+
+def write_array(arr, path, gt, proj, nodata, cog=False, compress=COMPRESSION, overviews=True):
+    """
+    Write a 2D or (Ny, Nx, nbands) array (or memmap) to a compressed tiled GeoTIFF or COG, one strip of blocks at a
+    time.
+    """
+    start = time.perf_counter()
+    Ny, Nx = arr.shape[:2]
+    writer = TiffWriter(path, Nx, Ny, arr.shape[2] if arr.ndim == 3 else 1, arr.dtype, gt, proj, nodata, cog,
+                        compress)
+    for i0 in range(0, Ny, BLOCK_SIZE):
+        writer.write(i0, 0, arr[i0:i0 + BLOCK_SIZE])
+    writer.close(overviews)
+    emit_event('write', path=path, bytes=os.path.getsize(path), seconds=time.perf_counter() - start)
+    return path
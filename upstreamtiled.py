@@ -0,0 +1,293 @@
+"""
+Out-of-core tiled upstream averaging for DEMs that do not fit in memory.
+
+The DEM and variables are read one tile at a time, through windowed GDAL reads or memory-mapped .flt files. Each tile
+is padded with a one-cell halo so flow directions along tile edges match the untiled result. Pass 1 routes every tile
+on its own and records what flows out of it into its neighbors. Those fluxes form a boundary graph with one node per
+edge cell that receives flow from another tile; the graph is solved in topological order. Pass 2 routes every tile
+again with the inflow from upstream tiles injected at its entry cells and writes the finished tile. Peak memory is set
+by the tile size, which is derived from a user memory budget.
+
+The DEM must already be hydrocorrected: depression filling needs the whole DEM and cannot be done tile by tile.
+"""
+import argparse
+import logging
+import numpy as np
+from osgeo import gdal
+from upstreamlib import DEFAULT_NODATA, emit_event, log_events, route_grid, set_event_callback, set_threads
+from upstreamtiff import BLOCK_SIZE, TiffWriter
+
+DEFAULT_MEMORY_BUDGET = 2 * 1024**3  # bytes
+MIN_TILE = 64
+# per-cell bytes held while a tile is routed: DEM, flow direction, terminal index, the C core's work arrays and,
+# per channel (each variable plus the area), the init, sums and read buffers
+BYTES_PER_CELL = 44
+BYTES_PER_CELL_PER_CHANNEL = 16
+
+class FltRaster:
+    """
+    Memory-mapped raw float32 raster, row-major with pixel-interleaved bands.
+    """
+    def __init__(self, path, Nx, Ny, nbands=1, mode='r'):
+        self.Nx, self.Ny, self.nbands = Nx, Ny, nbands
+        self.arr = np.memmap(path, dtype=np.float32, mode=mode, shape=(Ny, Nx, nbands))
+
+    def read(self, i0, i1, j0, j1):
+        return np.array(self.arr[i0:i1, j0:j1, :])
+
+    def write(self, i0, j0, block):
+        self.arr[i0:i0 + block.shape[0], j0:j0 + block.shape[1], :] = block
+
+    def close(self):
+        if self.arr.mode != 'r':
+            self.arr.flush()
+        self.arr = None
+
+class GdalRaster:
+    """
+    Windowed access to a GDAL raster; blocks are (rows, cols, bands). Output rasters are compressed tiled BigTIFFs
+    or COGs written through upstreamtiff, so tiles are compressed and stored as they are finished.
+    """
+    def __init__(self, path, mode='r', like=None, nbands=1, dtype=np.float32, nodata=None, cog=False):
+        self.writer = None
+        if mode == 'r':
+            self.ds = gdal.Open(path)
+            if self.ds is None:
+                raise FileNotFoundError(f"Could not open raster: {path}")
+        else:
+            self.writer = TiffWriter(path, like.RasterXSize, like.RasterYSize, nbands, dtype, like.GetGeoTransform(),
+                                     like.GetProjection(), nodata, cog)
+            self.ds = self.writer.ds
+        self.Nx, self.Ny, self.nbands = self.ds.RasterXSize, self.ds.RasterYSize, self.ds.RasterCount
+
+    def read(self, i0, i1, j0, j1):
+        block = self.ds.ReadAsArray(j0, i0, j1 - j0, i1 - i0)
+        return block[:, :, None] if block.ndim == 2 else np.moveaxis(block, 0, -1)
+
+    def write(self, i0, j0, block):
+        for b in range(block.shape[2]):
+            self.ds.GetRasterBand(b + 1).WriteArray(block[:, :, b], xoff=j0, yoff=i0)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.ds.FlushCache()
+        self.ds = None
+
+def open_raster(path, shape=None, nbands=1):
+    """
+    Open an input raster: .flt files are memory-mapped and need shape=(Ny, Nx); anything else goes through GDAL.
+    """
+    if path.lower().endswith('.flt'):
+        if shape is None:
+            raise ValueError(f"shape=(Ny, Nx) is required to read {path}")
+        return FltRaster(path, shape[1], shape[0], nbands)
+    return GdalRaster(path)
+
+def tile_size(memory_budget, nvar):
+    """
+    Side length of the square tiles that keep one routed tile within memory_budget bytes, rounded down to whole
+    GeoTIFF blocks when tiles are at least a block wide so every output block is written exactly once.
+    """
+    bytes_per_cell = BYTES_PER_CELL + BYTES_PER_CELL_PER_CHANNEL * (nvar + 1)
+    tile = max(MIN_TILE, int(np.sqrt(memory_budget / bytes_per_cell)) - 2)
+    return tile - tile % BLOCK_SIZE if tile >= BLOCK_SIZE else tile
+
+def tile_windows(Nx, Ny, tile):
+    """
+    Yield (i0, i1, j0, j1) for every tile of a Ny x Nx grid, row by row.
+    """
+    for i0 in range(0, Ny, tile):
+        for j0 in range(0, Nx, tile):
+            yield i0, min(i0 + tile, Ny), j0, min(j0 + tile, Nx)
+
+class TiledRouter:
+    """
+    Reads padded tiles of the DEM and variables and routes them with route_grid.
+    """
+    def __init__(self, dem, variables, dx, nodata):
+        self.dem, self.variables = dem, variables
+        self.Nx, self.Ny = dem.Nx, dem.Ny
+        self.nvar = sum(v.nbands for v in variables)
+        self.cellarea = np.float32(dx * dx)
+        self.nodata = nodata
+
+    def route(self, i0, i1, j0, j1, inflow_idx=None, inflow=None, flowdir=None):
+        """
+        Route the tile [i0:i1, j0:j1] padded with a one-cell halo. Halo cells contribute nothing themselves, so what
+        they collect is exactly what the tile sends across its edges. inflow is added at the cells with global flat
+        indices inflow_idx. Returns the padded window origin, the core slices, the DEM, sums and terminals.
+        """
+        pi0, pi1, pj0, pj1 = max(i0 - 1, 0), min(i1 + 1, self.Ny), max(j0 - 1, 0), min(j1 + 1, self.Nx)
+        core = (slice(i0 - pi0, i1 - pi0), slice(j0 - pj0, j1 - pj0))
+        dem = self.dem.read(pi0, pi1, pj0, pj1)[:, :, 0]
+        init = np.zeros(dem.shape + (self.nvar + 1,), dtype=np.float32)
+        init[core + (slice(0, self.nvar),)] = np.concatenate([v.read(i0, i1, j0, j1) for v in self.variables],
+                                                             axis=2) * self.cellarea
+        init[core + (self.nvar,)] = self.cellarea
+        if inflow_idx is not None and len(inflow_idx):
+            rows, cols = inflow_idx // self.Nx - pi0, inflow_idx % self.Nx - pj0
+            init[rows, cols, :] += inflow.astype(np.float32)
+        sums = np.empty_like(init)
+        terminal = np.empty(dem.shape, dtype=np.int64)
+        route_grid(dem, init, sums, self.nodata, flowdir=flowdir, terminal=terminal)
+        return (pi0, pj0), core, dem, sums, terminal
+
+    def to_global(self, local, origin, width):
+        """
+        Convert flat indices within a padded tile (width columns, origin (pi0, pj0)) to flat indices in the raster.
+        """
+        return (local // width + origin[0]) * self.Nx + local % width + origin[1]
+
+def boundary_fluxes(router, tile):
+    """
+    Pass 1: route every tile on its own. Returns the global cells that receive flow from a neighboring tile with the
+    flux each receives, and, for every cell on a tile edge, the global cell where its flow path leaves the tile
+    (or -1 if it ends inside the tile).
+    """
+    flux_idx, flux, edge_idx, edge_exit = [], [], [], []
+    ntiles = -(-router.Nx // tile) * -(-router.Ny // tile)
+    for t, (i0, i1, j0, j1) in enumerate(tile_windows(router.Nx, router.Ny, tile)):
+        origin, core, dem, sums, terminal = router.route(i0, i1, j0, j1)
+        emit_event('tile', phase=1, done=t + 1, total=ntiles)
+        width = dem.shape[1]
+        halo = np.ones(dem.shape, dtype=bool)
+        halo[core] = False
+        valid = dem != router.nodata
+
+        # what the tile delivers to each halo cell; the area channel is positive wherever anything arrived
+        receives = halo & valid & (sums[:, :, router.nvar] > 0)
+        flux_idx.append(router.to_global(np.flatnonzero(receives), origin, width))
+        flux.append(sums[receives].astype(np.float64))
+
+        # where the flow of each edge cell leaves the tile: its terminal if that is a halo cell
+        ring = np.zeros(dem.shape, dtype=bool)
+        ring[core] = True
+        ring[core[0].start + 1:core[0].stop - 1, core[1].start + 1:core[1].stop - 1] = False
+        ring &= valid
+        local = np.flatnonzero(ring)
+        term = terminal.ravel()[local]
+        leaves = (term >= 0) & halo.ravel()[np.maximum(term, 0)]
+        edge_idx.append(router.to_global(local, origin, width))
+        edge_exit.append(np.where(leaves, router.to_global(term, origin, width), -1))
+
+    flux_idx, flux = np.concatenate(flux_idx), np.concatenate(flux)
+    edge_idx, edge_exit = np.concatenate(edge_idx), np.concatenate(edge_exit)
+
+    # a halo cell can be shared by up to three tiles; add up what each of them delivers
+    entries, inverse = np.unique(flux_idx, return_inverse=True)
+    inflow = np.zeros((len(entries), flux.shape[1]))
+    np.add.at(inflow, inverse, flux)
+    order = np.argsort(edge_idx)
+    exits = edge_exit[order][np.searchsorted(edge_idx[order], entries)]
+    return entries, inflow, exits
+
+def solve_boundary_graph(entries, inflow, exits):
+    """
+    Total inflow at every entry cell: what its neighbors deliver directly plus everything passed through from entries
+    upstream. Each entry drains to at most one other entry (the cell where its flow leaves its tile), so the graph is
+    a forest and is solved level by level from the leaves.
+    """
+    succ = np.full(len(entries), -1)
+    leaves_tile = exits >= 0
+    succ[leaves_tile] = np.searchsorted(entries, exits[leaves_tile])
+    indeg = np.bincount(succ[succ >= 0], minlength=len(entries))
+    total = inflow.copy()
+    frontier = np.flatnonzero(indeg == 0)
+    while len(frontier):
+        frontier = frontier[succ[frontier] >= 0]
+        np.add.at(total, succ[frontier], total[frontier])
+        np.subtract.at(indeg, succ[frontier], 1)
+        frontier = np.unique(succ[frontier])
+        frontier = frontier[indeg[frontier] == 0]
+    return total
+
+def tiled_upstream_average(deminfile, varinfiles, outfile, dx=None, nodata=None, average=True,
+                           memory_budget=DEFAULT_MEMORY_BUDGET, shape=None, flowdirfile=None, cog=False):
+    """
+    Upstream average (or sum if average=False) of the variable rasters over a hydrocorrected DEM, computed tile by
+    tile so that peak memory stays near memory_budget bytes. Inputs may be GeoTIFFs (or anything GDAL reads) or
+    single-band .flt files, which then need shape=(Ny, Nx), dx and nodata. The result is written to outfile (.flt, or
+    a compressed tiled GeoTIFF with overviews, a COG if cog=True) with one band per variable band; flowdirfile
+    optionally receives the D8 directions.
+    """
+    dem = open_raster(deminfile, shape)
+    variables = [open_raster(f, shape) for f in varinfiles]
+    if isinstance(dem, GdalRaster):
+        dx = dem.ds.GetGeoTransform()[1] if dx is None else dx
+        nodata = dem.ds.GetRasterBand(1).GetNoDataValue() if nodata is None else nodata
+    if dx is None:
+        raise ValueError('dx is required for .flt inputs')
+    nodata = DEFAULT_NODATA if nodata is None else nodata
+    router = TiledRouter(dem, variables, dx, nodata)
+    tile = tile_size(memory_budget, router.nvar)
+
+    entries, inflow, exits = boundary_fluxes(router, tile)
+    inflow = solve_boundary_graph(entries, inflow, exits)
+
+    # Pass 2: reroute each tile with its inflow and write it out
+    if outfile.lower().endswith('.flt'):
+        out = FltRaster(outfile, router.Nx, router.Ny, router.nvar, mode='w+')
+        dirs = FltRaster(flowdirfile, router.Nx, router.Ny, 1, mode='w+') if flowdirfile else None
+    else:
+        out = GdalRaster(outfile, 'w', dem.ds, router.nvar, nodata=nodata, cog=cog)
+        dirs = GdalRaster(flowdirfile, 'w', dem.ds, 1, np.uint8, cog=cog) if flowdirfile else None
+    ntx = -(-router.Nx // tile)
+    entry_tile = (entries // router.Nx // tile) * ntx + entries % router.Nx // tile
+    by_tile = np.argsort(entry_tile, kind='stable')
+    bounds = np.searchsorted(entry_tile[by_tile], np.arange(-(-router.Ny // tile) * ntx + 1))
+    ntiles = ntx * -(-router.Ny // tile)
+    for t, (i0, i1, j0, j1) in enumerate(tile_windows(router.Nx, router.Ny, tile)):
+        sel = by_tile[bounds[t]:bounds[t + 1]]
+        flowdir = None
+        if dirs is not None:
+            flowdir = np.empty((min(i1 + 1, router.Ny) - max(i0 - 1, 0), min(j1 + 1, router.Nx) - max(j0 - 1, 0)),
+                               dtype=np.uint8)
+        _, core, tdem, sums, _ = router.route(i0, i1, j0, j1, entries[sel], inflow[sel], flowdir)
+        block = sums[core][:, :, :router.nvar]
+        if average:
+            area = sums[core][:, :, router.nvar:]
+            valid = (tdem[core] != nodata)[:, :, None] & (area > 0)
+            block = np.where(valid, block / np.where(valid, area, 1), block)
+        out.write(i0, j0, block)
+        if dirs is not None:
+            dirs.write(i0, j0, flowdir[core][:, :, None].astype(np.float32 if isinstance(dirs, FltRaster) else np.uint8))
+        emit_event('tile', phase=2, done=t + 1, total=ntiles)
+
+    for r in [dem, out] + variables + ([dirs] if dirs is not None else []):
+        r.close()
+    return outfile
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Tiled upstream averaging for DEMs larger than memory.')
+    parser.add_argument('dem', help='hydrocorrected DEM (GeoTIFF, or .flt with --shape, --dx and --nodata)')
+    parser.add_argument('variables', nargs='+', help='variable rasters to average (all bands)')
+    parser.add_argument('-o', '--output', required=True, help='output raster (.tif or .flt)')
+    parser.add_argument('-m', '--memory', type=float, default=DEFAULT_MEMORY_BUDGET / 1024**3,
+                        help='memory budget in GiB (default: %(default)s)')
+    parser.add_argument('-s', '--sum', action='store_true', help='write the upstream sum instead of the average')
+    parser.add_argument('--shape', type=int, nargs=2, metavar=('NY', 'NX'), help='grid size of .flt inputs')
+    parser.add_argument('--dx', type=float, help='grid spacing (read from the DEM if omitted)')
+    parser.add_argument('--nodata', type=float, help='NoData value (read from the DEM if omitted)')
+    parser.add_argument('--flowdir', help='optional output raster for the D8 flow directions')
+    parser.add_argument('--cog', action='store_true', help='write Cloud-Optimized GeoTIFFs')
+    parser.add_argument('-t', '--threads', type=int, default=0,
+                        help='threads for routing each tile, 0 = all cores (default: %(default)s)')
+    parser.add_argument('--events', help='write every instrumentation event to this file as JSON lines')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log the progress of every tile')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    logging.getLogger('upstream.events').propagate = False
+    if args.events:
+        events = logging.getLogger('upstream.events')
+        events.setLevel(logging.INFO)
+        events.addHandler(logging.FileHandler(args.events))
+    set_event_callback(log_events())
+    set_threads(args.threads)
+
+    tiled_upstream_average(args.dem, args.variables, args.output, args.dx, args.nodata, not args.sum,
+                           int(args.memory * 1024**3), args.shape, args.flowdir, args.cog)
+    print(f"Output written to {args.output}")
@@ -22,6 +22,18 @@ void free_ivector(int *v, long nl, long nh)
     free((FREE_ARG) (v+nl-NR_END));
 }
 
+void free_lvector(long *v, long nl, long nh)
+/* free a long vector allocated with lvector() */
+{
+    free((FREE_ARG) (v+nl-NR_END));
+}
+
+void free_cvector(unsigned char *v, long nl, long nh)
+/* free an unsigned char vector allocated with cvector() */
+{
+    free((FREE_ARG) (v+nl-NR_END));
+}
+
 void free_vector(float *v, long nl, long nh)
 /* free a float vector allocated with vector() */
 {
@@ -40,7 +52,7 @@ float *vector(long nl, long nh)
 {
     float *v;
 
-    v=(float *)malloc((unsigned int) ((nh-nl+1+NR_END)*sizeof(float)));
+    v=(float *)malloc((size_t) ((nh-nl+1+NR_END)*sizeof(float)));
     if (!v) nrerror("allocation failure in vector()");
     return v-nl+NR_END;
 }
@@ -50,11 +62,69 @@ int *ivector(long nl, long nh)
 {
     int *v;
 
-    v=(int *)malloc((unsigned int) ((nh-nl+1+NR_END)*sizeof(int)));
+    v=(int *)malloc((size_t) ((nh-nl+1+NR_END)*sizeof(int)));
     if (!v) nrerror("allocation failure in ivector()");
     return v-nl+NR_END;
 }
 
+long *lvector(long nl, long nh)
+/* allocate a long vector with subscript range v[nl..nh] */
+{
+    long *v;
+
+    v=(long *)malloc((size_t) ((nh-nl+1+NR_END)*sizeof(long)));
+    if (!v) nrerror("allocation failure in lvector()");
+    return v-nl+NR_END;
+}
+
+unsigned char *cvector(long nl, long nh)
+/* allocate an unsigned char vector with subscript range v[nl..nh] */
+{
+    unsigned char *v;
+
+    v=(unsigned char *)malloc((size_t) ((nh-nl+1+NR_END)*sizeof(unsigned char)));
+    if (!v) nrerror("allocation failure in cvector()");
+    return v-nl+NR_END;
+}
+
+unsigned char *zero_cvector(long nl, long nh)
+/* allocate a zero-initialized unsigned char vector with subscript range v[nl..nh]; free it with free_cvector().
+   only the pages that are written to take up memory, so it suits large, sparsely used flag arrays */
+{
+    unsigned char *v;
+
+    v=(unsigned char *)calloc((size_t) (nh-nl+1+NR_END),sizeof(unsigned char));
+    if (!v) nrerror("allocation failure in zero_cvector()");
+    return v-nl+NR_END;
+}
+
+float **convert_matrix(float *a, long nrl, long nrh, long ncl, long nch)
+/* allocate a float matrix m[nrl..nrh][ncl..nch] that points to the row-major array a[0..(nrh-nrl+1)*(nch-ncl+1)-1]
+   without copying it */
+{
+    long i,j,nrow=nrh-nrl+1,ncol=nch-ncl+1;
+    float **m;
+
+    /* allocate pointers to rows */
+    m=(float **) malloc((size_t) ((nrow+NR_END)*sizeof(float*)));
+    if (!m) nrerror("allocation failure in convert_matrix()");
+    m += NR_END;
+    m -= nrl;
+
+    /* set pointers to rows */
+    m[nrl]=a-ncl;
+    for(i=1,j=nrl+1;i<nrow;i++,j++) m[j]=m[j-1]+ncol;
+
+    /* return pointer to array of pointers to rows */
+    return m;
+}
+
+void free_convert_matrix(float **b, long nrl, long nrh, long ncl, long nch)
+/* free a matrix allocated by convert_matrix() */
+{
+    free((FREE_ARG) (b+nrl-NR_END));
+}
+
 float **matrix(long nrl, long nrh, long ncl, long nch)
 /* allocate a float matrix with subscript range m[nrl..nrh][ncl..nch] */
 {
@@ -62,13 +132,13 @@ float **matrix(long nrl, long nrh, long ncl, long nch)
     float **m;
 
     /* allocate pointers to rows */
-    m=(float **) malloc((unsigned int)((nrow+NR_END)*sizeof(float*)));
+    m=(float **) malloc((size_t)((nrow+NR_END)*sizeof(float*)));
     if (!m) nrerror("allocation failure 1 in matrix()");
     m += NR_END;
     m -= nrl;
 
     /* allocate rows and set pointers to them */
-    m[nrl]=(float *) malloc((unsigned int)((nrow*ncol+NR_END)*sizeof(float)));
+    m[nrl]=(float *) malloc((size_t)((nrow*ncol+NR_END)*sizeof(float)));
     if (!m[nrl]) nrerror("allocation failure 2 in matrix()");
     m[nrl] += NR_END;
     m[nrl] -= ncl;
@@ -79,75 +149,6 @@ float **matrix(long nrl, long nrh, long ncl, long nch)
     return m;
 }
 
-#define SWAP(a,b) itemp=(a);(a)=(b);(b)=itemp;
-#define M 7
-#define NSTACK 100000
-
-void indexx(int n, float arr[], int indx[])
-/* sort index table indx such that arr[indx[j]] is in increasing order for j=1,...,n */
-{
-    unsigned long i,indxt,ir=n,itemp,j,k,l=1;
-    int jstack=0,*istack;
-    float a;
-
-    istack=ivector(1,NSTACK);
-    for (j=1;j<=n;j++) indx[j]=j;
-    for (;;) {
-        if (ir-l < M) {
-            for (j=l+1;j<=ir;j++) {
-                indxt=indx[j];
-                a=arr[indxt];
-                for (i=j-1;i>=1;i--) {
-                    if (arr[indx[i]] <= a) break;
-                    indx[i+1]=indx[i];
-                }
-                indx[i+1]=indxt;
-            }
-            if (jstack == 0) break;
-            ir=istack[jstack--];
-            l=istack[jstack--];
-        } else {
-            k=(l+ir) >> 1;
-            SWAP(indx[k],indx[l+1]);
-            if (arr[indx[l+1]] > arr[indx[ir]]) {
-                SWAP(indx[l+1],indx[ir])
-            }
-            if (arr[indx[l]] > arr[indx[ir]]) {
-                SWAP(indx[l],indx[ir])
-            }
-            if (arr[indx[l+1]] > arr[indx[l]]) {
-                SWAP(indx[l+1],indx[l])
-            }
-            i=l+1;
-            j=ir;
-            indxt=indx[l];
-            a=arr[indxt];
-            for (;;) {
-                do i++; while (arr[indx[i]] < a);
-                do j--; while (arr[indx[j]] > a);
-                if (j < i) break;
-                SWAP(indx[i],indx[j])
-            }
-            indx[l]=indx[j];
-            indx[j]=indxt;
-            jstack += 2;
-            if (ir-i+1 >= j-l) {
-                istack[jstack]=ir;
-                istack[jstack-1]=i;
-                ir=j-1;
-            } else {
-                istack[jstack]=j-1;
-                istack[jstack-1]=l;
-                l=i;
-            }
-        }
-    }
-    free_ivector(istack,1,NSTACK);
-}
-#undef M
-#undef NSTACK
-#undef SWAP
-
 void fileerrorcheck(FILE *fp)
 {
     if (fp==NULL)
@@ -7,8 +7,14 @@ void free_vector(float *v, long nl, long nh);
 void free_matrix(float **m, long nrl,long nrh,long ncl,long nch);
 float *vector(long nl, long nh);
 int *ivector(long nl, long nh);
+long *lvector(long nl, long nh);
+void free_lvector(long *v, long nl, long nh);
+unsigned char *cvector(long nl, long nh);
+unsigned char *zero_cvector(long nl, long nh);
+void free_cvector(unsigned char *v, long nl, long nh);
 float **matrix(long nrl, long nrh, long ncl, long nch);
-void indexx(int n, float arr[], int indx[]);
+float **convert_matrix(float *a, long nrl, long nrh, long ncl, long nch);
+void free_convert_matrix(float **b, long nrl, long nrh, long ncl, long nch);
 void fileerrorcheck(FILE *fp);
 
 #endif /* UTILITIES_H*/
\ No newline at end of file